@@ -8,8 +8,13 @@ CREATE TABLE IF NOT EXISTS cadastro.veiculo (
   criado_em TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 
+-- Particionada por mês (UTC) em data_evento: rastreio.posicao_AAAAMM. As partições são criadas
+-- pelo ETL (rastreio.garantir_particoes_posicao) antes de cada carga e POSICAO_PARTICOES_FUTURAS
+-- meses à frente; as antigas saem por rastreio.aplicar_retencao_posicao (POSICAO_RETENCAO_MESES).
+-- A PK inclui a chave de partição; o dedup por id_position continua exato porque data_evento
+-- é derivado do EventDate do próprio item (a API devolve o mesmo par em toda releitura).
 CREATE TABLE IF NOT EXISTS rastreio.posicao (
-  id_position BIGINT PRIMARY KEY,
+  id_position BIGINT NOT NULL,
   placa TEXT NOT NULL REFERENCES cadastro.veiculo(placa),
   id_event INT,
   ignicao BOOLEAN,
@@ -25,13 +30,113 @@ CREATE TABLE IF NOT EXISTS rastreio.posicao (
   outputs JSONB,
   telemetria JSONB,
   nivel_tanque_percent NUMERIC,
-  raw JSONB
-);
+  raw JSONB,
+  PRIMARY KEY (id_position, data_evento)
+) PARTITION BY RANGE (data_evento);
 CREATE INDEX IF NOT EXISTS idx_posicao_placa_evento
   ON rastreio.posicao (placa, data_evento DESC);
   CREATE INDEX IF NOT EXISTS idx_posicao_geom
   ON rastreio.posicao USING GIST (geom);
 
+-- Cria as partições mensais que faltam entre os meses de p_ini e p_fim (inclusive).
+-- Idempotente e serializada por advisory lock (vários workers podem chamar ao mesmo tempo).
+CREATE OR REPLACE FUNCTION rastreio.garantir_particoes_posicao(p_ini date, p_fim date)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  m     date := date_trunc('month', p_ini)::date;
+  nome  text;
+  n     integer := 0;
+BEGIN
+  PERFORM pg_advisory_xact_lock(hashtext('rastreio.posicao:particoes'));
+  WHILE m <= p_fim LOOP
+    nome := 'posicao_' || to_char(m, 'YYYYMM');
+    IF to_regclass(format('rastreio.%I', nome)) IS NULL THEN
+      EXECUTE format(
+        'CREATE TABLE rastreio.%I PARTITION OF rastreio.posicao FOR VALUES FROM (%L) TO (%L)',
+        nome, m::timestamp AT TIME ZONE 'UTC', (m + interval '1 month')::timestamp AT TIME ZONE 'UTC');
+      n := n + 1;
+    ELSIF NOT EXISTS (SELECT 1 FROM pg_inherits
+                       WHERE inhrelid = format('rastreio.%I', nome)::regclass
+                         AND inhparent = 'rastreio.posicao'::regclass) THEN
+      RAISE EXCEPTION 'rastreio.% existe mas não está anexada a rastreio.posicao (desanexada pela retenção?)', nome;
+    END IF;
+    m := (m + interval '1 month')::date;
+  END LOOP;
+  RETURN n;
+END;
+$$;
+
+-- Retenção: desanexa (ou remove, com p_remover) as partições mensais anteriores aos últimos
+-- p_meses meses completos. Partições desanexadas continuam no schema rastreio para arquivo.
+CREATE OR REPLACE FUNCTION rastreio.aplicar_retencao_posicao(p_meses integer, p_remover boolean DEFAULT FALSE)
+RETURNS SETOF text
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  corte date;
+  r     record;
+BEGIN
+  IF p_meses IS NULL OR p_meses <= 0 THEN
+    RETURN;
+  END IF;
+  corte := (date_trunc('month', now() AT TIME ZONE 'UTC') - make_interval(months => p_meses))::date;
+  FOR r IN
+    SELECT c.relname
+      FROM pg_inherits i
+      JOIN pg_class c ON c.oid = i.inhrelid
+     WHERE i.inhparent = 'rastreio.posicao'::regclass
+       AND c.relname ~ '^posicao_[0-9]{6}$'
+       AND to_date(substr(c.relname, 9), 'YYYYMM') < corte
+     ORDER BY c.relname
+  LOOP
+    IF p_remover THEN
+      EXECUTE format('DROP TABLE rastreio.%I', r.relname);
+    ELSE
+      EXECUTE format('ALTER TABLE rastreio.posicao DETACH PARTITION rastreio.%I', r.relname);
+    END IF;
+    RETURN NEXT r.relname;
+  END LOOP;
+END;
+$$;
+
+-- Meses correntes na subida do banco; o ETL cria as demais conforme a necessidade
+SELECT rastreio.garantir_particoes_posicao((now() - interval '1 month')::date, (now() + interval '3 months')::date);
+
+-- Última posição de cada placa, mantida pelo ETL (upsert na mesma instrução do INSERT em
+-- rastreio.posicao). Substitui o ROW_NUMBER() sobre todo o histórico em rastreio.v_ultima_posicao.
+-- Conferência/reconstrução: python etl.py posicao-atual [--corrigir]
+CREATE TABLE IF NOT EXISTS rastreio.posicao_atual (
+  placa TEXT PRIMARY KEY REFERENCES cadastro.veiculo(placa),
+  id_position BIGINT NOT NULL,
+  id_event INT,
+  ignicao BOOLEAN,
+  valid_gps BOOLEAN,
+  data_evento TIMESTAMPTZ NOT NULL,
+  data_atualizacao TIMESTAMPTZ,
+  latitude DOUBLE PRECISION NOT NULL,
+  longitude DOUBLE PRECISION NOT NULL,
+  velocidade_kmh numeric(10,2),
+  geom geometry(Point, 4326)
+  GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)) STORED,
+  inputs JSONB,
+  outputs JSONB,
+  telemetria JSONB,
+  nivel_tanque_percent NUMERIC,
+  raw JSONB,
+  atualizado_em TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Marca d'água da ingestão: último item gravado por placa (cursor exato da paginação da API).
+-- Atualizada na mesma transação do INSERT em rastreio.posicao.
+CREATE TABLE IF NOT EXISTS rastreio.ingestao_cursor (
+  placa              TEXT PRIMARY KEY REFERENCES cadastro.veiculo(placa),
+  ultimo_evento_api  TIMESTAMPTZ NOT NULL,   -- EventDate da API (UTC, sem FIX_UTC_OFFSET_HOURS)
+  ultimo_id_position BIGINT NOT NULL,
+  atualizado_em      TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
 -- Índices úteis
 CREATE INDEX IF NOT EXISTS evento_tanque_placa_idx ON operacao.evento_tanque(placa);
 CREATE INDEX IF NOT EXISTS evento_tanque_status_idx ON operacao.evento_tanque(status);
@@ -40,7 +145,7 @@ CREATE INDEX IF NOT EXISTS evento_tanque_inicio_idx ON operacao.evento_tanque(in
 CREATE TABLE IF NOT EXISTS operacao.sessao_tanque (
   id_sessao        BIGSERIAL PRIMARY KEY,
   placa            VARCHAR(64) NOT NULL,
-  tipo             VARCHAR(16) NOT NULL CHECK (tipo IN ('COLETA','DESCARGA','DESCARTE_CORRETO','DESCARTE_INDEVIDO')),
+  tipo             VARCHAR(32) NOT NULL CHECK (tipo IN ('COLETA','DESCARGA','DESCARTE_CORRETO','DESCARTE_INDEVIDO')),
   inicio_em        TIMESTAMPTZ NOT NULL,
   fim_em           TIMESTAMPTZ NULL,
   nivel_inicio_pct NUMERIC(6,3) NOT NULL,
@@ -49,16 +154,32 @@ CREATE TABLE IF NOT EXISTS operacao.sessao_tanque (
   lon_inicio       NUMERIC(10,6) NULL,
   lat_fim          NUMERIC(10,6) NULL,
   lon_fim          NUMERIC(10,6) NULL,
+  id_position_inicio BIGINT NULL,   -- posição que originou inicio_em (base do detector)
+  id_position_fim    BIGINT NULL,   -- último touch; vira a posição de fim_em ao fechar
   origem           TEXT NOT NULL DEFAULT 'pp_v1',
   criado_em        TIMESTAMPTZ NOT NULL DEFAULT now(),
   atualizado_em    TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 
+-- bancos criados antes das colunas de posição: sessões antigas ficam NULL até o
+-- `etl.py sessoes-posicoes` (as views caem na busca por horário enquanto isso)
+ALTER TABLE operacao.sessao_tanque ADD COLUMN IF NOT EXISTS id_position_inicio BIGINT NULL;
+ALTER TABLE operacao.sessao_tanque ADD COLUMN IF NOT EXISTS id_position_fim    BIGINT NULL;
+
 -- 1 sessão aberta por placa+tipo (fim_em IS NULL)
 CREATE UNIQUE INDEX IF NOT EXISTS sessao_tanque_open_unique
 ON operacao.sessao_tanque (placa, tipo)
 WHERE fim_em IS NULL;
 
+-- Snapshot do detector por tendência (etl.DetectorTendencia) de cada placa: sessão aberta,
+-- base de nível, bloqueio do geofence e pontos pendentes do anti-spike.
+-- Gravado na mesma transação das sessões; permite retomar a detecção exatamente após restart.
+CREATE TABLE IF NOT EXISTS operacao.detector_estado (
+  placa         TEXT PRIMARY KEY REFERENCES cadastro.veiculo(placa),
+  estado        JSONB NOT NULL,
+  atualizado_em TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
 -- 02_areas_descarte.sql
 CREATE SCHEMA IF NOT EXISTS operacao;
 
@@ -89,6 +210,30 @@ CREATE INDEX IF NOT EXISTS idx_area_descarte_gix
   ON operacao.area_descarte
   USING GIST (geom);
 
+-- Versão do cadastro de áreas: o ETL mantém as áreas em memória (etl.IndiceAreas) e só relê a
+-- tabela quando este número muda. Incrementado na mesma transação de qualquer alteração.
+CREATE TABLE IF NOT EXISTS operacao.area_descarte_versao (
+  id     BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),   -- linha única
+  versao BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO operacao.area_descarte_versao DEFAULT VALUES ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION operacao.trg_area_descarte_versao_fn()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  UPDATE operacao.area_descarte_versao SET versao = versao + 1;
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_area_descarte_versao ON operacao.area_descarte;
+CREATE TRIGGER trg_area_descarte_versao
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON operacao.area_descarte
+FOR EACH STATEMENT
+EXECUTE FUNCTION operacao.trg_area_descarte_versao_fn();
+
 CREATE INDEX IF NOT EXISTS sessao_tanque_placa_idx ON operacao.sessao_tanque (placa);
 CREATE INDEX IF NOT EXISTS sessao_tanque_inicio_idx ON operacao.sessao_tanque (inicio_em);
 CREATE INDEX IF NOT EXISTS sessao_tanque_fim_idx    ON operacao.sessao_tanque (fim_em);
\ No newline at end of file
@@ -5,16 +5,9 @@ CREATE SCHEMA IF NOT EXISTS cadastro;
 CREATE SCHEMA IF NOT EXISTS rastreio;
 CREATE SCHEMA IF NOT EXISTS operacao;
 
--- Última posição por placa (ajuste mínimo; usa dados básicos já gravados em rastreio.posicao)
+-- Última posição por placa: lida de rastreio.posicao_atual (1 linha por placa, mantida pelo ETL),
+-- sem varrer o histórico de rastreio.posicao
 CREATE OR REPLACE VIEW rastreio.v_ultima_posicao AS
-WITH ult AS (
-  SELECT p.*,
-         ROW_NUMBER() OVER (
-           PARTITION BY p.placa
-           ORDER BY p.data_evento DESC, p.id_position DESC
-         ) AS rn
-    FROM rastreio.posicao p
-)
 SELECT
   u.placa,
   v.empresa,
@@ -34,9 +27,8 @@ SELECT
   u.outputs,
   u.telemetria,
   u.raw
-FROM ult u
-JOIN cadastro.veiculo v ON v.placa = u.placa
-WHERE u.rn = 1;
+FROM rastreio.posicao_atual u
+JOIN cadastro.veiculo v ON v.placa = u.placa;
 
 CREATE OR REPLACE VIEW rastreio.vw_ultimas_posicoes_detalhe AS
 SELECT * FROM rastreio.v_ultima_posicao;
@@ -67,10 +59,18 @@ WHERE s.fim_em IS NOT NULL;
 
 
 -- Painel unificado: início e fim das sessões + última posição por placa
+-- id_posicao de início/fim vem gravado na sessão pelo detector; a busca por horário só roda
+-- para sessões antigas ainda sem o id (COALESCE não avalia a subconsulta quando há valor).
 CREATE OR REPLACE VIEW operacao.vw_painel_tanque AS
 /* Início das sessões fechadas */
 SELECT
-  p_ini.id_position            AS id_posicao,
+  COALESCE(s.id_position_inicio, (
+    SELECT id_position
+      FROM rastreio.posicao
+     WHERE placa = s.placa
+       AND data_evento <= s.inicio_em
+     ORDER BY data_evento DESC, id_position DESC
+     LIMIT 1))                 AS id_posicao,
   s.placa,
   v.empresa,
   s.tipo::text                 AS tipo,
@@ -79,21 +79,19 @@ SELECT
   (v.capacidade_tanque_litros * s.nivel_inicio_pct / 100.0) AS volume_estimado_l
 FROM operacao.sessao_tanque s
 JOIN cadastro.veiculo v USING (placa)
-LEFT JOIN LATERAL (
-  SELECT id_position
-    FROM rastreio.posicao
-   WHERE placa = s.placa
-     AND data_evento <= s.inicio_em
-   ORDER BY data_evento DESC, id_position DESC
-   LIMIT 1
-) p_ini ON TRUE
 WHERE s.fim_em IS NOT NULL
 
 UNION ALL
 
 /* Fim das sessões fechadas */
 SELECT
-  p_fim.id_position           AS id_posicao,
+  COALESCE(s.id_position_fim, (
+    SELECT id_position
+      FROM rastreio.posicao
+     WHERE placa = s.placa
+       AND data_evento <= s.fim_em
+     ORDER BY data_evento DESC, id_position DESC
+     LIMIT 1))                 AS id_posicao,
   s.placa,
   v.empresa,
   s.tipo::text                AS tipo,
@@ -102,14 +100,6 @@ SELECT
   (v.capacidade_tanque_litros * s.nivel_fim_pct / 100.0) AS volume_estimado_l
 FROM operacao.sessao_tanque s
 JOIN cadastro.veiculo v USING (placa)
-LEFT JOIN LATERAL (
-  SELECT id_position
-    FROM rastreio.posicao
-   WHERE placa = s.placa
-     AND data_evento <= s.fim_em
-   ORDER BY data_evento DESC, id_position DESC
-   LIMIT 1
-) p_fim ON TRUE
 WHERE s.fim_em IS NOT NULL
 
 UNION ALL
@@ -263,16 +253,26 @@ $$;
 
 -- Trigger: ao finalizar uma sessão de "DESCARGA",
 -- trocar para DESCARTE_CORRETO ou DESCARTE_INDEVIDO.
+-- O ETL grava as sessões em lote: uma DESCARGA aberta e finalizada no mesmo ciclo
+-- já chega finalizada no INSERT, por isso o INSERT também conta como finalização.
+-- Com as áreas em memória o ETL já grava DESCARTE_*; essas linhas passam direto e o
+-- trigger só classifica o que chega como DESCARGA (ex.: fechamento por GAP).
+-- BEFORE: a troca de NEW.tipo só vale antes da gravação da linha.
 CREATE OR REPLACE FUNCTION operacao.trg_classificar_descarte_fn()
 RETURNS TRIGGER
 LANGUAGE plpgsql
 AS $$
+DECLARE
+  v_finalizou boolean;
 BEGIN
   -- Só atua quando a sessão acabou de ser finalizada
-  IF TG_OP = 'UPDATE'
-     AND NEW.fim_em IS NOT NULL
-     AND (OLD.fim_em IS NULL)
-     AND OLD.tipo = 'DESCARGA'
+  IF TG_OP = 'INSERT' THEN
+    v_finalizou := NEW.fim_em IS NOT NULL AND NEW.tipo = 'DESCARGA';
+  ELSE
+    v_finalizou := NEW.fim_em IS NOT NULL AND OLD.fim_em IS NULL AND NEW.tipo = 'DESCARGA';
+  END IF;
+
+  IF v_finalizou
   THEN
     -- Usa lat/lon de fim; se nulos, tenta lat/lon de início
     -- (NEW.lat_fim pode ser alimentado por sessao_touch no ETL)
@@ -295,6 +295,6 @@ DROP TRIGGER IF EXISTS trg_classificar_descarte
 ON operacao.sessao_tanque;
 
 CREATE TRIGGER trg_classificar_descarte
-AFTER UPDATE OF fim_em ON operacao.sessao_tanque
+BEFORE INSERT OR UPDATE OF fim_em ON operacao.sessao_tanque
 FOR EACH ROW
 EXECUTE FUNCTION operacao.trg_classificar_descarte_fn();
\ No newline at end of file
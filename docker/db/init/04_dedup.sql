@@ -11,7 +11,8 @@ AS $$
   SELECT CASE
            WHEN cap_l IS NULL OR ini IS NULL OR fim IS NULL THEN NULL
            WHEN tipo = 'COLETA'   THEN cap_l * GREATEST(fim - ini, 0) / 100.0
-           WHEN tipo = 'DESCARGA' THEN cap_l * GREATEST(ini - fim, 0) / 100.0
+           WHEN tipo IN ('DESCARGA','DESCARTE_CORRETO','DESCARTE_INDEVIDO')
+                                 THEN cap_l * GREATEST(ini - fim, 0) / 100.0
            ELSE NULL
          END
 $$;
@@ -65,6 +66,7 @@ BEGIN
        SET nivel_fim_pct = COALESCE(p_nivel, nivel_fim_pct),
            lat_fim       = COALESCE(p_lat, lat_fim),
            lon_fim       = COALESCE(p_lon, lon_fim),
+           id_position_fim = COALESCE(p_origem_posicao, id_position_fim),
            atualizado_em = p_data_hora
      WHERE id_sessao = s_id;
 
@@ -81,12 +83,14 @@ AS $$
 DECLARE
   v_count int := 0;
 BEGIN
+  PERFORM set_config('operacao.evento_sessao', 'fechada_gap', true);   -- evento em sessao_evento (07)
   UPDATE operacao.sessao_tanque
      SET fim_em = atualizado_em, atualizado_em = now()
    WHERE fim_em IS NULL
      AND atualizado_em < now() - (p_gap_min || ' minutes')::interval;
 
   GET DIAGNOSTICS v_count = ROW_COUNT;
+  PERFORM set_config('operacao.evento_sessao', '', true);
   RETURN v_count;
 END;
 $$;
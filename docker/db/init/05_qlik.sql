@@ -0,0 +1,253 @@
+-- 05_qlik.sql — tabelas físicas para o Qlik, mantidas pelo ETL no fim de cada ciclo
+--
+-- Mesmas colunas de operacao.vw_qlik_snapshot / vw_qlik_timeline / vw_painel_tanque, mais:
+--   versao        -> valor de operacao.qlik_versao_seq do ciclo em que a linha mudou pela última vez
+--   removido      -> tombstone: a linha saiu da view (sessão cancelada/apagada); fica para a carga incremental
+--   atualizado_em -> quando a linha foi escrita
+-- Carga incremental no Qlik: WHERE versao > <maior versao já carregada>, aplicando removido.
+-- Só placas/sessões tocadas no ciclo são recalculadas (operacao.qlik_atualizar); linhas que não
+-- mudaram não ganham versão nova. Reconstrução completa: python etl.py qlik-reconstruir
+
+CREATE SEQUENCE IF NOT EXISTS operacao.qlik_versao_seq;
+
+CREATE TABLE IF NOT EXISTS operacao.qlik_snapshot (
+  placa                          TEXT PRIMARY KEY,
+  empresa                        TEXT,
+  descricao                      TEXT,
+  capacidade_tanque_litros       NUMERIC,
+  agora_horario                  TIMESTAMPTZ,
+  agora_data                     DATE,
+  agora_lat                      DOUBLE PRECISION,
+  agora_lon                      DOUBLE PRECISION,
+  agora_nivel_percent            NUMERIC,
+  agora_tanque_l                 NUMERIC,
+  sessao_id                      BIGINT,
+  sessao_tipo                    TEXT,
+  sessao_inicio                  TIMESTAMPTZ,
+  sessao_fim                     TIMESTAMPTZ,
+  sessao_nivel_inicio_pct        NUMERIC(6,3),
+  sessao_nivel_fim_pct           NUMERIC(6,3),
+  litros_inicio                  NUMERIC,
+  litros_fim                     NUMERIC,
+  volume_estimado_l              NUMERIC,
+  sessao_lat_inicio              NUMERIC(10,6),
+  sessao_lon_inicio              NUMERIC(10,6),
+  sessao_lat_fim                 NUMERIC(10,6),
+  sessao_lon_fim                 NUMERIC(10,6),
+  sessao_aberta_id               BIGINT,
+  sessao_aberta_tipo             TEXT,
+  sessao_aberta_inicio           TIMESTAMPTZ,
+  sessao_aberta_nivel_inicio_pct NUMERIC(6,3),
+  sessao_aberta_lat_inicio       NUMERIC(10,6),
+  sessao_aberta_lon_inicio       NUMERIC(10,6),
+  versao                         BIGINT NOT NULL,
+  removido                       BOOLEAN NOT NULL DEFAULT FALSE,
+  atualizado_em                  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS qlik_snapshot_versao_idx ON operacao.qlik_snapshot (versao);
+
+-- Timeline e painel: 1 linha por (ponto, ref, placa). ref = id_sessao em 'Início'/'Fim', 0 em 'Agora'.
+CREATE TABLE IF NOT EXISTS operacao.qlik_timeline (
+  ponto             TEXT NOT NULL,
+  ref               BIGINT NOT NULL,
+  placa             TEXT NOT NULL,
+  id_posicao        BIGINT,
+  empresa           TEXT,
+  tipo              TEXT,
+  horario           TIMESTAMPTZ,
+  data_filtro       DATE,
+  volume_estimado_l NUMERIC,
+  versao            BIGINT NOT NULL,
+  removido          BOOLEAN NOT NULL DEFAULT FALSE,
+  atualizado_em     TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (ponto, ref, placa)
+);
+CREATE INDEX IF NOT EXISTS qlik_timeline_versao_idx ON operacao.qlik_timeline (versao);
+
+CREATE TABLE IF NOT EXISTS operacao.qlik_painel (
+  ponto             TEXT NOT NULL,
+  ref               BIGINT NOT NULL,
+  placa             TEXT NOT NULL,
+  id_posicao        BIGINT,
+  empresa           TEXT,
+  tipo              TEXT,
+  horario           TIMESTAMPTZ,
+  volume_estimado_l NUMERIC,
+  versao            BIGINT NOT NULL,
+  removido          BOOLEAN NOT NULL DEFAULT FALSE,
+  atualizado_em     TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (ponto, ref, placa)
+);
+CREATE INDEX IF NOT EXISTS qlik_painel_versao_idx ON operacao.qlik_painel (versao);
+
+-- Recalcula as linhas das placas (snapshot + 'Agora') e sessões (Início/Fim) informadas.
+-- As regras são as das views vw_qlik_snapshot, vw_qlik_timeline e vw_painel_tanque; ao mudar
+-- uma view, ajuste o trecho correspondente aqui. Devolve a versão usada.
+CREATE OR REPLACE FUNCTION operacao.qlik_atualizar(p_placas text[], p_sessoes bigint[])
+RETURNS bigint
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v bigint := nextval('operacao.qlik_versao_seq');
+BEGIN
+  p_placas  := COALESCE(p_placas, '{}');
+  p_sessoes := COALESCE(p_sessoes, '{}');
+
+  -- ===== snapshot (1 linha por placa)
+  INSERT INTO operacao.qlik_snapshot AS q
+  SELECT s.*, v, FALSE, now()
+    FROM operacao.vw_qlik_snapshot s
+   WHERE s.placa = ANY(p_placas)
+  ON CONFLICT (placa) DO UPDATE
+     SET (empresa, descricao, capacidade_tanque_litros, agora_horario, agora_data, agora_lat, agora_lon,
+          agora_nivel_percent, agora_tanque_l, sessao_id, sessao_tipo, sessao_inicio, sessao_fim,
+          sessao_nivel_inicio_pct, sessao_nivel_fim_pct, litros_inicio, litros_fim, volume_estimado_l,
+          sessao_lat_inicio, sessao_lon_inicio, sessao_lat_fim, sessao_lon_fim, sessao_aberta_id,
+          sessao_aberta_tipo, sessao_aberta_inicio, sessao_aberta_nivel_inicio_pct,
+          sessao_aberta_lat_inicio, sessao_aberta_lon_inicio, versao, removido, atualizado_em)
+       = (EXCLUDED.empresa, EXCLUDED.descricao, EXCLUDED.capacidade_tanque_litros, EXCLUDED.agora_horario,
+          EXCLUDED.agora_data, EXCLUDED.agora_lat, EXCLUDED.agora_lon, EXCLUDED.agora_nivel_percent,
+          EXCLUDED.agora_tanque_l, EXCLUDED.sessao_id, EXCLUDED.sessao_tipo, EXCLUDED.sessao_inicio,
+          EXCLUDED.sessao_fim, EXCLUDED.sessao_nivel_inicio_pct, EXCLUDED.sessao_nivel_fim_pct,
+          EXCLUDED.litros_inicio, EXCLUDED.litros_fim, EXCLUDED.volume_estimado_l, EXCLUDED.sessao_lat_inicio,
+          EXCLUDED.sessao_lon_inicio, EXCLUDED.sessao_lat_fim, EXCLUDED.sessao_lon_fim,
+          EXCLUDED.sessao_aberta_id, EXCLUDED.sessao_aberta_tipo, EXCLUDED.sessao_aberta_inicio,
+          EXCLUDED.sessao_aberta_nivel_inicio_pct, EXCLUDED.sessao_aberta_lat_inicio,
+          EXCLUDED.sessao_aberta_lon_inicio, v, FALSE, now())
+   WHERE q.removido
+      OR to_jsonb(q) - 'versao' - 'removido' - 'atualizado_em'
+         IS DISTINCT FROM to_jsonb(EXCLUDED) - 'versao' - 'removido' - 'atualizado_em';
+
+  UPDATE operacao.qlik_snapshot q
+     SET removido = TRUE, versao = v, atualizado_em = now()
+   WHERE q.placa = ANY(p_placas) AND NOT q.removido
+     AND NOT EXISTS (SELECT 1 FROM cadastro.veiculo c WHERE c.placa = q.placa);
+
+  -- ===== timeline (regras de vw_qlik_timeline)
+  CREATE TEMP TABLE IF NOT EXISTS _qlik_linhas (
+    ponto TEXT, ref BIGINT, placa TEXT, id_posicao BIGINT, empresa TEXT, tipo TEXT,
+    horario TIMESTAMPTZ, volume_estimado_l NUMERIC
+  ) ON COMMIT DROP;
+  TRUNCATE _qlik_linhas;
+
+  INSERT INTO _qlik_linhas
+  SELECT 'Início', s.id_sessao, s.placa, s.id_sessao, v2.empresa, s.tipo, s.inicio_em, NULL::numeric
+    FROM operacao.sessao_tanque s JOIN cadastro.veiculo v2 USING (placa)
+   WHERE s.id_sessao = ANY(p_sessoes) AND s.inicio_em IS NOT NULL
+  UNION ALL
+  SELECT 'Fim', s.id_sessao, s.placa, s.id_sessao + 1000000000, v2.empresa, s.tipo, s.fim_em,
+         ABS(v2.capacidade_tanque_litros*(s.nivel_fim_pct - s.nivel_inicio_pct)/100.0)
+    FROM operacao.sessao_tanque s JOIN cadastro.veiculo v2 USING (placa)
+   WHERE s.id_sessao = ANY(p_sessoes) AND s.fim_em IS NOT NULL
+  UNION ALL
+  SELECT 'Agora', 0, u.placa, (EXTRACT(EPOCH FROM u.data_evento))::bigint, v2.empresa, NULL, u.data_evento, NULL
+    FROM rastreio.v_ultima_posicao u JOIN cadastro.veiculo v2 USING (placa)
+   WHERE u.placa = ANY(p_placas);
+
+  INSERT INTO operacao.qlik_timeline AS q
+         (ponto, ref, placa, id_posicao, empresa, tipo, horario, data_filtro, volume_estimado_l, versao)
+  SELECT ponto, ref, placa, id_posicao, empresa, tipo, horario, CAST(horario AS date), volume_estimado_l, v
+    FROM _qlik_linhas
+  ON CONFLICT (ponto, ref, placa) DO UPDATE
+     SET (id_posicao, empresa, tipo, horario, data_filtro, volume_estimado_l, versao, removido, atualizado_em)
+       = (EXCLUDED.id_posicao, EXCLUDED.empresa, EXCLUDED.tipo, EXCLUDED.horario, EXCLUDED.data_filtro,
+          EXCLUDED.volume_estimado_l, v, FALSE, now())
+   WHERE q.removido
+      OR (q.id_posicao, q.empresa, q.tipo, q.horario, q.volume_estimado_l)
+         IS DISTINCT FROM (EXCLUDED.id_posicao, EXCLUDED.empresa, EXCLUDED.tipo, EXCLUDED.horario,
+                           EXCLUDED.volume_estimado_l);
+
+  UPDATE operacao.qlik_timeline q
+     SET removido = TRUE, versao = v, atualizado_em = now()
+   WHERE NOT q.removido
+     AND ((q.ponto IN ('Início', 'Fim') AND q.ref = ANY(p_sessoes))
+       OR (q.ponto = 'Agora' AND q.ref = 0 AND q.placa = ANY(p_placas)))
+     AND NOT EXISTS (SELECT 1 FROM _qlik_linhas l
+                      WHERE l.ponto = q.ponto AND l.ref = q.ref AND l.placa = q.placa);
+
+  -- ===== painel (regras de vw_painel_tanque: só sessões fechadas + última posição)
+  TRUNCATE _qlik_linhas;
+
+  INSERT INTO _qlik_linhas
+  SELECT 'Início', s.id_sessao, s.placa,
+         COALESCE(s.id_position_inicio, (SELECT id_position FROM rastreio.posicao
+                             WHERE placa = s.placa AND data_evento <= s.inicio_em
+                             ORDER BY data_evento DESC, id_position DESC LIMIT 1)),
+         v2.empresa, s.tipo::text, s.inicio_em,
+         v2.capacidade_tanque_litros * s.nivel_inicio_pct / 100.0
+    FROM operacao.sessao_tanque s JOIN cadastro.veiculo v2 USING (placa)
+   WHERE s.id_sessao = ANY(p_sessoes) AND s.fim_em IS NOT NULL
+  UNION ALL
+  SELECT 'Fim', s.id_sessao, s.placa,
+         COALESCE(s.id_position_fim, (SELECT id_position FROM rastreio.posicao
+                             WHERE placa = s.placa AND data_evento <= s.fim_em
+                             ORDER BY data_evento DESC, id_position DESC LIMIT 1)),
+         v2.empresa, s.tipo::text, s.fim_em,
+         v2.capacidade_tanque_litros * s.nivel_fim_pct / 100.0
+    FROM operacao.sessao_tanque s JOIN cadastro.veiculo v2 USING (placa)
+   WHERE s.id_sessao = ANY(p_sessoes) AND s.fim_em IS NOT NULL
+  UNION ALL
+  SELECT 'Agora', 0, u.placa, u.id_position, u.empresa, NULL, u.data_evento,
+         CASE WHEN u.capacidade_tanque_litros IS NOT NULL AND u.nivel_tanque_percent IS NOT NULL
+              THEN u.capacidade_tanque_litros * (u.nivel_tanque_percent/100.0) END
+    FROM rastreio.v_ultima_posicao u
+   WHERE u.placa = ANY(p_placas);
+
+  INSERT INTO operacao.qlik_painel AS q
+         (ponto, ref, placa, id_posicao, empresa, tipo, horario, volume_estimado_l, versao)
+  SELECT ponto, ref, placa, id_posicao, empresa, tipo, horario, volume_estimado_l, v
+    FROM _qlik_linhas
+  ON CONFLICT (ponto, ref, placa) DO UPDATE
+     SET (id_posicao, empresa, tipo, horario, volume_estimado_l, versao, removido, atualizado_em)
+       = (EXCLUDED.id_posicao, EXCLUDED.empresa, EXCLUDED.tipo, EXCLUDED.horario,
+          EXCLUDED.volume_estimado_l, v, FALSE, now())
+   WHERE q.removido
+      OR (q.id_posicao, q.empresa, q.tipo, q.horario, q.volume_estimado_l)
+         IS DISTINCT FROM (EXCLUDED.id_posicao, EXCLUDED.empresa, EXCLUDED.tipo, EXCLUDED.horario,
+                           EXCLUDED.volume_estimado_l);
+
+  UPDATE operacao.qlik_painel q
+     SET removido = TRUE, versao = v, atualizado_em = now()
+   WHERE NOT q.removido
+     AND ((q.ponto IN ('Início', 'Fim') AND q.ref = ANY(p_sessoes))
+       OR (q.ponto = 'Agora' AND q.ref = 0 AND q.placa = ANY(p_placas)))
+     AND NOT EXISTS (SELECT 1 FROM _qlik_linhas l
+                      WHERE l.ponto = q.ponto AND l.ref = q.ref AND l.placa = q.placa);
+
+  RETURN v;
+END;
+$$;
+
+-- Reconstrução completa: todas as placas e sessões (inclusive as que só restam nas tabelas,
+-- que viram tombstone). Uso pontual: após carga manual, mudança de view ou migração.
+CREATE OR REPLACE FUNCTION operacao.qlik_reconstruir()
+RETURNS bigint
+LANGUAGE SQL
+AS $$
+  SELECT operacao.qlik_atualizar(
+    ARRAY(SELECT placa FROM cadastro.veiculo
+          UNION SELECT placa FROM operacao.qlik_snapshot
+          UNION SELECT placa FROM operacao.qlik_timeline WHERE ponto = 'Agora'
+          UNION SELECT placa FROM operacao.qlik_painel WHERE ponto = 'Agora'),
+    ARRAY(SELECT id_sessao FROM operacao.sessao_tanque
+          UNION SELECT ref FROM operacao.qlik_timeline WHERE ponto <> 'Agora'
+          UNION SELECT ref FROM operacao.qlik_painel WHERE ponto <> 'Agora'));
+$$;
+
+-- Fechamento por GAP que devolve o que fechou, para o ETL saber quais placas/sessões
+-- atualizar no Qlik (fechar_sessoes_stagnadas só devolve a contagem).
+CREATE OR REPLACE FUNCTION operacao.fechar_sessoes_stagnadas_placas(p_gap_min integer DEFAULT 60)
+RETURNS TABLE (id_sessao bigint, placa text)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  PERFORM set_config('operacao.evento_sessao', 'fechada_gap', true);   -- evento em sessao_evento (07)
+  RETURN QUERY
+  UPDATE operacao.sessao_tanque s
+     SET fim_em = s.atualizado_em, atualizado_em = now()
+   WHERE s.fim_em IS NULL
+     AND s.atualizado_em < now() - (p_gap_min || ' minutes')::interval
+  RETURNING s.id_sessao, s.placa::text;
+  PERFORM set_config('operacao.evento_sessao', '', true);
+END;
+$$;
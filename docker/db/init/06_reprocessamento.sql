@@ -0,0 +1,111 @@
+-- Reprocessamento offline das sessões (etl.py reprocessar).
+-- Cada execução recebe uma 'origem' (ex.: reproc_20250101_120000), grava as sessões recalculadas
+-- em operacao.sessao_tanque_sombra e só substitui operacao.sessao_tanque quando
+-- operacao.trocar_sessoes_sombra(origem) é chamada, numa única transação.
+CREATE SCHEMA IF NOT EXISTS operacao;
+
+CREATE TABLE IF NOT EXISTS operacao.reprocessamento (
+  origem        TEXT PRIMARY KEY,
+  placas        TEXT[] NOT NULL,
+  de            TIMESTAMPTZ NOT NULL,
+  ate           TIMESTAMPTZ NOT NULL,       -- exclusivo
+  parametros    JSONB NOT NULL,             -- configuração do detector usada na execução
+  posicoes      BIGINT,
+  criado_em     TIMESTAMPTZ NOT NULL DEFAULT now(),
+  concluido_em  TIMESTAMPTZ,
+  trocado_em    TIMESTAMPTZ
+);
+
+-- Mesmas colunas de operacao.sessao_tanque (id próprio) + origem da execução.
+-- Sessão ainda aberta no fim do intervalo fica com fim_em NULL e não entra na troca.
+CREATE TABLE IF NOT EXISTS operacao.sessao_tanque_sombra (
+  id_sessao          BIGSERIAL PRIMARY KEY,
+  origem             TEXT NOT NULL REFERENCES operacao.reprocessamento(origem) ON DELETE CASCADE,
+  placa              VARCHAR(64) NOT NULL,
+  tipo               VARCHAR(32) NOT NULL,
+  inicio_em          TIMESTAMPTZ NOT NULL,
+  fim_em             TIMESTAMPTZ NULL,
+  nivel_inicio_pct   NUMERIC(6,3) NOT NULL,
+  nivel_fim_pct      NUMERIC(6,3) NULL,
+  lat_inicio         NUMERIC(10,6) NULL,
+  lon_inicio         NUMERIC(10,6) NULL,
+  lat_fim            NUMERIC(10,6) NULL,
+  lon_fim            NUMERIC(10,6) NULL,
+  id_position_inicio BIGINT NULL,
+  id_position_fim    BIGINT NULL,
+  atualizado_em      TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS sessao_tanque_sombra_origem_idx
+  ON operacao.sessao_tanque_sombra (origem, placa, inicio_em);
+
+-- Atual x sombra por placa e tipo (sessões fechadas com início no intervalo da execução).
+CREATE OR REPLACE FUNCTION operacao.comparar_sessoes_sombra(p_origem text)
+RETURNS TABLE (placa text, tipo text, sessoes_atual bigint, sessoes_sombra bigint,
+               variacao_pp_atual numeric, variacao_pp_sombra numeric)
+LANGUAGE SQL
+STABLE
+AS $$
+  WITH r AS (SELECT * FROM operacao.reprocessamento WHERE origem = p_origem),
+  atual AS (
+    SELECT s.placa::text, s.tipo::text, count(*) AS n,
+           sum(abs(s.nivel_fim_pct - s.nivel_inicio_pct)) AS pp
+      FROM operacao.sessao_tanque s, r
+     WHERE s.placa = ANY(r.placas) AND s.inicio_em >= r.de AND s.inicio_em < r.ate
+       AND s.fim_em IS NOT NULL
+     GROUP BY 1, 2),
+  sombra AS (
+    SELECT s.placa::text, s.tipo::text, count(*) AS n,
+           sum(abs(s.nivel_fim_pct - s.nivel_inicio_pct)) AS pp
+      FROM operacao.sessao_tanque_sombra s
+     WHERE s.origem = p_origem AND s.fim_em IS NOT NULL
+     GROUP BY 1, 2)
+  SELECT placa, tipo, COALESCE(a.n, 0), COALESCE(b.n, 0), a.pp, b.pp
+    FROM atual a FULL JOIN sombra b USING (placa, tipo)
+   ORDER BY placa, tipo;
+$$;
+
+-- Troca atômica: remove as sessões fechadas das placas com início no intervalo e insere as
+-- fechadas da sombra (origem = p_origem). Sessões abertas (da tabela e da sombra) ficam como
+-- estão. Devolve o que saiu e o que entrou, para atualizar as tabelas do Qlik.
+CREATE OR REPLACE FUNCTION operacao.trocar_sessoes_sombra(p_origem text)
+RETURNS TABLE (id_sessao bigint, placa text, acao text)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  r operacao.reprocessamento%ROWTYPE;
+BEGIN
+  SELECT * INTO r FROM operacao.reprocessamento WHERE origem = p_origem FOR UPDATE;
+  IF NOT FOUND THEN
+    RAISE EXCEPTION 'reprocessamento % não existe', p_origem;
+  ELSIF r.concluido_em IS NULL THEN
+    RAISE EXCEPTION 'reprocessamento % não foi concluído', p_origem;
+  ELSIF r.trocado_em IS NOT NULL THEN
+    RAISE EXCEPTION 'reprocessamento % já foi trocado em %', p_origem, r.trocado_em;
+  END IF;
+
+  -- o ETL não grava sessões durante a troca (e não vê o meio dela)
+  LOCK TABLE operacao.sessao_tanque IN SHARE ROW EXCLUSIVE MODE;
+  PERFORM set_config('operacao.evento_sessao', 'reprocessamento', true);   -- removida/inserida em sessao_evento (07)
+
+  RETURN QUERY
+  DELETE FROM operacao.sessao_tanque s
+   WHERE s.placa = ANY(r.placas) AND s.inicio_em >= r.de AND s.inicio_em < r.ate
+     AND s.fim_em IS NOT NULL
+  RETURNING s.id_sessao, s.placa::text, 'removida'::text;
+
+  RETURN QUERY
+  INSERT INTO operacao.sessao_tanque
+         (placa, tipo, inicio_em, fim_em, nivel_inicio_pct, nivel_fim_pct, lat_inicio, lon_inicio,
+          lat_fim, lon_fim, id_position_inicio, id_position_fim, origem, atualizado_em)
+  SELECT b.placa, b.tipo, b.inicio_em, b.fim_em, b.nivel_inicio_pct, b.nivel_fim_pct, b.lat_inicio,
+         b.lon_inicio, b.lat_fim, b.lon_fim, b.id_position_inicio, b.id_position_fim, b.origem, b.atualizado_em
+    FROM operacao.sessao_tanque_sombra b
+   WHERE b.origem = p_origem AND b.fim_em IS NOT NULL
+   ORDER BY b.placa, b.inicio_em
+  RETURNING sessao_tanque.id_sessao, sessao_tanque.placa::text, 'inserida'::text;
+
+  PERFORM set_config('operacao.evento_sessao', '', true);
+  UPDATE operacao.reprocessamento SET trocado_em = now() WHERE origem = p_origem;
+END;
+$$;
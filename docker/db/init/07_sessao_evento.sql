@@ -0,0 +1,143 @@
+-- Log de mudanças de operacao.sessao_tanque para consumidores incrementais (BI, integrações).
+-- Cada mudança relevante de uma sessão vira uma linha em operacao.sessao_evento e um NOTIFY no
+-- canal 'sessao_tanque' (payload JSON compacto, entregue no commit):
+--   aberta         -> INSERT de sessão aberta
+--   finalizada     -> INSERT já fechada ou UPDATE que preenche fim_em
+--   fechada_gap    -> fim_em preenchido por fechar_sessoes_stagnadas(_placas)
+--   cancelada      -> DELETE (sessão aberta invalidada pelo detector)
+--   reclassificada -> tipo mudou (DESCARGA -> DESCARTE_*, pelo ETL ou pelo trigger); tipo_anterior preenchido
+--   removida / inserida -> troca de um reprocessamento (trocar_sessoes_sombra)
+-- Toques (nível/posição de fim) não geram evento. O contexto (fechada_gap, reprocessamento) vem da
+-- variável de transação operacao.evento_sessao, ligada pelas funções que fecham/trocam sessões.
+--
+-- seq cresce na ordem de COMMIT: quem grava evento pega um advisory lock de transação antes do
+-- nextval, então um consumidor que leu até seq N nunca vê aparecer depois um seq menor que N:
+--   SELECT * FROM operacao.sessao_evento WHERE seq > :ultimo ORDER BY seq LIMIT 10000;
+-- O lock é global (um por placa deixaria um seq menor de uma placa commitar depois de um maior de
+-- outra, e o consumidor acima o perderia), mas curto: triggers por comando (transition tables), um
+-- lock por comando e só se ele gerou evento (toques não pegam), e o ETL escreve as sessões no fim
+-- da transação de detecção (gravar -> snapshot -> commit).
+-- LISTEN sessao_tanque avisa quando há o que ler. O ETL apaga eventos com mais de
+-- SESSAO_EVENTOS_RETENCAO_DIAS: consumidor parado por mais tempo que isso recarrega tudo.
+CREATE SCHEMA IF NOT EXISTS operacao;
+
+CREATE TABLE IF NOT EXISTS operacao.sessao_evento (
+  seq            BIGSERIAL PRIMARY KEY,
+  id_sessao      BIGINT NOT NULL,
+  placa          VARCHAR(64) NOT NULL,
+  evento         TEXT NOT NULL,
+  tipo           VARCHAR(32) NOT NULL,
+  tipo_anterior  VARCHAR(32) NULL,
+  inicio_em      TIMESTAMPTZ NOT NULL,
+  fim_em         TIMESTAMPTZ NULL,
+  origem         TEXT NULL,
+  criado_em      TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS sessao_evento_criado_idx ON operacao.sessao_evento (criado_em);
+
+CREATE OR REPLACE FUNCTION operacao.trg_sessao_evento_fn()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_ctx      text := COALESCE(current_setting('operacao.evento_sessao', true), '');
+  v_payloads text[];
+  v_payload  text;
+BEGIN
+  IF TG_OP = 'UPDATE' THEN
+    PERFORM 1 FROM novas n JOIN antigas o USING (id_sessao)
+     WHERE (o.fim_em IS NULL AND n.fim_em IS NOT NULL) OR n.tipo IS DISTINCT FROM o.tipo
+     LIMIT 1;
+    IF NOT FOUND THEN
+      RETURN NULL;   -- só toques (nível/posição de fim): sem evento e sem lock
+    END IF;
+  END IF;
+
+  -- serializa a numeração até o commit: seq visível sempre em ordem crescente
+  PERFORM pg_advisory_xact_lock(hashtext('operacao.sessao_evento'));
+
+  IF TG_OP = 'INSERT' THEN
+    WITH ins AS (
+      INSERT INTO operacao.sessao_evento (id_sessao, placa, evento, tipo, inicio_em, fim_em, origem)
+      SELECT n.id_sessao, n.placa,
+             CASE WHEN v_ctx = 'reprocessamento' THEN 'inserida'
+                  WHEN n.fim_em IS NULL THEN 'aberta'
+                  ELSE 'finalizada' END,
+             n.tipo, n.inicio_em, n.fim_em, n.origem
+        FROM novas n
+       ORDER BY n.id_sessao
+      RETURNING seq, id_sessao, placa, evento, tipo
+    )
+    SELECT array_agg(json_build_object('seq', seq, 'id_sessao', id_sessao, 'placa', placa,
+                                       'evento', evento, 'tipo', tipo)::text ORDER BY seq)
+      INTO v_payloads FROM ins;
+  ELSIF TG_OP = 'DELETE' THEN
+    WITH ins AS (
+      INSERT INTO operacao.sessao_evento (id_sessao, placa, evento, tipo, inicio_em, fim_em, origem)
+      SELECT o.id_sessao, o.placa,
+             CASE WHEN v_ctx = 'reprocessamento' THEN 'removida' ELSE 'cancelada' END,
+             o.tipo, o.inicio_em, o.fim_em, o.origem
+        FROM antigas o
+       ORDER BY o.id_sessao
+      RETURNING seq, id_sessao, placa, evento, tipo
+    )
+    SELECT array_agg(json_build_object('seq', seq, 'id_sessao', id_sessao, 'placa', placa,
+                                       'evento', evento, 'tipo', tipo)::text ORDER BY seq)
+      INTO v_payloads FROM ins;
+  ELSE
+    -- numa mesma sessão o fechamento vem antes da reclassificação (ordem 1, 2)
+    WITH ev AS (
+      SELECT n.id_sessao, n.placa, 1 AS ordem,
+             CASE WHEN v_ctx = 'fechada_gap' THEN 'fechada_gap' ELSE 'finalizada' END AS evento,
+             n.tipo, NULL::varchar AS tipo_anterior, n.inicio_em, n.fim_em, n.origem
+        FROM novas n JOIN antigas o USING (id_sessao)
+       WHERE o.fim_em IS NULL AND n.fim_em IS NOT NULL
+      UNION ALL
+      SELECT n.id_sessao, n.placa, 2, 'reclassificada', n.tipo, o.tipo, n.inicio_em, n.fim_em, n.origem
+        FROM novas n JOIN antigas o USING (id_sessao)
+       WHERE n.tipo IS DISTINCT FROM o.tipo
+    ), ins AS (
+      INSERT INTO operacao.sessao_evento (id_sessao, placa, evento, tipo, tipo_anterior, inicio_em, fim_em, origem)
+      SELECT id_sessao, placa, evento, tipo, tipo_anterior, inicio_em, fim_em, origem
+        FROM ev
+       ORDER BY id_sessao, ordem
+      RETURNING seq, id_sessao, placa, evento, tipo
+    )
+    SELECT array_agg(json_build_object('seq', seq, 'id_sessao', id_sessao, 'placa', placa,
+                                       'evento', evento, 'tipo', tipo)::text ORDER BY seq)
+      INTO v_payloads FROM ins;
+  END IF;
+
+  FOREACH v_payload IN ARRAY COALESCE(v_payloads, '{}') LOOP
+    PERFORM pg_notify('sessao_tanque', v_payload);
+  END LOOP;
+  RETURN NULL;
+END;
+$$;
+
+-- versão anterior (por linha)
+DROP TRIGGER IF EXISTS trg_sessao_evento ON operacao.sessao_tanque;
+
+-- AFTER: vê o tipo final (depois de trg_classificar_descarte) e só registra o que foi gravado.
+-- Transition tables exigem um trigger por operação e não aceitam lista de colunas no UPDATE.
+DROP TRIGGER IF EXISTS trg_sessao_evento_ins ON operacao.sessao_tanque;
+CREATE TRIGGER trg_sessao_evento_ins
+AFTER INSERT ON operacao.sessao_tanque
+REFERENCING NEW TABLE AS novas
+FOR EACH STATEMENT
+EXECUTE FUNCTION operacao.trg_sessao_evento_fn();
+
+DROP TRIGGER IF EXISTS trg_sessao_evento_upd ON operacao.sessao_tanque;
+CREATE TRIGGER trg_sessao_evento_upd
+AFTER UPDATE ON operacao.sessao_tanque
+REFERENCING OLD TABLE AS antigas NEW TABLE AS novas
+FOR EACH STATEMENT
+EXECUTE FUNCTION operacao.trg_sessao_evento_fn();
+
+DROP TRIGGER IF EXISTS trg_sessao_evento_del ON operacao.sessao_tanque;
+CREATE TRIGGER trg_sessao_evento_del
+AFTER DELETE ON operacao.sessao_tanque
+REFERENCING OLD TABLE AS antigas
+FOR EACH STATEMENT
+EXECUTE FUNCTION operacao.trg_sessao_evento_fn();
@@ -0,0 +1 @@
+"""Benchmarks do ETL (rodar a partir de etl/: python -m bench.<modulo>)."""
@@ -0,0 +1,149 @@
+"""
+API local no lugar da de rastreamento: login + HistoryPosition (GET_LAST_POSITIONS_PATH) servindo a
+telemetria sintética de bench.telemetria, com o mesmo limite de itens por resposta (API_SOFT_CAP).
+
+    cd etl && python -m bench.api_local --veiculos 100 --porta 8099 --inicio 2025-01-01
+
+Sobe em primeiro plano e imprime as variáveis para apontar o ETL para ela; as placas são
+BENCH00001..BENCHnnnnn (cadastre-as em cadastro.veiculo com instalado_em = --inicio). Nesse modo
+não devolve posições no futuro do relógio da máquina, então o ETL vê a frota "andando".
+Em código (bench.ciclo): iniciar_processo(...) sobe o servidor em outro processo, sem disputar o
+GIL com o cliente medido.
+"""
+import argparse, json, multiprocessing, secrets, socket, threading, time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench.telemetria import FrotaSintetica
+
+CAMINHO_LOGIN = "/login"
+CAMINHO_POSICOES = "/history-position"
+LIMITE_ITENS = 1000   # mesmo valor de etl.API_SOFT_CAP
+
+
+def _data_api(txt):
+    dt = datetime.fromisoformat(txt[:-1] + "+00:00" if txt.endswith("Z") else txt)
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, como o pool do requests espera
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        # cabeçalho e corpo saem em writes separados: sem isto, Nagle + delayed ACK somam ~40 ms por resposta
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _responder(self, status, corpo=b"", tipo="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def _corpo(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def do_GET(self):
+        self._corpo()
+        if self.path.split("?")[0] == self.server.caminho_login:
+            return self._login()
+        self._responder(404)
+
+    def do_POST(self):
+        corpo = self._corpo()
+        caminho = self.path.split("?")[0]
+        if caminho == self.server.caminho_login:
+            return self._login()
+        if caminho != self.server.caminho_posicoes:
+            return self._responder(404)
+        if self.server.token not in (self.headers.get("Authorization") or ""):
+            return self._responder(401, b'{"Message": "token invalido"}')
+        try:
+            req = json.loads(corpo)
+            placa = req["TrackedUnitIntegrationCode"]
+            ini, fim = _data_api(req["StartDatePosition"]), _data_api(req["EndDatePosition"])
+        except (KeyError, TypeError, ValueError):
+            return self._responder(400, b'{"Message": "corpo invalido"}')
+        if self.server.limitar_ao_agora:
+            fim = min(fim, datetime.now(timezone.utc))
+        if self.server.latencia:
+            time.sleep(self.server.latencia)
+        with self.server.lock:   # gerador guarda estado por placa
+            pagina = self.server.frota.pagina(placa, ini, fim, self.server.limite)
+        self.server.requisicoes += 1
+        self._responder(200, pagina)
+
+    def _login(self):
+        self.server.logins += 1
+        self._responder(200, json.dumps({"AccessToken": self.server.token, "ExpiresIn": 3600}).encode())
+
+
+class ApiLocal(ThreadingHTTPServer):
+    """Servidor HTTP da frota sintética. limitar_ao_agora=False serve qualquer janela pedida."""
+
+    daemon_threads = True
+
+    def __init__(self, frota, porta=0, limite=LIMITE_ITENS, latencia=0.0, limitar_ao_agora=True,
+                 caminho_login=CAMINHO_LOGIN, caminho_posicoes=CAMINHO_POSICOES):
+        super().__init__(("127.0.0.1", porta), _Handler)
+        self.frota, self.limite, self.latencia = frota, limite, latencia
+        self.limitar_ao_agora = limitar_ao_agora
+        self.caminho_login, self.caminho_posicoes = caminho_login, caminho_posicoes
+        self.token = secrets.token_hex(16)
+        self.lock = threading.Lock()
+        self.requisicoes = self.logins = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+def _servir(fila, veiculos, inicio, passo, semente, limite, latencia):
+    srv = ApiLocal(FrotaSintetica(veiculos, inicio, passo, semente), limite=limite, latencia=latencia,
+                   limitar_ao_agora=False)
+    fila.put(srv.url)
+    srv.serve_forever()
+
+
+def iniciar_processo(veiculos, inicio, passo=30, semente=1, limite=LIMITE_ITENS, latencia=0.0):
+    """
+    Sobe a API local em outro processo (fork: chame antes de abrir conexões ao banco).
+    Devolve (url, processo); encerre com processo.terminate().
+    """
+    ctx = multiprocessing.get_context("fork")
+    fila = ctx.Queue()
+    proc = ctx.Process(target=_servir, args=(fila, veiculos, inicio, passo, semente, limite, latencia),
+                       daemon=True)
+    proc.start()
+    return fila.get(timeout=30), proc
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("--veiculos", type=int, default=100)
+    ap.add_argument("--porta", type=int, default=8099)
+    ap.add_argument("--inicio", default="2025-01-01", help="primeira posição da frota (ISO 8601, UTC)")
+    ap.add_argument("--passo", type=int, default=30, help="segundos entre posições de uma placa")
+    ap.add_argument("--limite", type=int, default=LIMITE_ITENS, help="itens por resposta (soft cap)")
+    ap.add_argument("--latencia-ms", type=float, default=0.0, help="atraso artificial por requisição")
+    args = ap.parse_args()
+
+    frota = FrotaSintetica(args.veiculos, _data_api(args.inicio), args.passo)
+    srv = ApiLocal(frota, args.porta, args.limite, args.latencia_ms / 1000)
+    print(f"API_BASE_URL={srv.url}\nAUTH_LOGIN_PATH={CAMINHO_LOGIN}\nGET_LAST_POSITIONS_PATH={CAMINHO_POSICOES}")
+    print(f"placas {frota.placas[0]}..{frota.placas[-1]} a partir de {frota.inicio.isoformat()}")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"{srv.logins} logins, {srv.requisicoes} requisições de posições")
+
+
+if __name__ == "__main__":
+    main()
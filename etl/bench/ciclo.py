@@ -0,0 +1,155 @@
+"""
+Benchmark de ciclo do ETL: API local (bench.api_local) + banco, para frotas de 10 a 5000 placas.
+
+    cd etl && python -m bench.ciclo --frotas 10,100,1000,5000 --ciclos 10
+    cd etl && python -m bench.ciclo --frotas 100 --intervalo 43200 --saida base.json   # páginas cheias
+
+Cada ciclo avança o relógio da frota em --intervalo segundos e passa todas as placas pelo caminho
+do ETL, medindo cada etapa: api (etl.baixar_posicoes: HTTP + parsing da página, paginando pelo
+soft cap de 1000 itens), insert (etl.gravar_posicoes: COPY + dedup + cursor, commit) e detect
+(etl.detectar_posicoes: detector incremental + sessões + snapshot, commit). A janela de cada placa
+começa no último EventDate gravado, então o item repetido passa pelo dedup como na API real.
+Saída: linhas/s e p50/p99 do tempo de ciclo por etapa (ciclos de aquecimento fora da conta).
+
+Usa as variáveis DB_* do ETL: rode num Postgres/PostGIS local, não no de produção. As placas
+BENCH* são cadastradas inativas (o loop do ETL não as vê) e apagadas no início e no fim
+(--manter deixa os dados para inspeção). Placas são processadas em sequência, numa conexão.
+"""
+import argparse, json, logging, statistics, time
+from datetime import datetime, timedelta, timezone
+
+import etl
+from bench import api_local
+from bench.telemetria import FrotaSintetica
+
+INICIO = datetime(2025, 1, 1, tzinfo=timezone.utc)
+PREFIXO = "BENCH"
+ETAPAS = ("api", "insert", "detect")
+
+
+def limpar(conn, prefixo=PREFIXO):
+    padrao = prefixo + "%"
+    with conn.cursor() as cur:
+        for tabela in ("operacao.sessao_tanque", "operacao.detector_estado",
+                       "rastreio.ingestao_cursor", "rastreio.posicao_atual", "rastreio.posicao",
+                       "cadastro.veiculo"):
+            cur.execute(f"DELETE FROM {tabela} WHERE placa LIKE %s;", (padrao,))
+    conn.commit()
+    etl._DETECTORES.clear()
+
+
+def preparar(conn, placas, fim):
+    etl.garantir_particoes(INICIO.date() - timedelta(days=1), fim.date() + timedelta(days=1))
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO cadastro.veiculo (placa, descricao, ativo, instalado_em)
+            SELECT unnest(%s::text[]), 'benchmark', FALSE, %s
+            ON CONFLICT (placa) DO NOTHING;
+        """, (placas, INICIO))
+        etl.carregar_areas(cur)
+    conn.commit()
+
+
+def _percentis(tempos):
+    if len(tempos) < 2:
+        return tempos[0], tempos[0]
+    q = statistics.quantiles(tempos, n=100, method="inclusive")
+    return q[49], q[98]
+
+
+def medir_frota(conn, veiculos, args):
+    """
+    Roda os ciclos das primeiras 'veiculos' placas da frota servida pela API local.
+    Devolve {etapa: {"linhas", "segundos", "ciclos": [s, ...]}}.
+    """
+    placas = FrotaSintetica(veiculos, INICIO).placas
+    total_ciclos = args.aquecimento + args.ciclos
+    limpar(conn)
+    preparar(conn, placas, INICIO + timedelta(seconds=args.intervalo * total_ciclos))
+    marcas = {p: {"instalado_em": INICIO, "evento_api": None, "id_position": None, "ultima_data_evento": None}
+              for p in placas}
+    resultado = {e: {"linhas": 0, "segundos": 0.0, "ciclos": []} for e in ETAPAS + ("ciclo",)}
+    try:
+        with conn.cursor() as cur:
+            for c in range(total_ciclos):
+                agora = INICIO + timedelta(seconds=args.intervalo * (c + 1))
+                tempo, linhas = dict.fromkeys(ETAPAS, 0.0), dict.fromkeys(ETAPAS, 0)
+                t_ciclo = time.perf_counter()
+                for placa in placas:
+                    janela = etl.calcular_janela(placa, marcas[placa], agora)
+                    if not janela:
+                        continue
+                    t0 = time.perf_counter()
+                    candidatos = etl.baixar_posicoes(placa, janela)
+                    t1 = time.perf_counter()
+                    novas = etl.gravar_posicoes(conn, cur, placa, candidatos)
+                    t2 = time.perf_counter()
+                    if novas:
+                        etl.detectar_posicoes(conn, cur, placa, novas)
+                    t3 = time.perf_counter()
+                    if candidatos:
+                        marcas[placa]["evento_api"] = max(r.evento_api for r in candidatos)
+                    for etapa, dt, n in (("api", t1 - t0, len(candidatos)), ("insert", t2 - t1, len(candidatos)),
+                                         ("detect", t3 - t2, len(novas))):
+                        tempo[etapa] += dt
+                        linhas[etapa] += n
+                tempo["ciclo"], linhas["ciclo"] = time.perf_counter() - t_ciclo, linhas["api"]
+                if c < args.aquecimento:
+                    continue
+                for etapa, r in resultado.items():
+                    r["linhas"] += linhas[etapa]
+                    r["segundos"] += tempo[etapa]
+                    r["ciclos"].append(tempo[etapa])
+    finally:
+        if not args.manter:
+            limpar(conn)
+    return resultado
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("--frotas", default="10,100,1000", help="tamanhos de frota separados por vírgula (até 5000)")
+    ap.add_argument("--ciclos", type=int, default=10, help="ciclos medidos por frota")
+    ap.add_argument("--aquecimento", type=int, default=1, help="ciclos iniciais fora da conta")
+    ap.add_argument("--intervalo", type=int, default=600, help="segundos de telemetria nova por ciclo")
+    ap.add_argument("--passo", type=int, default=30, help="segundos entre posições de uma placa")
+    ap.add_argument("--latencia-ms", type=float, default=0.0, help="atraso artificial da API local")
+    ap.add_argument("--saida", help="grava os resultados em JSON (para comparar entre versões)")
+    ap.add_argument("--manter", action="store_true", help="não apaga as placas BENCH* no fim")
+    args = ap.parse_args()
+
+    logging.disable(logging.WARNING)
+    frotas = [int(v) for v in args.frotas.split(",")]
+    # uma API local para todas as frotas (as menores usam as primeiras placas), antes de abrir o banco
+    url, proc = api_local.iniciar_processo(max(frotas), INICIO, args.passo, latencia=args.latencia_ms / 1000)
+    etl.API_BASE_URL = url
+    etl.AUTH_LOGIN_PATH, etl.GET_LAST_POSITIONS_PATH = api_local.CAMINHO_LOGIN, api_local.CAMINHO_POSICOES
+    qlik_original, etl.QLIK_TABELAS = etl.QLIK_TABELAS, False   # sem pendências do Qlik para as placas BENCH*
+    conn = None
+    resultados = {}
+    try:
+        conn = etl.obter_conexao()
+        print(f"{args.ciclos} ciclos de {args.intervalo}s de telemetria (1 posição a cada {args.passo}s por placa)")
+        print(f"{'frota':>6} {'etapa':<7} {'linhas':>9} {'linhas/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+        for veiculos in frotas:
+            r = medir_frota(conn, veiculos, args)
+            resultados[veiculos] = {}
+            for etapa, m in r.items():
+                p50, p99 = _percentis(m["ciclos"])
+                resultados[veiculos][etapa] = {"linhas": m["linhas"], "linhas_s": m["linhas"] / max(m["segundos"], 1e-9),
+                                               "p50_s": p50, "p99_s": p99}
+                print(f"{veiculos:>6} {etapa:<7} {m['linhas']:>9} {resultados[veiculos][etapa]['linhas_s']:>10,.0f} "
+                      f"{p50 * 1e3:>10.1f} {p99 * 1e3:>10.1f}")
+    finally:
+        etl.QLIK_TABELAS = qlik_original
+        if conn is not None:
+            conn.close()
+        proc.terminate()
+
+    if args.saida:
+        with open(args.saida, "w") as f:
+            json.dump({"parametros": vars(args), "resultados": resultados}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
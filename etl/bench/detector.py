@@ -0,0 +1,89 @@
+"""
+Micro-benchmark do detector por tendência: laço ponto a ponto contra o lote vetorizado
+(NumPy), sobre um histórico sintético de uma placa (coleta, descarga, deslocamento, spikes).
+
+    cd etl && python -m bench.detector --dias 90 --repeticoes 3
+
+Não acessa banco: as sessões ficam só em memória no detector. Também confere que os dois
+caminhos terminam no mesmo estado.
+"""
+import argparse, json, logging, random, re, statistics, time
+from datetime import datetime, timedelta
+
+import etl
+
+PLACA = "BENCH0001"
+
+
+def historico_sintetico(n, seed=1):
+    rnd = random.Random(seed)
+    t, nv, lat, lon = datetime(2025, 1, 1), 40.0, -21.12, -56.46
+    modo, resta, linhas = "parado", 0, []
+    for i in range(n):
+        if resta <= 0:
+            modo = rnd.choice(["parado", "coleta", "descarga", "desloca", "parado"])
+            resta = rnd.randint(5, 80)
+        resta -= 1
+        t += timedelta(seconds=rnd.choice([5, 60, 600]) if rnd.random() < 0.1 else 30)
+        if modo == "coleta":
+            nv = min(99.0, nv + rnd.uniform(0, 1.5))
+        elif modo == "descarga":
+            nv = max(1.0, nv - rnd.uniform(0, 1.5))
+        elif modo == "desloca":
+            lat, lon = lat + rnd.uniform(-3e-3, 3e-3), lon + rnd.uniform(-3e-3, 3e-3)
+        nivel = nv + rnd.choice([-1, 1]) * rnd.uniform(10, 25) if rnd.random() < 0.03 else nv
+        linhas.append(etl.Posicao(
+            id_position=i + 1, placa=PLACA, data_evento=t,
+            nivel_tanque_percent=round(nivel, 2) if nivel > 0 else None,
+            latitude=lat, longitude=lon,
+            velocidade_kmh=rnd.uniform(20, 60) if modo == "desloca" else rnd.choice([0, 0, 5, 15]),
+        ))
+    return linhas
+
+
+def _estado(det):
+    txt = json.dumps(etl._estado_para_json({c: getattr(det, c) for c in det._CAMPOS_ESTADO}), sort_keys=True)
+    return txt, sorted(re.sub(r'"id": \d+', "", json.dumps(s, default=str, sort_keys=True))
+                       for s in det._alteradas.values())
+
+
+def medir(linhas, lote_minimo, repeticoes):
+    etl.DETECTOR_LOTE_VETORIZADO = lote_minimo
+    tempos = []
+    for _ in range(repeticoes):
+        det = etl.DetectorTendencia(PLACA)
+        t = time.perf_counter()
+        det.processar(None, linhas)
+        tempos.append(time.perf_counter() - t)
+    return statistics.median(tempos), _estado(det)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("--dias", type=int, default=90, help="dias de histórico (1 ponto a cada ~30 s)")
+    ap.add_argument("--repeticoes", type=int, default=3)
+    args = ap.parse_args()
+
+    logging.disable(logging.WARNING)
+    linhas = historico_sintetico(args.dias * 2880)
+    original = etl.DETECTOR_LOTE_VETORIZADO
+    try:
+        t_ponto, est_ponto = medir(linhas, 0, args.repeticoes)
+        modos = [("ponto", t_ponto)]
+        if etl.np is not None:
+            t_vet, est_vet = medir(linhas, 1, args.repeticoes)
+            modos.append(("numpy", t_vet))
+    finally:
+        etl.DETECTOR_LOTE_VETORIZADO = original
+
+    print(f"{len(linhas)} posições, {len(est_ponto[1])} sessões, mediana de {args.repeticoes} repetições")
+    for nome, t in modos:
+        print(f"{nome:<6} {t:8.3f} s  {len(linhas) / t / 1e3:8.1f} mil pontos/s")
+    if etl.np is None:
+        print("numpy não instalado: apenas o caminho ponto a ponto medido (pip install numpy)")
+    elif est_vet != est_ponto:
+        print("ATENÇÃO: estado final difere entre os caminhos")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Micro-benchmark do caminho JSON: stdlib contra orjson na decodificação da página do
+HistoryPosition, na serialização das colunas JSONB e na montagem do buffer do COPY.
+
+    cd etl && python -m bench.json_codec --itens 1000 --repeticoes 20
+    cd etl && python -m bench.json_codec --arquivo resposta_history_position.json
+
+--arquivo aceita uma resposta gravada da API (array JSON); sem ele, gera uma página
+sintética no formato da API. Não acessa banco nem rede.
+"""
+import argparse, json, random, statistics, time
+from datetime import datetime, timedelta
+
+import etl
+
+
+def pagina_sintetica(n, id_base=9_000_000_000_000):
+    t0 = datetime(2025, 1, 1)
+    nivel = 50.0
+    itens = []
+    for i in range(n):
+        nivel = min(100.0, max(1.0, nivel + random.uniform(-0.5, 0.5)))
+        itens.append({
+            "IdPosition": id_base + i, "IdEvent": 1,
+            "EventDate": (t0 + timedelta(seconds=30 * i)).isoformat() + "Z",
+            "UpdateDate": (t0 + timedelta(seconds=30 * i + 2)).isoformat() + "Z",
+            "Latitude": -21.12 + random.uniform(-1e-3, 1e-3), "Longitude": -56.46 + random.uniform(-1e-3, 1e-3),
+            "Ignition": True, "ValidGPS": True, "Speed": round(random.uniform(0, 80), 1),
+            "PercentageLevelTank": round(nivel, 2),
+            "ListTelemetry": {str(k): round(random.uniform(0, 500), 2) for k in range(300, 330)},
+            "ListInputSensor": {str(k): random.random() < 0.5 for k in range(1, 9)},
+            "ListOutputActuator": {str(k): False for k in range(1, 5)},
+        })
+    return json.dumps(itens).encode()
+
+
+def _decodificar(payload, pedaco=65536):
+    leitor = etl.LeitorPaginaPosicoes("BENCH0001")
+    linhas = []
+    for i in range(0, len(payload), pedaco):
+        linhas.extend(leitor.feed(payload[i:i + pedaco]))
+    linhas.extend(leitor.close())
+    return linhas
+
+
+def _cronometrar(fn, repeticoes):
+    tempos = []
+    for _ in range(repeticoes):
+        t = time.perf_counter()
+        fn()
+        tempos.append(time.perf_counter() - t)
+    return statistics.median(tempos)
+
+
+def medir_backend(backend, payload, repeticoes):
+    etl.JSON_BACKEND = backend
+    linhas = _decodificar(payload)
+    itens = json.loads(payload)
+    jsonb = [(it.get("ListInputSensor") or {}, it.get("ListOutputActuator") or {}, it.get("ListTelemetry") or {})
+             for it in itens]
+    return len(linhas), {
+        "decode_pagina": _cronometrar(lambda: _decodificar(payload), repeticoes),
+        "encode_jsonb": _cronometrar(lambda: [etl.json_dumps_bytes(o) for t in jsonb for o in t], repeticoes),
+        "buffer_copy": _cronometrar(lambda: etl._buffer_copy(linhas), repeticoes),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("--arquivo", help="resposta gravada do HistoryPosition (array JSON)")
+    ap.add_argument("--itens", type=int, default=etl.API_SOFT_CAP)
+    ap.add_argument("--repeticoes", type=int, default=20)
+    args = ap.parse_args()
+
+    if args.arquivo:
+        with open(args.arquivo, "rb") as f:
+            payload = f.read()
+    else:
+        payload = pagina_sintetica(args.itens)
+
+    backends = ["stdlib"] + (["orjson"] if etl.orjson is not None else [])
+    original = etl.JSON_BACKEND
+    try:
+        resultados = {b: medir_backend(b, payload, args.repeticoes) for b in backends}
+    finally:
+        etl.JSON_BACKEND = original
+
+    print(f"payload: {len(payload) / 1024:.0f} KiB, mediana de {args.repeticoes} repetições (ms)")
+    print(f"{'backend':<8} {'itens':>6} {'decode_pagina':>14} {'encode_jsonb':>13} {'buffer_copy':>12}")
+    for b, (n, r) in resultados.items():
+        print(f"{b:<8} {n:>6} {r['decode_pagina'] * 1e3:>14.2f} {r['encode_jsonb'] * 1e3:>13.2f} "
+              f"{r['buffer_copy'] * 1e3:>12.2f}")
+    if etl.orjson is None:
+        print("orjson não instalado: apenas stdlib medido (pip install orjson)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark da carga em rastreio.posicao: caminho antigo (SELECT de IDs existentes +
+execute_values) contra o COPY para staging + INSERT ... SELECT de etl.inserir_posicoes.
+
+    cd etl && python -m bench.loader --linhas 50000 --repeticoes 3
+
+Usa as variáveis DB_* do ETL. Tudo roda dentro de transações desfeitas com ROLLBACK,
+então o banco não fica com as linhas sintéticas (só com as partições mensais do período).
+"""
+import argparse, random, time
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+import etl
+
+PLACA_BENCH = "BENCH0001"
+
+
+def gerar_linhas(n, placa=PLACA_BENCH, id_base=9_000_000_000_000):
+    t0 = datetime(2025, 1, 1)
+    nivel = 50.0
+    linhas = []
+    for i in range(n):
+        nivel = min(100.0, max(1.0, nivel + random.uniform(-0.5, 0.5)))
+        item = {
+            "IdPosition": id_base + i, "EventDate": (t0 + timedelta(seconds=30 * i)).isoformat() + "Z",
+            "Latitude": -21.12 + random.uniform(-1e-3, 1e-3), "Longitude": -56.46 + random.uniform(-1e-3, 1e-3),
+            "Ignition": True, "ValidGPS": True, "SpeedKmh": 0.0, "PercentageLevelTank": round(nivel, 2),
+            "ListTelemetry": {"304": round(nivel, 2)}, "ListInputSensor": {"1": True, "2": False},
+            "ListOutputActuator": {"1": False},
+        }
+        linhas.append(etl.Posicao(
+            id_position=item["IdPosition"], placa=placa, id_event=1,
+            ignicao=True, valid_gps=True,
+            data_evento=t0 + timedelta(seconds=30 * i), data_atualizacao=None,
+            latitude=item["Latitude"], longitude=item["Longitude"], velocidade_kmh=0.0,
+            inputs=etl.json_dumps_bytes(item["ListInputSensor"]),
+            outputs=etl.json_dumps_bytes(item["ListOutputActuator"]),
+            telemetria=etl.json_dumps_bytes(item["ListTelemetry"]), nivel_tanque_percent=item["PercentageLevelTank"],
+            raw=etl.json_dumps_bytes(item),
+        ))
+    return linhas
+
+
+def caminho_antigo(cur, linhas):
+    """Reprodução do fluxo anterior: pré-filtro de IDs existentes + execute_values."""
+    ids = [l.id_position for l in linhas]
+    existentes = set()
+    for i in range(0, len(ids), 10000):
+        cur.execute("SELECT id_position FROM rastreio.posicao WHERE id_position = ANY(%s);", (ids[i:i + 10000],))
+        existentes.update(r[0] for r in cur.fetchall())
+    novas = [l for l in linhas if l.id_position not in existentes]
+    cols = etl.POSICAO_COLS
+    tpl = f'({",".join(["%s"] * len(cols))})'
+    sql = f"INSERT INTO rastreio.posicao ({','.join(cols)}) VALUES %s ON CONFLICT (id_position, data_evento) DO NOTHING;"
+    # o fluxo antigo mandava JSON como str (bytes iriam como bytea)
+    valores = [tuple(v.decode() if isinstance(v := getattr(l, c), bytes) else v for c in cols) for l in novas]
+    execute_values(cur, sql, valores, template=tpl, page_size=10000)
+    return len(novas)
+
+
+def caminho_copy(cur, linhas):
+    return len(etl.inserir_posicoes(cur, linhas))
+
+
+def medir(conn, fn, linhas):
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO cadastro.veiculo (placa, descricao, ativo) VALUES (%s, 'benchmark', FALSE) "
+            "ON CONFLICT (placa) DO NOTHING;", (PLACA_BENCH,))
+        t = time.perf_counter()
+        n = fn(cur, linhas)
+        dt = time.perf_counter() - t
+    conn.rollback()
+    return n, dt
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("--linhas", type=int, default=50000)
+    ap.add_argument("--repeticoes", type=int, default=3)
+    args = ap.parse_args()
+
+    linhas = gerar_linhas(args.linhas)
+    # fora da transação medida (mesma margem de inserir_posicoes): o DDL não entra no tempo
+    um_dia = timedelta(days=1)
+    etl.garantir_particoes(linhas[0].data_evento.date() - um_dia, linhas[-1].data_evento.date() + um_dia)
+    conn = etl.obter_conexao()
+    try:
+        for nome, fn in (("execute_values", caminho_antigo), ("copy", caminho_copy)):
+            tempos = []
+            for _ in range(args.repeticoes):
+                n, dt = medir(conn, fn, linhas)
+                tempos.append(dt)
+            melhor = min(tempos)
+            print(f"{nome:>15}: {n} linhas em {melhor:.3f}s -> {n / melhor:,.0f} linhas/s (melhor de {args.repeticoes})")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
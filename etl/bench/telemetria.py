@@ -0,0 +1,133 @@
+"""
+Gerador de telemetria sintética no formato do HistoryPosition, para a API local (bench.api_local)
+e o benchmark de ciclo (bench.ciclo).
+
+Cada placa tem uma posição a cada `passo` segundos a partir de `inicio`, em segmentos de
+SEGMENTO posições com um modo cada (parado, coleta, descarga, deslocamento, sem sinal):
+nível do tanque sobe/desce com ruído, velocidade e GPS acompanham o modo, ~3% dos níveis
+são spikes e ~1% dos pontos vêm sem GPS válido. O conteúdo é determinístico por (placa,
+índice): qualquer janela pedida, em qualquer ordem, devolve sempre os mesmos itens, então
+paginação e dedup se comportam como na API real.
+
+    from bench.telemetria import FrotaSintetica
+    frota = FrotaSintetica(100, datetime(2025, 1, 1, tzinfo=timezone.utc))
+    corpo = frota.pagina("BENCH00001", ini, fim, limite=1000)   # bytes do array JSON
+"""
+import random, zlib
+from datetime import timedelta, timezone
+from math import ceil, cos, floor, pi, sin
+
+SEGMENTO = 40   # posições por modo (20 min a 30 s)
+MODOS = ("parado", "coleta", "parado", "desloca", "descarga", "desloca", "parado", "sem_sinal")
+ID_BASE = 9_000_000_000_000
+IDS_POR_PLACA = 100_000_000
+_TELEMETRIA_EXTRA = tuple(str(c) for c in range(310, 326))
+_ENTRADAS = tuple(str(c) for c in range(1, 9))
+_SAIDAS_JSON = "{" + ", ".join(f'"{c}": false' for c in range(1, 5)) + "}"
+
+
+class VeiculoSintetico:
+    """Telemetria de uma placa. Guarda só o estado (nível, lat, lon) no início de cada segmento."""
+
+    def __init__(self, placa, indice, inicio, passo=30, semente=1):
+        self.placa, self.indice, self.inicio, self.passo = placa, indice, inicio, passo
+        self.semente = zlib.crc32(placa.encode()) ^ semente
+        rnd = random.Random(self.semente)
+        self._inicios = [(rnd.uniform(20, 60), -21.12 + rnd.uniform(-0.2, 0.2), -56.46 + rnd.uniform(-0.2, 0.2))]
+        self._cache = (None, None)   # (segmento, pontos) do último segmento gerado
+
+    def _gerar(self, s):
+        """Pontos (EventDate, item) do segmento s (None = sem sinal) e o estado no fim dele."""
+        nivel, lat, lon = self._inicios[s]
+        rnd = random.Random(self.semente * 1_000_003 + s)
+        modo = rnd.choice(MODOS)
+        taxa, rumo = rnd.uniform(0.3, 1.5), rnd.uniform(0, 2 * pi)
+        itens = []
+        for j in range(SEGMENTO):
+            k = s * SEGMENTO + j
+            if modo == "coleta":
+                nivel = min(99.0, nivel + taxa * rnd.uniform(0.5, 1.5))
+            elif modo == "descarga":
+                nivel = max(1.0, nivel - taxa * rnd.uniform(0.5, 1.5))
+            elif modo == "desloca":
+                passo_graus = rnd.uniform(1e-3, 5e-3)
+                lat, lon = lat + passo_graus * cos(rumo), lon + passo_graus * sin(rumo)
+                rumo += rnd.uniform(-0.3, 0.3)
+            if modo == "sem_sinal":
+                itens.append(None)
+                continue
+            lido = nivel + rnd.choice((-1, 1)) * rnd.uniform(10, 25) if rnd.random() < 0.03 else nivel
+            lido = round(min(100.0, max(0.0, lido + rnd.uniform(-0.2, 0.2))), 2)
+            gps_ok = rnd.random() >= 0.01
+            vel = round(rnd.uniform(20, 70), 1) if modo == "desloca" else rnd.choice((0.0, 0.0, 0.0, 5.0, 15.0))
+            t = self.inicio + timedelta(seconds=k * self.passo, milliseconds=rnd.randint(0, 999))
+            itens.append((t, self._item(k, t, rnd, lido, lat, lon, vel, gps_ok, ignicao=modo != "parado")))
+        return itens, (nivel, lat, lon)
+
+    def _item(self, k, t, rnd, nivel, lat, lon, vel, gps_ok, ignicao):
+        """Item já serializado (bytes): a API local só concatena a página, sem json.dumps por item."""
+        aleatorio = rnd.random
+        evento = t.strftime("%Y-%m-%dT%H:%M:%S.") + f"{t.microsecond // 1000:03d}Z"
+        t_upd = t + timedelta(seconds=2)
+        upd = t_upd.strftime("%Y-%m-%dT%H:%M:%S.") + f"{t_upd.microsecond // 1000:03d}Z"
+        extra = ", ".join(f'"{c}": {500 * aleatorio():.2f}' for c in _TELEMETRIA_EXTRA)
+        entradas = ", ".join(f'"{c}": {"true" if aleatorio() < 0.5 else "false"}' for c in _ENTRADAS)
+        return (
+            f'{{"IdPosition": {ID_BASE + self.indice * IDS_POR_PLACA + k}, "IdEvent": 1, '
+            f'"EventDate": "{evento}", "UpdateDate": "{upd}", '
+            f'"Latitude": {round(lat, 6) if gps_ok else 0.0}, "Longitude": {round(lon, 6) if gps_ok else 0.0}, '
+            f'"Ignition": {"true" if ignicao else "false"}, "ValidGPS": {"true" if gps_ok else "false"}, '
+            f'"SpeedKmh": {vel}, "PercentageLevelTank": {nivel}, '
+            f'"ListTelemetry": {{"304": {nivel}, "305": {11.5 + 3 * aleatorio():.2f}, '
+            f'"306": {60 + 35 * aleatorio():.1f}, {extra}}}, '
+            f'"ListInputSensor": {{{entradas}}}, "ListOutputActuator": {_SAIDAS_JSON}}}'
+        ).encode()
+
+    def _segmento(self, s):
+        if self._cache[0] != s:
+            while len(self._inicios) <= s:   # estado inicial dos segmentos anteriores ainda não vistos
+                self._inicios.append(self._gerar(len(self._inicios) - 1)[1])
+            itens, fim = self._gerar(s)
+            if len(self._inicios) == s + 1:  # leitura em ordem: cada segmento é gerado uma vez só
+                self._inicios.append(fim)
+            self._cache = (s, itens)
+        return self._cache[1]
+
+    def itens(self, ini, fim, limite=None) -> list:
+        """Itens (JSON em bytes) com ini <= EventDate <= fim (datetimes aware), em ordem, no máximo 'limite'."""
+        k = max(0, ceil((ini - self.inicio).total_seconds() / self.passo) - 1)
+        k_fim = floor((fim - self.inicio).total_seconds() / self.passo)
+        out = []
+        while k <= k_fim and (limite is None or len(out) < limite):
+            s, j = divmod(k, SEGMENTO)
+            ponto = self._segmento(s)[j]
+            k += 1
+            if ponto is not None and ini <= ponto[0] <= fim:
+                out.append(ponto[1])
+        return out
+
+
+class FrotaSintetica:
+    """N placas (prefixo + índice com 5 dígitos), criadas sob demanda."""
+
+    def __init__(self, veiculos, inicio, passo=30, semente=1, prefixo="BENCH"):
+        self.inicio = inicio if inicio.tzinfo else inicio.replace(tzinfo=timezone.utc)
+        self.passo, self.semente = passo, semente
+        self.placas = [f"{prefixo}{i:05d}" for i in range(1, veiculos + 1)]
+        self._indice = {p: i for i, p in enumerate(self.placas, 1)}
+        self._veiculos = {}
+
+    def veiculo(self, placa):
+        v = self._veiculos.get(placa)
+        if v is None and placa in self._indice:
+            v = self._veiculos[placa] = VeiculoSintetico(placa, self._indice[placa], self.inicio,
+                                                         self.passo, self.semente)
+        return v
+
+    def itens(self, placa, ini, fim, limite=None) -> list:
+        v = self.veiculo(placa)
+        return v.itens(ini, fim, limite) if v is not None else []
+
+    def pagina(self, placa, ini, fim, limite=None) -> bytes:
+        """Corpo da resposta do HistoryPosition (array JSON); placa desconhecida -> []."""
+        return b"[" + b",".join(self.itens(placa, ini, fim, limite)) + b"]"
@@ -1,15 +1,44 @@
-import os, time, json, logging, requests, unicodedata
+import os, io, re, sys, time, json, codecs, argparse, logging, random, requests, unicodedata, threading, queue, asyncio
+import select, signal, cProfile, pstats, tracemalloc
+import mmap, pickle, struct, zlib
 from urllib.parse import urlencode
-from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
+from datetime import date, datetime, timezone, timedelta
 from decimal import Decimal, InvalidOperation
 from collections import deque
+from dataclasses import dataclass, fields
 from json.decoder import JSONDecodeError
 from zoneinfo import ZoneInfo
-from math import radians, sin, cos, atan2, sqrt
+from math import radians, sin, cos, atan2, sqrt, floor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import psycopg2
 from psycopg2.extras import execute_values
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
+try:  # opcional: só necessário com ETL_ENGINE=async
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:  # opcional: JSON mais rápido; sem ele cai no json da stdlib
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # opcional: frente vetorizada do detector; sem ele, laço ponto a ponto
+    import numpy as np
+except ImportError:
+    np = None
+
+try:  # opcional: só necessário com o arquivo frio (ARQUIVO_IDADE_DIAS / etl.py arquivar)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 # ====================== bootstrap ======================
 load_dotenv()
 
@@ -36,6 +65,7 @@ DB_USER = os.getenv("DB_USER", "eslog")
 DB_PASS = os.getenv("DB_PASS", "eslog123")
 DB_SSLMODE = os.getenv("DB_SSLMODE", "require")
 DB_CHANNEL_BINDING = os.getenv("DB_channel_binding", "require")
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))   # segundos; banco lento/fora do ar não trava o ciclo
 #DATABASE_URL = os.getenv("DATABASE_URL")
 
 
@@ -44,6 +74,49 @@ FREQUENCIA = int(os.getenv("FREQUENCIA_SEGUNDOS", "10"))
 DEBUG_HTTP = os.getenv("DEBUG_HTTP", "0") == "1"
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
+# -------- Paralelismo da ingestão --------
+ETL_WORKERS = max(1, int(os.getenv("ETL_WORKERS", "1")))          # 1 = sequencial (comportamento original)
+API_RATE_LIMIT_RPS = float(os.getenv("API_RATE_LIMIT_RPS", "0"))  # 0 = sem limite global
+API_RATE_LIMIT_BURST = max(1, int(os.getenv("API_RATE_LIMIT_BURST", "1")))
+PIPELINE_BAIXAR_WORKERS = max(1, int(os.getenv("PIPELINE_BAIXAR_WORKERS", "8")))      # (ETL_ENGINE=pipeline) downloads + parsing
+PIPELINE_GRAVAR_WORKERS = max(1, int(os.getenv("PIPELINE_GRAVAR_WORKERS", "2")))      # conexões de insert
+PIPELINE_DETECTAR_WORKERS = max(1, int(os.getenv("PIPELINE_DETECTAR_WORKERS", "2")))  # conexões de detecção
+PIPELINE_FILA_MAX = max(1, int(os.getenv("PIPELINE_FILA_MAX", "16")))                 # lotes por fila de worker
+
+# -------- Backfill (janelas longas: placa nova ou que ficou offline) --------
+BACKFILL_LIMIAR_HORAS = float(os.getenv("BACKFILL_LIMIAR_HORAS", "24"))   # janela maior -> fatias paralelas (0 = nunca)
+BACKFILL_FATIA_HORAS = float(os.getenv("BACKFILL_FATIA_HORAS", "6"))      # tamanho inicial de cada fatia
+BACKFILL_CONCORRENCIA = max(1, int(os.getenv("BACKFILL_CONCORRENCIA", "4")))  # requisições simultâneas por placa
+ETL_LOTE_POSICOES = max(1, int(os.getenv("ETL_LOTE_POSICOES", "10000")))  # posições por commit (e cursor) ao paginar
+
+# -------- Cliente HTTP da API --------
+API_POOL_MAXSIZE = int(os.getenv("API_POOL_MAXSIZE", str(max(4, max(ETL_WORKERS, PIPELINE_BAIXAR_WORKERS) * BACKFILL_CONCORRENCIA))))
+API_TOKEN_TTL_SEC = int(os.getenv("API_TOKEN_TTL_SEC", "3600"))   # usado se o login não informar ExpiresIn
+API_MAX_TENTATIVAS = int(os.getenv("API_MAX_TENTATIVAS", "3"))
+API_BACKOFF_BASE_SEC = float(os.getenv("API_BACKOFF_BASE_SEC", "1"))
+API_BACKOFF_MAX_SEC = float(os.getenv("API_BACKOFF_MAX_SEC", "60"))
+
+# -------- Motor de execução --------
+ETL_ENGINE = (os.getenv("ETL_ENGINE") or "sync").lower()   # sync | async | pipeline
+ASYNC_API_CONCORRENCIA = int(os.getenv("ASYNC_API_CONCORRENCIA", "32"))  # requisições simultâneas à API
+ASYNC_DB_WRITERS = int(os.getenv("ASYNC_DB_WRITERS", "4"))              # conexões/threads de gravação
+ASYNC_FILA_MAX = int(os.getenv("ASYNC_FILA_MAX", "64"))                 # placas já baixadas aguardando gravação
+
+# -------- Spool local (banco fora do ar) --------
+SPOOL_DIR = os.getenv("SPOOL_DIR", "")                            # vazio = sem spool (lote sem banco se perde)
+SPOOL_SEGMENTO_MB = int(os.getenv("SPOOL_SEGMENTO_MB", "64"))     # tamanho de cada arquivo (unidade do replay)
+SPOOL_MAX_MB = int(os.getenv("SPOOL_MAX_MB", "2048"))             # cheio: para de gravar (a API é consultada de novo)
+
+# -------- Partições de rastreio.posicao --------
+POSICAO_PARTICOES_FUTURAS = int(os.getenv("POSICAO_PARTICOES_FUTURAS", "3"))   # meses criados à frente
+POSICAO_RETENCAO_MESES = int(os.getenv("POSICAO_RETENCAO_MESES", "0"))         # 0 = mantém tudo
+POSICAO_RETENCAO_MODO = (os.getenv("POSICAO_RETENCAO_MODO") or "detach").lower()  # detach | drop
+
+# -------- Arquivo frio de rastreio.posicao (Parquet) --------
+ARQUIVO_DIR = os.getenv("ARQUIVO_DIR", "/data/arquivo")
+ARQUIVO_IDADE_DIAS = int(os.getenv("ARQUIVO_IDADE_DIAS", "0"))            # 0 = não arquiva no loop
+ARQUIVO_TEMPO_MAX_SEC = float(os.getenv("ARQUIVO_TEMPO_MAX_SEC", "60"))   # fatia por ciclo do ETL
+
 LOCAL_TZ_NAME = os.getenv("TZ", "America/Campo_Grande")
 LOCAL_TZ = ZoneInfo(LOCAL_TZ_NAME)
 
@@ -61,6 +134,10 @@ MAX_INV_PCT = Decimal(os.getenv("MAX_INV_PCT", "5"))
 MIN_SESSION_DURATION_SEC = int(os.getenv("MIN_SESSION_DURATION_SEC", "60"))
 MIN_SESSION_DELTA_PP = Decimal(os.getenv("MIN_SESSION_DELTA_PP", "5"))
 GAP_MIN = int(os.getenv("GAP_MIN", "60"))
+MAX_STALE_TIME_MIN = int(os.getenv("MAX_STALE_TIME_MIN", "20"))
+MAX_SESSION_DURATION_MIN = int(os.getenv("MAX_SESSION_DURATION_MIN", "90"))
+# a partir de quantos pontos por lote o detector usa o caminho NumPy (0 = sempre ponto a ponto)
+DETECTOR_LOTE_VETORIZADO = int(os.getenv("DETECTOR_LOTE_VETORIZADO", "64"))
 
 # ---- Modo "slow trend" (config) ----
 SLOW_WIN_SEC = int(os.getenv("SLOW_TREND_WINDOW_SEC","600"))
@@ -76,10 +153,38 @@ MIN_DWELL_NEW_LEVEL_SEC = int(os.getenv("MIN_DWELL_NEW_LEVEL_SEC","120"))
 # ---- Geofence / Parada para retomar ----
 EXIT_RADIUS_M = int(os.getenv("EXIT_RADIUS_M", "250"))
 RESUME_STOP_DWELL_SEC = int(os.getenv("RESUME_STOP_DWELL_SEC", "0"))
+# ---- Áreas de descarte (índice em memória) ----
+AREAS_GRADE_GRAUS = float(os.getenv("AREAS_GRADE_GRAUS", "0.01"))   # lado da célula da grade (~1,1 km)
+
+# -------- Tabelas do Qlik (05_qlik.sql) --------
+QLIK_TABELAS = os.getenv("QLIK_TABELAS", "1") == "1"   # atualiza operacao.qlik_* no fim de cada ciclo
+
+# -------- Log de eventos de sessão (07_sessao_evento.sql) --------
+SESSAO_EVENTOS_RETENCAO_DIAS = int(os.getenv("SESSAO_EVENTOS_RETENCAO_DIAS", "30"))   # 0 = mantém tudo
+
+# -------- Métricas / trace do ciclo --------
+METRICAS_PORTA = int(os.getenv("METRICAS_PORTA", "0"))              # 0 = sem endpoint /metrics
+METRICAS_POR_PLACA = os.getenv("METRICAS_POR_PLACA", "1") == "1"    # histograma por placa+etapa (1 série por placa)
+METRICAS_TRACE = os.getenv("METRICAS_TRACE", "")                    # arquivo JSON Lines: 1 linha por ciclo
+
+# -------- Perfil sob demanda (cProfile / amostragem / tracemalloc) --------
+PERFIL_CICLOS = int(os.getenv("PERFIL_CICLOS", "0"))             # perfila os N primeiros ciclos; SIGUSR2 arma mais N
+PERFIL_MODO = (os.getenv("PERFIL_MODO") or "cprofile").lower()   # cprofile | amostragem
+PERFIL_PLACAS = {p.strip() for p in os.getenv("PERFIL_PLACAS", "").split(",") if p.strip()}   # vazio = ciclo inteiro
+PERFIL_MEMORIA = os.getenv("PERFIL_MEMORIA", "0") == "1"         # snapshot do tracemalloc por ciclo perfilado
+PERFIL_AMOSTRA_MS = float(os.getenv("PERFIL_AMOSTRA_MS", "5"))   # intervalo do modo amostragem
+PERFIL_TOP = int(os.getenv("PERFIL_TOP", "15"))                  # linhas do resumo no log
+PERFIL_DIR = os.getenv("PERFIL_DIR", "/data/perfil")
+
+# -------- Serialização JSON --------
+JSON_BACKEND = (os.getenv("JSON_BACKEND") or "auto").lower()   # auto | orjson | stdlib
+if JSON_BACKEND == "auto" or (JSON_BACKEND == "orjson" and orjson is None):
+    JSON_BACKEND = "orjson" if orjson is not None else "stdlib"
 
 # ====================== Logs ======================
 logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s [%(levelname)s] %(message)s")
 logging.Formatter.converter = lambda *args: datetime.now(LOCAL_TZ).timetuple()
+_LOG_DETECTOR = logging.getLogger("etl.detector")   # regras de sessão + detector (silenciável à parte)
 logging.info(
     f"Detector de Tendência (v2) INICIADO com cfg: "
     f"window_pts={TREND_WINDOW_POINTS}, start_pp={TREND_START_THRESHOLD_PP}, "
@@ -93,6 +198,379 @@ logging.info(
     f"stopped={TOUCH_ONLY_WHEN_STOPPED}(≤{SPEED_STOP_MAX_KMH}km/h)"
 )
 
+# ====================== Métricas e trace ======================
+# Instrumentação do ciclo em memória: histogramas por etapa (e por placa), contadores de páginas,
+# posições, retries, logins e sessões. METRICAS_PORTA expõe tudo em /metrics (formato texto do
+# Prometheus); METRICAS_TRACE grava, ao fim de cada ciclo, um JSON com o detalhe por placa.
+_BUCKETS_SEG = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_METRICAS_DEF = {   # nome -> (tipo, ajuda)
+    "etl_etapa_segundos": ("histogram", "Duracao por etapa: api (uma pagina), insert e detect (uma placa), "
+                                        "fechar_stagnadas, qlik e arquivo (fim do ciclo)"),
+    "etl_placa_etapa_segundos": ("histogram", "Duracao das etapas api/insert/detect por placa"),
+    "etl_ciclo_segundos": ("histogram", "Duracao do ciclo completo"),
+    "etl_ciclo_atraso_segundos": ("gauge", "Duracao do ultimo ciclo menos FREQUENCIA_SEGUNDOS (> 0: estourou)"),
+    "etl_ciclo_posicoes_por_segundo": ("gauge", "Posicoes recebidas da API por segundo no ultimo ciclo"),
+    "etl_ciclo_fim_timestamp_segundos": ("gauge", "Fim do ultimo ciclo (epoch)"),
+    "etl_ciclos_total": ("counter", "Ciclos concluidos"),
+    "etl_api_paginas_total": ("counter", "Paginas do HistoryPosition recebidas"),
+    "etl_api_retentativas_total": ("counter", "Requisicoes a API repetidas apos erro"),
+    "etl_api_logins_total": ("counter", "Logins na API (primeiro, expiracao e relogin por 401/403)"),
+    "etl_posicoes_recebidas_total": ("counter", "Posicoes recebidas da API, antes do dedup"),
+    "etl_posicoes_inseridas_total": ("counter", "Posicoes novas gravadas em rastreio.posicao"),
+    "etl_sessoes_total": ("counter", "Sessoes por evento (aberta, finalizada, cancelada, fechada_gap) e tipo"),
+    "etl_spool_posicoes_total": ("counter", "Posicoes gravadas no spool local (banco fora do ar) e reaplicadas no banco"),
+    "etl_pipeline_bloqueio_segundos_total": ("counter", "ETL_ENGINE=pipeline: tempo esperando vaga na fila do estagio "
+                                                        "(fila cheia = estagio atrasado)"),
+}
+
+def _rotulos_prom(rotulos) -> str:
+    if not rotulos: return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in rotulos) + "}"
+
+class Metricas:
+    """Registro thread-safe (workers, writers do async) de contadores, medidores e histogramas."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._valores = {}   # (nome, rótulos) -> valor (counter/gauge)
+        self._hist = {}      # (nome, rótulos) -> [contagem por bucket..., soma, total]
+        self._ciclos = 0
+        self._base_recebidas = 0
+        self._trace = None   # ciclo corrente (só com METRICAS_TRACE)
+
+    def _observar(self, nome, rotulos, segundos):
+        h = self._hist.get((nome, rotulos))
+        if h is None:
+            h = self._hist[(nome, rotulos)] = [0] * (len(_BUCKETS_SEG) + 2)
+        for i, limite in enumerate(_BUCKETS_SEG):
+            if segundos <= limite:
+                h[i] += 1
+                break
+        h[-2] += segundos
+        h[-1] += 1
+
+    def contar(self, nome, valor=1, placa=None, **rotulos):
+        with self._lock:
+            k = (nome, tuple(sorted(rotulos.items())))
+            self._valores[k] = self._valores.get(k, 0) + valor
+            if self._trace is not None:
+                chave = "_".join([nome[4:].removesuffix("_total"), *map(str, rotulos.values())])
+                self._trace["contadores"][chave] = self._trace["contadores"].get(chave, 0) + valor
+                if placa:
+                    p = self._trace["placas"].setdefault(placa, {})
+                    p[chave] = p.get(chave, 0) + valor
+
+    def medir(self, nome, valor, **rotulos):
+        with self._lock:
+            self._valores[(nome, tuple(sorted(rotulos.items())))] = valor
+
+    def etapa(self, etapa, segundos, placa=None):
+        with self._lock:
+            self._observar("etl_etapa_segundos", (("etapa", etapa),), segundos)
+            if placa and METRICAS_POR_PLACA:
+                self._observar("etl_placa_etapa_segundos", (("etapa", etapa), ("placa", placa)), segundos)
+            if self._trace is not None:
+                et = self._trace["etapas"]
+                et[etapa] = et.get(etapa, 0.0) + segundos
+                if placa:
+                    p = self._trace["placas"].setdefault(placa, {})
+                    p[etapa] = p.get(etapa, 0.0) + segundos
+
+    @property
+    def ciclo(self):
+        return self._ciclos
+
+    def _valor(self, nome, **rotulos):
+        return self._valores.get((nome, tuple(sorted(rotulos.items()))), 0)
+
+    def iniciar_ciclo(self):
+        with self._lock:
+            self._ciclos += 1
+            self._base_recebidas = self._valor("etl_posicoes_recebidas_total")
+            self._trace = {"ciclo": self._ciclos, "inicio": datetime.now(timezone.utc).isoformat(),
+                           "etapas": {}, "contadores": {}, "placas": {}} if METRICAS_TRACE else None
+
+    def encerrar_ciclo(self, duracao):
+        with self._lock:
+            recebidas = self._valor("etl_posicoes_recebidas_total") - self._base_recebidas
+            self._observar("etl_ciclo_segundos", (), duracao)
+            self._valores[("etl_ciclo_atraso_segundos", ())] = duracao - FREQUENCIA
+            self._valores[("etl_ciclo_posicoes_por_segundo", ())] = recebidas / max(duracao, 1e-9)
+            self._valores[("etl_ciclo_fim_timestamp_segundos", ())] = time.time()
+            self._valores[("etl_ciclos_total", ())] = self._ciclos
+            trace, self._trace = self._trace, None
+        if trace is not None:
+            trace.update(duracao_s=round(duracao, 6), atraso_s=round(duracao - FREQUENCIA, 6),
+                         posicoes_por_s=round(recebidas / max(duracao, 1e-9), 1))
+            for d in (trace["etapas"], *trace["placas"].values()):
+                d.update((k, round(v, 6)) for k, v in d.items() if isinstance(v, float))
+            try:
+                with open(METRICAS_TRACE, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(trace, ensure_ascii=False, separators=(",", ":")) + "\n")
+            except OSError as e:
+                logging.error(f"Falha ao gravar trace do ciclo em {METRICAS_TRACE}: {e}")
+
+    def exposicao(self) -> str:
+        """Tudo no formato texto do Prometheus (version=0.0.4)."""
+        with self._lock:
+            valores, hist = dict(self._valores), {k: list(v) for k, v in self._hist.items()}
+        linhas = []
+        for nome, (tipo, ajuda) in _METRICAS_DEF.items():
+            linhas += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} {tipo}"]
+            if tipo == "histogram":
+                for (n, rotulos), h in sorted(hist.items()):
+                    if n != nome: continue
+                    acumulado = 0
+                    for limite, c in zip((*_BUCKETS_SEG, "+Inf"), h[:-2] + [0]):
+                        acumulado += c
+                        linhas.append(f"{nome}_bucket{_rotulos_prom((*rotulos, ('le', limite)))} "
+                                      f"{h[-1] if limite == '+Inf' else acumulado}")
+                    linhas.append(f"{nome}_sum{_rotulos_prom(rotulos)} {h[-2]}")
+                    linhas.append(f"{nome}_count{_rotulos_prom(rotulos)} {h[-1]}")
+            else:
+                linhas += [f"{nome}{_rotulos_prom(rotulos)} {v}"
+                           for (n, rotulos), v in sorted(valores.items()) if n == nome]
+        return "\n".join(linhas) + "\n"
+
+METRICAS = Metricas()
+
+@contextmanager
+def cronometrar(etapa, placa=None):
+    """Mede o bloco como uma etapa do ciclo (também quando ele levanta exceção)."""
+    perfil = PERFIL.atual
+    marca = perfil.entrar(placa) if perfil is not None and placa else None
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICAS.etapa(etapa, time.perf_counter() - t, placa)
+        if marca is not None:
+            perfil.sair(marca)
+
+@contextmanager
+def ciclo_medido():
+    inicio = time.monotonic()
+    METRICAS.iniciar_ciclo()
+    PERFIL.iniciar_ciclo(METRICAS.ciclo)
+    try:
+        yield
+    finally:
+        METRICAS.encerrar_ciclo(time.monotonic() - inicio)
+        PERFIL.encerrar_ciclo()   # fora da duração medida: gravar o perfil não conta como ciclo lento
+
+class _HandlerMetricas(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        corpo = METRICAS.exposicao().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+def iniciar_servidor_metricas(porta=None):
+    """Sobe /metrics numa thread daemon (porta 0 ou ausente em METRICAS_PORTA = não sobe)."""
+    porta = METRICAS_PORTA if porta is None else porta
+    if not porta: return None
+    srv = ThreadingHTTPServer(("0.0.0.0", porta), _HandlerMetricas)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name="metricas", daemon=True).start()
+    logging.info(f"Métricas em http://0.0.0.0:{porta}/metrics")
+    return srv
+
+# ====================== Perfil sob demanda ======================
+# Desligado por padrão: sem ciclo armado, o custo é um teste de None por ciclo e por etapa medida.
+# PERFIL_CICLOS arma os N primeiros ciclos; `kill -USR2 <pid>` arma mais N (mín. 1) com o processo no ar.
+# Cada ciclo perfilado grava em PERFIL_DIR arquivos <AAAAMMDDTHHMMSSZ>-ciclo<n>.* e loga um top-N:
+#   cprofile   -> .pstats (python -m pstats / snakeviz). Sem PERFIL_PLACAS só vê a thread principal:
+#                 com ETL_WORKERS > 1 ou ETL_ENGINE=pipeline, use amostragem ou PERFIL_PLACAS.
+#   amostragem -> .folded (pilhas de todas as threads a cada PERFIL_AMOSTRA_MS, tempo de parede;
+#                 entrada do flamegraph.pl / speedscope). Custo fixo, independente do nº de chamadas.
+#   PERFIL_MEMORIA=1 -> .tracemalloc (tracemalloc.Snapshot.load): memória alocada no ciclo ainda viva no fim.
+# Com PERFIL_PLACAS só as etapas api/insert/detect dessas placas entram no perfil (.pstats por placa ou
+# pilhas com prefixo placa=...); no ETL_ENGINE=async inclui o que o event loop rodou durante a etapa.
+_PERFIL_MODOS = ("cprofile", "amostragem")
+
+class _Amostrador(threading.Thread):
+    """Amostra as pilhas das threads (todas, ou só as de placas perfiladas) a cada `intervalo` segundos."""
+
+    def __init__(self, intervalo, threads=None):
+        super().__init__(name="perfil-amostrador", daemon=True)
+        self.intervalo = intervalo
+        self.threads = threads   # None = todas; senão ident -> placa, mantido por _PerfilCiclo.entrar/sair
+        self.pilhas = {}         # "f1 (arq:linha);f2 (...)" -> amostras
+        self._parar = threading.Event()
+
+    def run(self):
+        ignorar = {self.ident} | {t.ident for t in threading.enumerate() if t.name == "metricas"}
+        while not self._parar.wait(self.intervalo):
+            alvo = None if self.threads is None else dict(self.threads)
+            for ident, frame in sys._current_frames().items():
+                if ident in ignorar or (alvo is not None and ident not in alvo):
+                    continue
+                quadros = []
+                while frame is not None:
+                    c = frame.f_code
+                    quadros.append(f"{c.co_name} ({os.path.basename(c.co_filename)}:{c.co_firstlineno})")
+                    frame = frame.f_back
+                if alvo is not None:
+                    quadros.append(f"placa={alvo[ident]}")
+                pilha = ";".join(reversed(quadros))
+                self.pilhas[pilha] = self.pilhas.get(pilha, 0) + 1
+
+    def parar(self):
+        self._parar.set()
+        self.join()
+
+class _PerfilCiclo:
+    """Um ciclo perfilado: liga os coletores no início e grava/resume tudo em encerrar()."""
+
+    def __init__(self, ciclo, modo, placas, memoria):
+        self.ciclo, self.modo, self.placas, self.memoria = ciclo, modo, placas, memoria
+        self.inicio = datetime.now(timezone.utc)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._por_placa = {}   # placa -> [cProfile.Profile] (um por etapa medida)
+        self._threads = {}     # amostragem por placa: ident -> placa
+        self._prof = self._amostrador = None
+        self._tracemalloc_nosso = memoria and not tracemalloc.is_tracing()
+        if self._tracemalloc_nosso:
+            tracemalloc.start()   # 1 quadro por alocação (o resumo é por linha); mais quadros custam caro
+        if modo == "amostragem":
+            self._amostrador = _Amostrador(PERFIL_AMOSTRA_MS / 1000, self._threads if placas else None)
+            self._amostrador.start()
+        elif not placas:
+            self._prof = cProfile.Profile()
+            self._prof.enable()
+
+    def entrar(self, placa):
+        """Início de uma etapa da placa; devolve a marca para sair() ou None se ela não é perfilada."""
+        if placa not in self.placas or getattr(self._local, "ativo", False):
+            return None
+        self._local.ativo = True
+        if self._amostrador is not None:
+            self._threads[threading.get_ident()] = placa
+            return (placa, None)
+        prof = cProfile.Profile()
+        prof.enable()
+        return (placa, prof)
+
+    def sair(self, marca):
+        placa, prof = marca
+        if prof is None:
+            self._threads.pop(threading.get_ident(), None)
+        else:
+            prof.disable()
+            with self._lock:
+                self._por_placa.setdefault(placa, []).append(prof)
+        self._local.ativo = False
+
+    def encerrar(self):
+        if self._prof is not None:
+            self._prof.disable()
+        if self._amostrador is not None:
+            self._amostrador.parar()
+        snapshot = tracemalloc.take_snapshot() if self.memoria else None
+        pico = tracemalloc.get_traced_memory()[1] if self.memoria else 0
+        if self._tracemalloc_nosso:
+            tracemalloc.stop()
+
+        os.makedirs(PERFIL_DIR, exist_ok=True)
+        base = os.path.join(PERFIL_DIR, f"{self.inicio:%Y%m%dT%H%M%SZ}-ciclo{self.ciclo}")
+        segundos = (datetime.now(timezone.utc) - self.inicio).total_seconds()
+        if self._prof is not None:
+            stats = pstats.Stats(self._prof)
+            stats.dump_stats(base + ".pstats")
+            _log_resumo(f"Perfil ciclo {self.ciclo} ({segundos:.1f} s, cprofile) -> {base}.pstats",
+                        _resumo_pstats(stats, PERFIL_TOP))
+        for placa, perfis in sorted(self._por_placa.items()):
+            stats = pstats.Stats(*perfis)
+            arq = f"{base}-{re.sub(r'[^0-9A-Za-z_.-]', '_', placa)}.pstats"
+            stats.dump_stats(arq)
+            _log_resumo(f"Perfil ciclo {self.ciclo} [{placa}] ({stats.total_tt:.2f} s em {len(perfis)} etapas, "
+                        f"cprofile) -> {arq}", _resumo_pstats(stats, PERFIL_TOP))
+        if self._amostrador is not None:
+            pilhas = self._amostrador.pilhas
+            with open(base + ".folded", "w", encoding="utf-8") as f:
+                f.writelines(f"{p} {n}\n" for p, n in sorted(pilhas.items()))
+            _log_resumo(f"Perfil ciclo {self.ciclo} ({segundos:.1f} s, {sum(pilhas.values())} amostras"
+                        f"{' de ' + ','.join(sorted(self.placas)) if self.placas else ''}) -> {base}.folded",
+                        _resumo_amostras(pilhas, PERFIL_TOP))
+        if snapshot is not None:
+            snapshot.dump(base + ".tracemalloc")
+            stats = snapshot.statistics("lineno")
+            _log_resumo(f"Memória ciclo {self.ciclo}: {sum(s.size for s in stats) / 2**20:.1f} MiB vivos, "
+                        f"pico {pico / 2**20:.1f} MiB -> {base}.tracemalloc",
+                        [f"{s.size / 1024:10.1f} KiB {s.count:>8} blocos  "
+                         f"{os.path.basename(s.traceback[0].filename)}:{s.traceback[0].lineno}"
+                         for s in stats[:PERFIL_TOP]])
+
+def _log_resumo(titulo, linhas):
+    logging.info("\n  ".join([titulo, *linhas]))
+
+def _resumo_pstats(stats, n) -> list:
+    """Top-n por tempo próprio: próprio, acumulado, chamadas, função (arquivo:linha)."""
+    maiores = sorted(stats.stats.items(), key=lambda kv: kv[1][2], reverse=True)[:n]
+    return [f"{tt:8.3f} s próprio {ct:8.3f} s acum. {nc:>9} chamadas  {func} ({os.path.basename(arq)}:{linha})"
+            for (arq, linha, func), (_, nc, tt, ct, _) in maiores]
+
+def _resumo_amostras(pilhas, n) -> list:
+    """Top-n quadros por amostras no topo da pilha (próprio), com a fração em que aparecem (acumulado)."""
+    total = sum(pilhas.values()) or 1
+    proprio, acumulado = {}, {}
+    for pilha, c in pilhas.items():
+        quadros = pilha.split(";")
+        proprio[quadros[-1]] = proprio.get(quadros[-1], 0) + c
+        for q in set(quadros):
+            acumulado[q] = acumulado.get(q, 0) + c
+    maiores = sorted(proprio.items(), key=lambda kv: kv[1], reverse=True)[:n]
+    return [f"{100 * c / total:5.1f}% próprio {100 * acumulado[q] / total:5.1f}% acum.  {q}" for q, c in maiores]
+
+class Perfil:
+    """Gatilho do perfil: ciclos armados (env ou sinal) e o ciclo perfilado corrente."""
+
+    def __init__(self, ciclos=0):
+        self.pendentes = ciclos
+        self.atual = None   # _PerfilCiclo durante um ciclo perfilado; None no resto do tempo
+
+    def armar(self, ciclos=None):
+        # chamado de handler de sinal: sem lock nem log aqui (o próximo iniciar_ciclo loga)
+        self.pendentes += max(PERFIL_CICLOS, 1) if ciclos is None else ciclos
+
+    def iniciar_ciclo(self, ciclo):
+        if self.pendentes <= 0:
+            return
+        self.pendentes -= 1
+        modo = PERFIL_MODO if PERFIL_MODO in _PERFIL_MODOS else "cprofile"
+        logging.info(f"Perfil: ciclo {ciclo} em modo {modo}"
+                     f"{' nas placas ' + ','.join(sorted(PERFIL_PLACAS)) if PERFIL_PLACAS else ''}"
+                     f"{' + tracemalloc' if PERFIL_MEMORIA else ''} (faltam {self.pendentes}).")
+        self.atual = _PerfilCiclo(ciclo, modo, PERFIL_PLACAS, PERFIL_MEMORIA)
+
+    def encerrar_ciclo(self):
+        atual, self.atual = self.atual, None
+        if atual is None:
+            return
+        try:
+            atual.encerrar()
+        except OSError as e:
+            logging.error(f"Falha ao gravar o perfil do ciclo {atual.ciclo} em {PERFIL_DIR}: {e}")
+
+    def instalar_sinal(self):
+        """SIGUSR2 arma mais PERFIL_CICLOS (mín. 1) ciclos; só na thread principal e fora do Windows."""
+        sig = getattr(signal, "SIGUSR2", None)
+        if sig is not None:
+            signal.signal(sig, lambda *_: self.armar())
+
+PERFIL = Perfil(PERFIL_CICLOS)
+
 # ====================== Utils gerais ======================
 def _to_iso_z(dt: datetime) -> str:
     if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)
@@ -112,6 +590,18 @@ def _to_local_dt(s: str) -> datetime:
     if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)
     return dt.astimezone(LOCAL_TZ)
 
+def json_loads(data):
+    """bytes/str -> objeto, com o backend configurado (JSON_BACKEND)."""
+    if JSON_BACKEND == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps_bytes(obj) -> bytes:
+    """Objeto -> JSON compacto em UTF-8, pronto para ir direto ao COPY das colunas JSONB."""
+    if JSON_BACKEND == "orjson":
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
 def _sanitize_path(p: str) -> str:
     if not p: return ""
     p = "".join(ch for ch in p if unicodedata.category(ch)[0] != "C").strip()
@@ -139,12 +629,17 @@ def _to_db_ts(s: str):
     - Se SAVE_AS_NAIVE_LOCAL=True: remove tzinfo e grava 'naive' (timestamp sem tz) já com o shift aplicado.
     - Se SAVE_AS_NAIVE_LOCAL=False: mantém tzinfo (aware) porém com o horário já shiftado.
     """
+    return _utc_to_db_ts(_api_dt_utc(s))
+
+def _api_dt_utc(s: str) -> datetime:
+    """Data da API como datetime aware em UTC (a API vem em UTC/GMT)."""
     dt = _parse_dt_any(s)
-    # considere que a API vem em UTC (GMT)
     if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    else:
-        dt = dt.astimezone(timezone.utc)
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+def _utc_to_db_ts(dt: datetime):
+    """Mesma regra de _to_db_ts para um datetime já convertido por _api_dt_utc."""
 
     # aplica o deslocamento desejado (ex.: -4h)
     dt_shift = dt + timedelta(hours=FIX_UTC_OFFSET_HOURS)
@@ -164,66 +659,381 @@ def _naive_local(dt: datetime) -> datetime:
         return dt
     return dt.astimezone(LOCAL_TZ).replace(tzinfo=None)
 
+_US = 1_000_000
+_EPOCH_NAIVE = datetime(1970, 1, 1)
+_UM_US = timedelta(microseconds=1)
+
+def _epoch_us(t: datetime) -> int:
+    """datetime naive -> µs inteiros (diferenças exatas, como no timedelta)."""
+    return (t - _EPOCH_NAIVE) // _UM_US
+
+def _haversine_np(lat1, lon1, lat2, lon2):
+    """_haversine_m vetorizada (lat2/lon2 arrays; NaN = coordenada ausente)."""
+    R = 6371000.0
+    φ1, φ2 = np.radians(lat1), np.radians(lat2)
+    Δφ, Δλ = np.radians(lat2 - lat1), np.radians(lon2 - lon1)
+    a = np.sin(Δφ/2)**2 + np.cos(φ1)*np.cos(φ2)*np.sin(Δλ/2)**2
+    return 2 * R * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
 # ====================== DB ======================
 def obter_conexao():
     #if DATABASE_URL and DATABASE_URL.strip():
     #   return psycopg2.connect(dsn=DATABASE_URL)
     return psycopg2.connect(
         host=DB_HOST, port=DB_PORT, dbname=DB_NAME,
-        user=DB_USER, password=DB_PASS, sslmode=DB_SSLMODE, channel_binding=DB_CHANNEL_BINDING
+        user=DB_USER, password=DB_PASS, sslmode=DB_SSLMODE, channel_binding=DB_CHANNEL_BINDING,
+        connect_timeout=DB_CONNECT_TIMEOUT
     )
 
-def carregar_placas_validas(cur):
-    cur.execute("SELECT placa FROM cadastro.veiculo WHERE ativo = TRUE;")
-    return [str(r[0]).strip() for r in cur.fetchall()]
-
-def carregar_ids_existentes(cur, ids):
-    existentes = set()
-    if not ids: return existentes
-    CHUNK = 10000
-    for i in range(0, len(ids), CHUNK):
-        slice_ids = ids[i:i+CHUNK]
-        cur.execute("SELECT id_position FROM rastreio.posicao WHERE id_position = ANY(%s);", (slice_ids,))
-        existentes.update(r[0] for r in cur.fetchall())
-    return existentes
-
-def obter_ultima_data_posicao(cur, placa: str):
-    cur.execute("SELECT MAX(data_evento) FROM rastreio.posicao WHERE placa = %s;", (placa,))
-    return cur.fetchone()[0]
+def carregar_marcas(cur):
+    """
+    Marca d'água de ingestão de TODAS as placas ativas em uma consulta:
+    {placa: {"instalado_em", "evento_api", "id_position", "ultima_data_evento"}}.
+    'evento_api'/'id_position' = último item gravado (EventDate UTC da API), cursor exato da paginação.
+    """
+    cur.execute("""
+        SELECT v.placa, v.instalado_em, c.ultimo_evento_api, c.ultimo_id_position
+          FROM cadastro.veiculo v
+          LEFT JOIN rastreio.ingestao_cursor c ON c.placa = v.placa
+         WHERE v.ativo = TRUE;
+    """)
+    marcas = {
+        str(placa).strip(): {"instalado_em": inst, "evento_api": evt, "id_position": idp, "ultima_data_evento": None}
+        for placa, inst, evt, idp in cur.fetchall()
+    }
+    # Placas ainda sem cursor (instalação anterior à tabela ou nunca gravadas): MAX(data_evento) em lote
+    sem_cursor = [p for p, m in marcas.items() if m["evento_api"] is None]
+    if sem_cursor:
+        cur.execute(
+            "SELECT placa, MAX(data_evento) FROM rastreio.posicao WHERE placa = ANY(%s) GROUP BY placa;",
+            (sem_cursor,))
+        for placa, dt in cur.fetchall():
+            marcas[placa]["ultima_data_evento"] = dt
+    return marcas
+
+def atualizar_marca(cur, placa, linhas):
+    """Avança o cursor da placa para o maior (EventDate, IdPosition) das linhas, na transação corrente."""
+    if not linhas: return
+    ultimo = max(linhas, key=lambda r: (r.evento_api, r.id_position))
+    cur.execute("""
+        INSERT INTO rastreio.ingestao_cursor AS c (placa, ultimo_evento_api, ultimo_id_position, atualizado_em)
+        VALUES (%s, %s, %s, now())
+        ON CONFLICT (placa) DO UPDATE
+           SET ultimo_evento_api  = EXCLUDED.ultimo_evento_api,
+               ultimo_id_position = EXCLUDED.ultimo_id_position,
+               atualizado_em      = now()
+         WHERE (EXCLUDED.ultimo_evento_api, EXCLUDED.ultimo_id_position)
+             > (c.ultimo_evento_api, c.ultimo_id_position);
+    """, (placa, ultimo.evento_api, ultimo.id_position))
+
+
+# ---------- partições mensais de rastreio.posicao ----------
+_PARTICOES = set()            # meses (date do dia 1) já garantidos neste processo
+_PARTICOES_LOCK = threading.Lock()
+_RETENCAO_MES = None          # retenção roda uma vez por mês por processo
+
+def _meses(ini, fim):
+    m = date(ini.year, ini.month, 1)
+    while m <= fim:
+        yield m
+        m = date(m.year + (m.month == 12), m.month % 12 + 1, 1)
+
+def garantir_particoes(ini, fim):
+    """
+    Garante as partições mensais de rastreio.posicao entre ini e fim (datas). Usa conexão
+    própria com commit imediato: o DDL não prende o lock da tabela-mãe na transação de carga
+    e o cache só registra o mês depois que a partição existe de fato.
+    """
+    faltam = [m for m in _meses(ini, fim) if m not in _PARTICOES]
+    if not faltam: return
+    with _PARTICOES_LOCK:
+        faltam = [m for m in faltam if m not in _PARTICOES]
+        if not faltam: return
+        conn = obter_conexao()
+        try:
+            with conn.cursor() as cur:
+                # o DDL pede lock exclusivo na tabela-mãe: não deixa a carga inteira na fila atrás dele
+                cur.execute("SET LOCAL lock_timeout = '10s';")
+                cur.execute("SELECT rastreio.garantir_particoes_posicao(%s, %s);", (faltam[0], faltam[-1]))
+                criadas = cur.fetchone()[0]
+            conn.commit()
+        finally:
+            conn.close()
+        _PARTICOES.update(_meses(faltam[0], faltam[-1]))
+    if criadas:
+        logging.info(f"Criadas {criadas} partições de rastreio.posicao ({faltam[0]:%Y-%m} a {faltam[-1]:%Y-%m}).")
+
+def corte_retencao(agora=None):
+    """Início (UTC) do mês mais antigo que a retenção mantém (mesma conta de aplicar_retencao_posicao), ou None."""
+    if POSICAO_RETENCAO_MESES <= 0: return None
+    agora = agora or datetime.now(timezone.utc)
+    m = agora.year * 12 + agora.month - 1 - POSICAO_RETENCAO_MESES
+    return datetime(m // 12, m % 12 + 1, 1, tzinfo=timezone.utc)
+
+def manter_particoes(agora=None):
+    """Início de ciclo: partições do mês corrente + POSICAO_PARTICOES_FUTURAS; retenção uma vez por mês."""
+    global _RETENCAO_MES
+    hoje = (agora or datetime.now(timezone.utc)).date()
+    garantir_particoes(hoje, hoje + timedelta(days=31 * POSICAO_PARTICOES_FUTURAS))
+    mes = (hoje.year, hoje.month)
+    if POSICAO_RETENCAO_MESES <= 0 or _RETENCAO_MES == mes:
+        return
+    with obter_conexao() as conn, conn.cursor() as cur:
+        cur.execute("SELECT rastreio.aplicar_retencao_posicao(%s, %s);",
+                    (POSICAO_RETENCAO_MESES, POSICAO_RETENCAO_MODO == "drop"))
+        saiu = [r[0] for r in cur.fetchall()]
+        conn.commit()
+    _RETENCAO_MES = mes
+    _PARTICOES.difference_update(date(int(n[8:12]), int(n[12:14]), 1) for n in saiu)
+    if saiu:
+        acao = "removidas" if POSICAO_RETENCAO_MODO == "drop" else "desanexadas"
+        logging.info(f"Retenção ({POSICAO_RETENCAO_MESES} meses): partições {acao}: {', '.join(saiu)}")
+
+# ====================== Áreas de descarte ======================
+# operacao.area_descarte fica em memória (IndiceAreas) e a DESCARGA finalizada pelo detector já
+# é gravada como DESCARTE_CORRETO/INDEVIDO, sem ST_Contains por sessão. O trigger do banco só
+# classifica o que chega como DESCARGA (fechamento por GAP, ETL sem o índice carregado).
+_AREAS = None   # IndiceAreas da última versão lida; None = ainda não carregado
+
+def _ponto_no_poligono(lat, lon, vertices):
+    """Par-ímpar (raio em longitude crescente) sobre os vértices [(lat, lon)], anel aberto."""
+    dentro = False
+    j = len(vertices) - 1
+    for i in range(len(vertices)):
+        (yi, xi), (yj, xj) = vertices[i], vertices[j]
+        if (yi > lat) != (yj > lat) and lon < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+            dentro = not dentro
+        j = i
+    return dentro
+
+class IndiceAreas:
+    """
+    Grade fixa de AREAS_GRADE_GRAUS: cada área entra nas células que o seu retângulo envolvente
+    cobre; a consulta olha só as áreas da célula do ponto (retângulo e depois o polígono).
+    """
+    def __init__(self, areas, versao=None, grade=None):
+        self.versao = versao
+        self.grade = grade or AREAS_GRADE_GRAUS
+        self.areas = []     # (id, nome, vértices [(lat, lon)], (lat_min, lat_max, lon_min, lon_max))
+        self.celulas = {}   # (i, j) -> índices em self.areas
+        for id_area, nome, vertices in areas:
+            lats, lons = [v[0] for v in vertices], [v[1] for v in vertices]
+            caixa = (min(lats), max(lats), min(lons), max(lons))
+            k = len(self.areas)
+            self.areas.append((id_area, nome, vertices, caixa))
+            for i in range(self._celula(caixa[0]), self._celula(caixa[1]) + 1):
+                for j in range(self._celula(caixa[2]), self._celula(caixa[3]) + 1):
+                    self.celulas.setdefault((i, j), []).append(k)
+
+    def __len__(self):
+        return len(self.areas)
+
+    def _celula(self, x):
+        return floor(x / self.grade)
+
+    def localizar(self, lat, lon):
+        """id da primeira área que contém o ponto, ou None."""
+        if lat is None or lon is None: return None
+        lat, lon = float(lat), float(lon)
+        for k in self.celulas.get((self._celula(lat), self._celula(lon)), ()):
+            id_area, _, vertices, (la0, la1, lo0, lo1) = self.areas[k]
+            if la0 <= lat <= la1 and lo0 <= lon <= lo1 and _ponto_no_poligono(lat, lon, vertices):
+                return id_area
+        return None
 
-def obter_data_instalacao(cur, placa: str):
-    cur.execute("SELECT instalado_em FROM cadastro.veiculo WHERE placa = %s;", (placa,))
-    return cur.fetchone()[0]
+    def localizar_lote(self, pontos):
+        """[(lat, lon)] -> [id da área ou None], na mesma ordem."""
+        return [self.localizar(lat, lon) for lat, lon in pontos]
 
+def carregar_areas(cur):
+    """
+    Início de ciclo: relê operacao.area_descarte só quando operacao.area_descarte_versao mudou
+    (trigger por comando na tabela). Em erro, mantém o índice anterior (ou nenhum).
+    """
+    global _AREAS
+    try:
+        cur.execute("SELECT versao FROM operacao.area_descarte_versao;")
+        row = cur.fetchone()
+        versao = row[0] if row else None
+        if _AREAS is not None and versao is not None and _AREAS.versao == versao:
+            return _AREAS
+        cur.execute("""
+            SELECT id, nome, lat1, lon1, lat2, lon2, lat3, lon3, lat4, lon4
+              FROM operacao.area_descarte ORDER BY id;
+        """)
+        areas = [(r[0], r[1], [(r[2], r[3]), (r[4], r[5]), (r[6], r[7]), (r[8], r[9])]) for r in cur.fetchall()]
+        cur.connection.commit()
+    except psycopg2.Error as e:
+        cur.connection.rollback()
+        logging.warning(f"Áreas de descarte não carregadas (classificação fica com o trigger): {e}")
+        return _AREAS
+    _AREAS = IndiceAreas(areas, versao)
+    logging.info(f"Áreas de descarte carregadas: {len(_AREAS)} (versão {versao}, {len(_AREAS.celulas)} células).")
+    return _AREAS
+
+def classificar_descargas(sessoes, indice=None):
+    """
+    DESCARGA finalizada -> DESCARTE_CORRETO se o ponto de fim (ou o de início, sem fim) está em
+    alguma área, senão DESCARTE_INDEVIDO; mesma regra do trigger. Sem índice, não mexe.
+    """
+    indice = indice or _AREAS
+    alvo = [s for s in sessoes if s["fim"] == "finalizar" and s["tipo"] == "DESCARGA"]
+    if indice is None or not alvo: return
+    pontos = []
+    for s in alvo:
+        lat, lon = s.get("lat1"), s.get("lon1")
+        pontos.append((lat, lon) if lat is not None and lon is not None else (s.get("lat0"), s.get("lon0")))
+    for s, area in zip(alvo, indice.localizar_lote(pontos)):
+        s["tipo"] = "DESCARTE_CORRETO" if area is not None else "DESCARTE_INDEVIDO"
 
 # ====================== Regras de Sessão ======================
-def sessao_abrir(cur, placa, tipo, t, nivel_ini_pct, lat_ini=None, lon_ini=None, origem='trend_v2'):
-    cur.execute("SELECT id_sessao FROM operacao.sessao_tanque WHERE placa=%s AND tipo=%s AND fim_em IS NULL ORDER BY inicio_em DESC LIMIT 1", (placa, tipo))
-    if cur.fetchone(): return None
-    cur.execute(
-        "INSERT INTO operacao.sessao_tanque (placa,tipo,inicio_em,nivel_inicio_pct,lat_inicio,lon_inicio,origem) VALUES (%s,%s,%s,%s,%s,%s,%s) RETURNING id_sessao",
-        (placa, tipo, t, float(nivel_ini_pct), lat_ini, lon_ini, origem)
-    )
-    return cur.fetchone()[0]
+# O detector não escreve sessão a sessão: abre/toca/finaliza/cancela em memória e
+# gravar_sessoes() descarrega tudo uma vez por placa por ciclo.
+def sessao_nova(placa, tipo, t, nivel_ini_pct, lat_ini=None, lon_ini=None, id_position_ini=None):
+    """Sessão aberta em memória; id_sessao só existe depois do gravar_sessoes()."""
+    return {
+        "id": None, "placa": placa, "tipo": tipo,
+        "t0": t, "nivel0": nivel_ini_pct,
+        "lat0": lat_ini, "lon0": lon_ini,
+        "lat1": None, "lon1": None,   # lat/lon do último touch (já gravado ou não)
+        "id_pos0": id_position_ini,   # posição da base do level_tracker (= inicio_em)
+        "toque": None,   # último touch ainda não gravado: [t, nivel, lat, lon, id_position]
+        "fim": None,     # None | "finalizar" | "cancelar"
+    }
 
-def sessao_touch(cur, id_sessao, t, nivel_fim_pct, lat_fim=None, lon_fim=None):
-    cur.execute(
-        "UPDATE operacao.sessao_tanque SET nivel_fim_pct=%s, lat_fim=%s, lon_fim=%s, atualizado_em=%s WHERE id_sessao=%s AND fim_em IS NULL",
-        (float(nivel_fim_pct), lat_fim, lon_fim, t, id_sessao)
-    )
+def sessao_touch(sess, t, nivel_fim_pct, lat_fim=None, lon_fim=None, id_position_fim=None):
+    sess["toque"] = [t, nivel_fim_pct, lat_fim, lon_fim, id_position_fim]
+    sess["lat1"], sess["lon1"] = lat_fim, lon_fim
 
-def sessao_finalizar(cur, id_sessao):
-    cur.execute(
-        "UPDATE operacao.sessao_tanque SET fim_em=atualizado_em, atualizado_em=now() WHERE id_sessao=%s AND fim_em IS NULL",
-        (id_sessao,)
-    )
+def _sessao_inserir(cur, novas, origem):
+    """
+    INSERT único das sessões abertas no ciclo. Devolve (id da que segue aberta ou None se
+    recusada, ids de todas as inseridas).
+    """
+    linhas = []
+    for s in novas:
+        t, nv, lat, lon, id_fim = s["toque"] or (None, None, None, None, None)
+        fechar = s["fim"] == "finalizar"
+        linhas.append((s["placa"], s["tipo"], s["t0"], fechar, t, float(s["nivel0"]),
+                       float(nv) if nv is not None else None, s["lat0"], s["lon0"], lat, lon,
+                       s.get("id_pos0"), id_fim, origem, fechar, t))
+    # sessões já finalizadas entram fechadas e já classificadas (sem índice de áreas, o trigger cobre o INSERT);
+    # a aberta respeita o índice único de placa+tipo em aberto, como o antigo sessao_abrir
+    rows = execute_values(cur, """
+        INSERT INTO operacao.sessao_tanque
+               (placa, tipo, inicio_em, fim_em, nivel_inicio_pct, nivel_fim_pct,
+                lat_inicio, lon_inicio, lat_fim, lon_fim, id_position_inicio, id_position_fim,
+                origem, atualizado_em)
+        VALUES %s
+        ON CONFLICT (placa, tipo) WHERE fim_em IS NULL DO NOTHING
+        RETURNING id_sessao, fim_em IS NULL;
+    """, linhas, fetch=True, template=(
+        "(%s, %s, %s, CASE WHEN %s THEN COALESCE(%s::timestamptz, now()) END, %s, %s, %s, %s, %s, %s, %s, %s, %s, "
+        "CASE WHEN %s THEN now() ELSE COALESCE(%s::timestamptz, now()) END)"))
+    return next((sid for sid, aberta in rows if aberta), None), [sid for sid, _ in rows]
+
+def _sessao_atualizar(cur, s):
+    """Sessão que já estava no banco: um UPDATE (toque e/ou finalização) ou DELETE (cancelamento)."""
+    if s["fim"] == "cancelar":
+        cur.execute("DELETE FROM operacao.sessao_tanque WHERE id_sessao = %s AND fim_em IS NULL", (s["id"],))
+        return True
+    if not s["toque"] and not s["fim"]:
+        return True
+    sets, params = [], []
+    if s["toque"]:
+        t, nv, lat, lon, id_fim = s["toque"]
+        sets += ["nivel_fim_pct=%s", "lat_fim=%s", "lon_fim=%s", "id_position_fim=COALESCE(%s, id_position_fim)"]
+        params += [float(nv), lat, lon, id_fim]
+    if s["fim"] == "finalizar":
+        # fim_em = último touch (mesma regra do antigo sessao_finalizar: fim_em=atualizado_em)
+        sets += ["fim_em=%s" if s["toque"] else "fim_em=atualizado_em", "atualizado_em=now()", "tipo=%s"]
+        params += ([t] if s["toque"] else []) + [s["tipo"]]
+    else:
+        sets.append("atualizado_em=%s")
+        params.append(t)
+    cur.execute(f"UPDATE operacao.sessao_tanque SET {', '.join(sets)} WHERE id_sessao=%s AND fim_em IS NULL",
+                (*params, s["id"]))
+    return cur.rowcount > 0
 
-def sessao_cancelar(cur, id_sessao):
-    cur.execute("DELETE FROM operacao.sessao_tanque WHERE id_sessao = %s", (id_sessao,))
+def gravar_sessoes(cur, sessoes, origem='trend_v2'):
+    """
+    Descarrega o ciclo de vida acumulado das sessões de UMA placa: UPDATE/DELETE das que já
+    estavam no banco (no máximo a que estava aberta) e um INSERT para as abertas no ciclo.
+    Sessões canceladas antes de gravadas nem chegam ao banco. Na sessão que segue aberta,
+    preenche 'id' e zera o pendente. Devolve (sessões abertas que o banco recusou, ids de
+    sessão escritos). Recusa = fechada por fora (ex. fechar_sessoes_stagnadas) ou já existe
+    outra aberta da mesma placa+tipo.
+    """
+    recusadas, ids = [], []
+    for s in sessoes:
+        if s["id"] is None:
+            METRICAS.contar("etl_sessoes_total", placa=s["placa"], evento="aberta", tipo=s["tipo"])
+    classificar_descargas(sessoes)
+    for s in sessoes:
+        if s["fim"]:
+            evento = "finalizada" if s["fim"] == "finalizar" else "cancelada"
+            METRICAS.contar("etl_sessoes_total", placa=s["placa"], evento=evento, tipo=s["tipo"])
+    # primeiro as existentes: libera o índice único antes de inserir a nova do mesmo tipo
+    for s in sessoes:
+        if s["id"] is None: continue
+        ids.append(s["id"])
+        if not _sessao_atualizar(cur, s) and s["fim"] is None:
+            recusadas.append(s)
+    novas = [s for s in sessoes if s["id"] is None and s["fim"] != "cancelar"]
+    if novas:
+        sid, inseridas = _sessao_inserir(cur, novas, origem)
+        ids += inseridas
+        for s in novas:
+            if s["fim"] is None:
+                if sid is None:
+                    recusadas.append(s)
+                s["id"] = sid
+    for s in sessoes:
+        s["toque"] = None
+    return recusadas, ids
+
+def preencher_posicoes_sessoes(conn, lote=5000) -> int:
+    """
+    Carga única de id_position_inicio/id_position_fim nas sessões gravadas antes das colunas
+    (ou por caminhos que não conhecem a posição). Usa a mesma busca por horário das views,
+    uma vez por sessão, em lotes por id_sessao com commit a cada lote. Só o fim das sessões
+    fechadas é preenchido: nas abertas o próximo touch grava. Devolve as sessões alteradas.
+    """
+    total, ultimo = 0, 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH alvo AS (
+                    SELECT id_sessao FROM operacao.sessao_tanque
+                     WHERE id_sessao > %s
+                       AND (id_position_inicio IS NULL OR (fim_em IS NOT NULL AND id_position_fim IS NULL))
+                     ORDER BY id_sessao
+                     LIMIT %s)
+                UPDATE operacao.sessao_tanque s
+                   SET id_position_inicio = COALESCE(s.id_position_inicio, (
+                           SELECT p.id_position FROM rastreio.posicao p
+                            WHERE p.placa = s.placa AND p.data_evento <= s.inicio_em
+                            ORDER BY p.data_evento DESC, p.id_position DESC LIMIT 1)),
+                       id_position_fim = CASE WHEN s.fim_em IS NULL THEN s.id_position_fim
+                           ELSE COALESCE(s.id_position_fim, (
+                           SELECT p.id_position FROM rastreio.posicao p
+                            WHERE p.placa = s.placa AND p.data_evento <= s.fim_em
+                            ORDER BY p.data_evento DESC, p.id_position DESC LIMIT 1)) END
+                  FROM alvo
+                 WHERE s.id_sessao = alvo.id_sessao
+                RETURNING s.id_sessao;
+            """, (ultimo, lote))
+            ids = [r[0] for r in cur.fetchall()]
+        conn.commit()
+        if not ids:
+            return total
+        total += len(ids)
+        ultimo = max(ids)
+        _LOG_DETECTOR.info(f"sessoes-posicoes: {total} sessões preenchidas (até id_sessao {ultimo})")
 
 # etl.py
 
-def finalizar_sessao_se_valida(cur, sess_dict):
+def finalizar_sessao_se_valida(sess_dict):
     if not sess_dict or not sess_dict.get("last_touch_t"): return 0
     
     MIN_POINTS = 2
@@ -233,200 +1043,321 @@ def finalizar_sessao_se_valida(cur, sess_dict):
     delta_pp = abs(sess_dict["last_nivel"] - sess_dict["nivel0"])
     
     if dur >= MIN_SESSION_DURATION_SEC and delta_pp >= MIN_SESSION_DELTA_PP and point_count >= MIN_POINTS:
-        logging.info(f"Finalizando sessão válida {sess_dict['id']} para {sess_dict['placa']} (pontos únicos: {point_count}, duração: {dur:.0f}s, delta: {delta_pp:.2f}pp)")
-        sessao_finalizar(cur, sess_dict["id"])
+        _LOG_DETECTOR.info(f"Finalizando sessão válida {sess_dict['id'] or '(nova)'} para {sess_dict['placa']} (pontos únicos: {point_count}, duração: {dur:.0f}s, delta: {delta_pp:.2f}pp)")
+        sess_dict["fim"] = "finalizar"
         return 1
     else:
-        logging.warning(
-            f"Cancelando sessão inválida {sess_dict['id']} para {sess_dict['placa']} "
+        _LOG_DETECTOR.warning(
+            f"Cancelando sessão inválida {sess_dict['id'] or '(nova)'} para {sess_dict['placa']} "
             f"(pontos únicos: {point_count}, duração: {dur:.0f}s, delta: {delta_pp:.2f}pp) - "
             f"Critérios: min_pontos={MIN_POINTS}, min_dur={MIN_SESSION_DURATION_SEC}s, min_delta={MIN_SESSION_DELTA_PP}pp"
         )
-        sessao_cancelar(cur, sess_dict["id"])
+        sess_dict["fim"] = "cancelar"
         return 0
 
 # ====================== Detector por Tendência (v2) ======================
-# Adicione esta função ANTES de detect_events_by_trend:
-
-def detect_events_with_context(cur, placa, new_rows, lookback_minutes):
+def _ponto_detector(r):
+    """Posicao -> ponto do detector {"t","nv","lat","lon","v","id"}; nv=None quando o nível não serve."""
+    try:
+        nv_raw = r.nivel_tanque_percent
+        nv = Decimal(str(nv_raw)) if nv_raw is not None and nv_raw > 0 else None
+        return {
+            "t": _naive_local(r.data_evento),
+            "nv": nv,
+            "lat": r.latitude,
+            "lon": r.longitude,
+            "v": r.velocidade_kmh,
+            "id": r.id_position,
+        }
+    except (InvalidOperation, TypeError):
+        return {"t": r.data_evento, "nv": None, "id": r.id_position}
+
+def _nova_base(point):
+    return {"start_nv": point["nv"], "start_t": point["t"], "start_id": point.get("id"),
+            "current_nv": point["nv"], "current_t": point["t"]}
+
+def _estado_para_json(v):
+    """datetime/Decimal não existem em JSON: marca o tipo para o snapshot voltar idêntico."""
+    if isinstance(v, datetime): return {"$dt": v.isoformat()}
+    if isinstance(v, Decimal): return {"$dec": str(v)}
+    if isinstance(v, dict): return {k: _estado_para_json(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple, deque)): return [_estado_para_json(x) for x in v]
+    return v
+
+def _estado_de_json(v):
+    if isinstance(v, dict):
+        if "$dt" in v: return datetime.fromisoformat(v["$dt"])
+        if "$dec" in v: return Decimal(v["$dec"])
+        return {k: _estado_de_json(x) for k, x in v.items()}
+    if isinstance(v, list): return [_estado_de_json(x) for x in v]
+    return v
+
+class DetectorTendencia:
     """
-    Busca contexto histórico antes de detectar eventos.
-    Isso garante que eventos que cruzam ciclos de ETL sejam capturados.
+    Detector por tendência de UMA placa, incremental: recebe só as posições novas de cada
+    ciclo e mantém em memória o que o algoritmo em lote reconstruía a cada chamada
+    (level_tracker, sessão aberta, bloqueio do geofence e os pontos ainda em julgamento
+    pelo anti-spike). Alimentado em pedaços, decide exatamente o mesmo que o lote com
+    todos os pontos de uma vez; a sessão só fecha por critério, não pelo fim do ciclo.
+
+    O estado vai para operacao.detector_estado na mesma transação das sessões, então um
+    restart retoma de onde parou (e reprocessa posições gravadas sem detecção, se houver).
     """
-    if not new_rows:
-        return 0
-    
-    # Pegar timestamp do primeiro ponto novo
-    first_new_time = min(r["data_evento"] for r in new_rows)
-    lookback_time = first_new_time - timedelta(minutes=lookback_minutes)
-    
-    # Buscar pontos históricos recentes
-    cur.execute("""
-        SELECT 
-            data_evento,
-            nivel_tanque_percent,
-            latitude,
-            longitude,
-            velocidade_kmh
-        FROM rastreio.posicao
-        WHERE placa = %s
-          AND data_evento BETWEEN %s AND %s
-          AND nivel_tanque_percent IS NOT NULL
-          AND nivel_tanque_percent > 0
-        ORDER BY data_evento, id_position
-    """, (placa, lookback_time, first_new_time))
-    
-    historical_rows = [
-        {
-            "data_evento": row[0],
-            "nivel_tanque_percent": row[1],
-            "latitude": row[2],
-            "longitude": row[3],
-            "velocidade_kmh": row[4]
-        }
-        for row in cur.fetchall()
-    ]
-    
-    # Combinar histórico + novos pontos
-    all_rows = historical_rows + new_rows
-    all_rows.sort(key=lambda r: _naive_local(r["data_evento"]))
-    
-    logging.info(f"[{placa}] Detectando com contexto: {len(historical_rows)} históricos + {len(new_rows)} novos")
-    
-    return detect_events_by_trend(cur, placa, all_rows)
-
-# Substitua a função detect_events_by_trend completa por esta versão:
-
-def detect_events_by_trend(cur, placa, rows):
-    finalizados = 0
-    state = "STABLE"
-    open_sess = None
-
-    # GEOfence/Retomar-Parado: trava detecção após sair do raio até parar
-    block_until_stopped = False
-    stop_since_t = None
-
-    trend_confirmation_count = 0
-    potential_sess_start = None
-    slow_conf_count = 0
-
-    MAX_STALE_TIME_MIN = int(os.getenv("MAX_STALE_TIME_MIN", "20"))
-    MAX_SESSION_DURATION_MIN = int(os.getenv("MAX_SESSION_DURATION_MIN", "90"))
-
-    # Retomar sessão se existir
-    cur.execute("""
-        SELECT id_sessao, tipo, inicio_em, nivel_inicio_pct, 
-               lat_inicio, lon_inicio, atualizado_em, nivel_fim_pct
-        FROM operacao.sessao_tanque
-        WHERE placa = %s AND fim_em IS NULL
-        ORDER BY inicio_em DESC
-        LIMIT 1
-    """, (placa,))
-    existing = cur.fetchone()
-    if existing:
-        sid, tipo, t0, nivel0, lat0, lon0, last_updated, last_nivel = existing
-        logging.info(f"[{placa}] Retomando sessão existente {sid} ({tipo}) iniciada em {t0}")
-        open_sess = {
-            "id": sid, "placa": placa, "tipo": tipo,
-            "t0": _naive_local(t0),
-            "nivel0": Decimal(str(nivel0)),
-            "last_touch_t": _naive_local(last_updated),
-            "last_nivel": Decimal(str(last_nivel)) if last_nivel else Decimal(str(nivel0)),
-            "point_count": 1,
-            "last_unique_nv": Decimal(str(last_nivel)) if last_nivel else Decimal(str(nivel0)),
-            "lat0": float(lat0) if lat0 is not None else None,
-            "lon0": float(lon0) if lon0 is not None else None,
-        }
-        state = "TRENDING_DOWN" if tipo == "DESCARGA" else "TRENDING_UP"
 
-    def _get_point_details(r):
+    def __init__(self, placa):
+        self.placa = placa
+        self.state = "STABLE"
+        self.open_sess = None
+        # GEOfence/Retomar-Parado: trava detecção após sair do raio até parar
+        self.block_until_stopped = False
+        self.stop_since_t = None
+        self.level_tracker = {"start_nv": None, "start_t": None, "start_id": None, "current_nv": None, "current_t": None}
+        self.ultimo = None         # (t, id_position) da última posição recebida
+        self.nv_anterior = None    # nível do último ponto válido (referência do anti-spike)
+        self.pendentes = deque()   # [ponto, nv_anterior, manter?]; None = ainda na janela do anti-spike
+        self._alteradas = {}       # id(sessão) -> sessão com escrita pendente (gravar_sessoes no fim do ciclo)
+
+    # ---------- estado ----------
+    _CAMPOS_ESTADO = ("state", "open_sess", "block_until_stopped", "stop_since_t",
+                      "level_tracker", "ultimo", "nv_anterior", "pendentes")
+
+    @classmethod
+    def carregar(cls, cur, placa):
+        """Snapshot salvo ou, na primeira vez, retomada da sessão aberta no banco (como o lote)."""
+        det = cls(placa)
+        cur.execute("SELECT estado FROM operacao.detector_estado WHERE placa = %s;", (placa,))
+        row = cur.fetchone()
+        if row is None:
+            det.retomar_sessao_aberta(cur)
+            return det
+        estado = _estado_de_json(row[0])
+        for campo in cls._CAMPOS_ESTADO:
+            setattr(det, campo, estado.get(campo))
+        det.ultimo = tuple(det.ultimo) if det.ultimo else None
+        det.pendentes = deque(det.pendentes or [])
+        if det.open_sess:
+            det.open_sess.setdefault("toque", None)
+            det.open_sess.setdefault("fim", None)
+        det._recuperar(cur)
+        return det
+
+    def gravar(self, cur):
+        """
+        Descarrega as escritas de sessão acumuladas (uma vez por ciclo, antes do snapshot).
+        Devolve os ids de sessão escritos (inclusive removidos).
+        """
+        if not self._alteradas: return []
+        recusadas, ids = gravar_sessoes(cur, list(self._alteradas.values()))
+        self._alteradas = {}
+        if self.open_sess is not None and any(s is self.open_sess for s in recusadas):
+            _LOG_DETECTOR.info(f"[{self.placa}] Sessão {self.open_sess['id'] or '(nova)'} ({self.open_sess['tipo']}) "
+                         f"recusada pelo banco (fechada por fora ou já existe outra aberta); detector volta a STABLE")
+            self.state = "STABLE"
+            self.open_sess = None
+        return ids
+
+    def _marcar(self, sess):
+        self._alteradas[id(sess)] = sess
+
+    def retirar_encerradas(self) -> list:
+        """Tira das escritas pendentes e devolve as sessões já encerradas; as abertas continuam pendentes."""
+        encerradas = [s for s in self._alteradas.values() if s["fim"] is not None]
+        self._alteradas = {k: s for k, s in self._alteradas.items() if s["fim"] is None}
+        return encerradas
+
+    def retirar_pendentes(self) -> list:
+        """Tira e devolve todas as escritas pendentes (abertas inclusive), sem gravar."""
+        pendentes, self._alteradas = list(self._alteradas.values()), {}
+        return pendentes
+
+    def salvar(self, cur):
+        estado = _estado_para_json({c: getattr(self, c) for c in self._CAMPOS_ESTADO})
+        cur.execute("""
+            INSERT INTO operacao.detector_estado (placa, estado, atualizado_em)
+            VALUES (%s, %s, now())
+            ON CONFLICT (placa) DO UPDATE SET estado = EXCLUDED.estado, atualizado_em = now();
+        """, (self.placa, json_dumps_bytes(estado).decode()))
+
+    def _recuperar(self, cur):
+        """
+        Posições gravadas depois do snapshot (queda entre o commit da carga e o da detecção), lidas
+        por cursor no servidor em lotes de ETL_LOTE_POSICOES: um atraso longo não vai inteiro à memória.
+        """
+        if not self.ultimo: return
+        t, idp = self.ultimo
+        leitor = cur.connection.cursor(name=f"recuperar_{self.placa}")
+        leitor.itersize = ETL_LOTE_POSICOES
+        total = 0
         try:
-            nv_raw = r.get("nivel_tanque_percent")
-            nv = Decimal(str(nv_raw)) if nv_raw is not None and nv_raw > 0 else None
-            return {
-                "t": _naive_local(r.get("data_evento")),
-                "nv": nv,
-                "lat": r.get("latitude"),
-                "lon": r.get("longitude"),
-                "v": r.get("velocidade_kmh"),
+            leitor.execute("""
+                SELECT id_position, data_evento, nivel_tanque_percent, latitude, longitude, velocidade_kmh
+                  FROM rastreio.posicao
+                 WHERE placa = %s AND (data_evento, id_position) > (%s, %s)
+                 ORDER BY data_evento, id_position
+            """, (self.placa, t.replace(tzinfo=LOCAL_TZ), idp))
+            while rows := leitor.fetchmany(ETL_LOTE_POSICOES):
+                total += len(rows)
+                self.processar(cur, [
+                    Posicao(id_position=r[0], placa=self.placa, data_evento=r[1], nivel_tanque_percent=r[2],
+                            latitude=r[3], longitude=r[4], velocidade_kmh=r[5])
+                    for r in rows
+                ])
+        finally:
+            leitor.close()
+        if total:
+            _LOG_DETECTOR.info(f"[{self.placa}] Detector retomado: {total} posições gravadas após o snapshot")
+
+    def retomar_sessao_aberta(self, cur):
+        cur.execute("""
+            SELECT id_sessao, tipo, inicio_em, nivel_inicio_pct, 
+                   lat_inicio, lon_inicio, atualizado_em, nivel_fim_pct, lat_fim, lon_fim
+            FROM operacao.sessao_tanque
+            WHERE placa = %s AND fim_em IS NULL
+            ORDER BY inicio_em DESC
+            LIMIT 1
+        """, (self.placa,))
+        existing = cur.fetchone()
+        if existing:
+            sid, tipo, t0, nivel0, lat0, lon0, last_updated, last_nivel, lat1, lon1 = existing
+            _LOG_DETECTOR.info(f"[{self.placa}] Retomando sessão existente {sid} ({tipo}) iniciada em {t0}")
+            self.open_sess = {
+                "id": sid, "placa": self.placa, "tipo": tipo,
+                "t0": _naive_local(t0),
+                "nivel0": Decimal(str(nivel0)),
+                "last_touch_t": _naive_local(last_updated),
+                "last_nivel": Decimal(str(last_nivel)) if last_nivel else Decimal(str(nivel0)),
+                "point_count": 1,
+                "last_unique_nv": Decimal(str(last_nivel)) if last_nivel else Decimal(str(nivel0)),
+                "lat0": float(lat0) if lat0 is not None else None,
+                "lon0": float(lon0) if lon0 is not None else None,
+                "lat1": float(lat1) if lat1 is not None else None,
+                "lon1": float(lon1) if lon1 is not None else None,
+                "toque": None, "fim": None,
             }
-        except (InvalidOperation, TypeError):
-            return {"t": r.get("data_evento"), "nv": None}
-
-    # 1) Filtrar pontos com nível válido (detecção independe de velocidade por enquanto)
-    valid_points = []
-    for r in rows:
-        p = _get_point_details(r)
-        if p["t"] is None or p["nv"] is None:
-            continue
-        valid_points.append(p)
-
-    if len(valid_points) < 3:
-        logging.debug(f"[{placa}] Apenas {len(valid_points)} pontos válidos")
-        return 0
-
-    logging.info(f"[{placa}] Analisando {len(valid_points)} pontos válidos")
-
-    # 2) Anti-spike mais brando (já existente)
-    def _is_spike_reversal(idx, pts, jump_pp, win_sec, tol_band):
-        if idx == 0 or idx >= len(pts): return False
-        prev = float(pts[idx-1]["nv"]); curr = float(pts[idx]["nv"])
-        if abs(curr - prev) < 10.0: return False  # mantém 10pp
-        t0 = pts[idx]["t"]; limit = t0 + timedelta(seconds=SPIKE_REV_WIN_SEC)
-        low, high = prev - SPIKE_TOL_BAND_PP, prev + SPIKE_TOL_BAND_PP
-        j = idx + 1
-        while j < len(pts) and pts[j]["t"] <= limit:
-            nvj = float(pts[j]["nv"])
-            if low <= nvj <= high:
-                return True
-            j += 1
-        return False
-
-    clean_points, dropped_spikes = [], 0
-    for i, p in enumerate(valid_points):
-        if _is_spike_reversal(i, valid_points, 10.0, SPIKE_REV_WIN_SEC, SPIKE_TOL_BAND_PP):
-            dropped_spikes += 1
-            continue
-        clean_points.append(p)
-    if dropped_spikes:
-        logging.info(f"[{placa}] Anti-spike removeu {dropped_spikes} pontos.")
-    valid_points = clean_points
-
-    time_window_all = deque()
-    LONG_WINDOW_SEC = 600
-
-    level_tracker = {"start_nv": None, "start_t": None, "current_nv": None, "current_t": None}
-
-    for idx, point in enumerate(valid_points):
+            self.state = "TRENDING_DOWN" if tipo == "DESCARGA" else "TRENDING_UP"
+
+    # ---------- entrada ----------
+    def processar(self, cur, rows):
+        """Posições novas, em ordem (data_evento, id_position); o que já foi visto é ignorado."""
+        novas, tempos = [], []
+        for r in rows:
+            t = _naive_local(r.data_evento)
+            if self.ultimo is not None and (t, r.id_position) <= self.ultimo:
+                continue
+            self.ultimo = (t, r.id_position)
+            novas.append(r)
+            tempos.append(t)
+        if self._vetorizar(len(novas)):
+            lote = _LoteVetorizado.de_linhas(novas, tempos)
+            if not len(lote):
+                return 0
+            _LOG_DETECTOR.info(f"[{self.placa}] Analisando {len(lote)} pontos válidos")
+            return self._alimentar_lote(cur, lote)
+        pontos = [p for p in map(_ponto_detector, novas) if p["t"] is not None and p["nv"] is not None]
+        if not pontos:
+            return 0
+        _LOG_DETECTOR.info(f"[{self.placa}] Analisando {len(pontos)} pontos válidos")
+        return self._alimentar(cur, pontos)
+
+    def drenar(self, cur):
+        """Processa os pontos retidos pelo anti-spike (fim dos dados) sem fechar a sessão aberta."""
+        finalizados = 0
+        for p in self._liberar(final=True):
+            finalizados += self._processar_ponto(cur, p)
+        return finalizados
+
+    def encerrar(self, cur):
+        """Fim da análise (uso em lote): libera os pendentes do anti-spike, fecha a sessão aberta e grava."""
+        finalizados = self.drenar(cur)
+        if self.open_sess:
+            _LOG_DETECTOR.info(f"[{self.placa}] Finalizando sessão aberta ao fim da análise")
+            finalizados += self._fechar_sessao(cur)
+        self.gravar(cur)
+        return finalizados
+
+    def _alimentar(self, cur, pontos):
+        finalizados, removidos = 0, 0
+        for p in pontos:
+            removidos += self._anti_spike(p)
+            for q in self._liberar(final=False):
+                finalizados += self._processar_ponto(cur, q)
+        if removidos:
+            _LOG_DETECTOR.info(f"[{self.placa}] Anti-spike removeu {removidos} pontos.")
+        return finalizados
+
+    # ---------- anti-spike ----------
+    def _anti_spike(self, point):
+        """
+        Mesmo critério do lote: ponto que salta >= 10pp do anterior e volta à faixa do anterior
+        (± SPIKE_TOL_BAND_PP) em até SPIKE_REV_WIN_SEC é descartado. A decisão depende de pontos
+        futuros, então o ponto fica pendente até a volta chegar ou a janela passar.
+        Devolve quantos pendentes foram descartados.
+        """
+        nv = float(point["nv"])
+        removidos = 0
+        for item in self.pendentes:
+            p, prev, manter = item
+            if manter is not None:
+                continue
+            if point["t"] > p["t"] + timedelta(seconds=SPIKE_REV_WIN_SEC):
+                item[2] = True
+            elif prev - SPIKE_TOL_BAND_PP <= nv <= prev + SPIKE_TOL_BAND_PP:
+                item[2] = False
+                removidos += 1
+        prev = self.nv_anterior
+        salto = prev is not None and abs(nv - prev) >= 10.0  # mantém 10pp
+        self.pendentes.append([point, prev, None if salto else True])
+        self.nv_anterior = nv
+        return removidos
+
+    def _liberar(self, final):
+        """Pontos decididos no início da fila, em ordem; no fim da análise o pendente fica (não voltou)."""
+        prontos = []
+        while self.pendentes and (final or self.pendentes[0][2] is not None):
+            p, _, manter = self.pendentes.popleft()
+            if manter is not False:
+                prontos.append(p)
+        return prontos
+
+    # ---------- máquina de estados ----------
+    def _fechar_sessao(self, cur, point=None):
+        """Finaliza (ou cancela, se inválida) a sessão aberta; com 'point', reinicia a base nele."""
+        self._marcar(self.open_sess)
+        n = finalizar_sessao_se_valida(self.open_sess)
+        self.state = "STABLE"
+        self.open_sess = None
+        if point is not None:
+            self.level_tracker = _nova_base(point)
+        return n
+
+    def _processar_ponto(self, cur, point):
+        placa = self.placa
         # GEOfence/Retomar-Parado: se estamos bloqueados, só liberamos ao detectar <= SPEED_STOP_MAX_KMH
-        if block_until_stopped:
+        if self.block_until_stopped:
             v = float(point.get("v") or 0)
             if v <= SPEED_STOP_MAX_KMH:
                 if RESUME_STOP_DWELL_SEC > 0:
-                    if stop_since_t is None:
-                        stop_since_t = point["t"]
-                    elif (point["t"] - stop_since_t).total_seconds() >= RESUME_STOP_DWELL_SEC:
-                        block_until_stopped = False
-                        stop_since_t = None
-                        level_tracker = {"start_nv": point["nv"], "start_t": point["t"], "current_nv": point["nv"], "current_t": point["t"]}
+                    if self.stop_since_t is None:
+                        self.stop_since_t = point["t"]
+                    elif (point["t"] - self.stop_since_t).total_seconds() >= RESUME_STOP_DWELL_SEC:
+                        self.block_until_stopped = False
+                        self.stop_since_t = None
+                        self.level_tracker = _nova_base(point)
                     else:
                         # ainda acumulando dwell parado
-                        continue
+                        return 0
                 else:
-                    block_until_stopped = False
-                    level_tracker = {"start_nv": point["nv"], "start_t": point["t"], "current_nv": point["nv"], "current_t": point["t"]}
+                    self.block_until_stopped = False
+                    self.level_tracker = _nova_base(point)
             # se ainda não parou, ignora esse ponto completamente
-            if block_until_stopped:
-                continue
-
-        # Atualiza janela longa
-        time_window_all.append((point["t"], float(point["nv"])))
-        while (time_window_all[-1][0] - time_window_all[0][0]).total_seconds() > LONG_WINDOW_SEC:
-            time_window_all.popleft()
+            if self.block_until_stopped:
+                return 0
 
+        level_tracker = self.level_tracker
         if level_tracker["start_nv"] is None:
             level_tracker["start_nv"] = point["nv"]
             level_tracker["start_t"] = point["t"]
+            level_tracker["start_id"] = point.get("id")
 
         level_tracker["current_nv"] = point["nv"]
         level_tracker["current_t"] = point["t"]
@@ -435,78 +1366,56 @@ def detect_events_by_trend(cur, placa, rows):
         time_elapsed = (level_tracker["current_t"] - level_tracker["start_t"]).total_seconds()
 
         # Abrir sessão ao detectar variação acumulada significativa
-        if abs(delta_accumulated) >= 3.0 and time_elapsed >= 120 and state == "STABLE":
+        if abs(delta_accumulated) >= 3.0 and time_elapsed >= 120 and self.state == "STABLE":
             tipo = "DESCARGA" if delta_accumulated < 0 else "COLETA"
-            logging.info(f"[{placa}] Tendência: {delta_accumulated:.2f}pp/{time_elapsed:.0f}s - Iniciando {tipo}")
-            sid = sessao_abrir(cur, placa, tipo, level_tracker["start_t"], level_tracker["start_nv"],
-                               point.get("lat"), point.get("lon"))
-            if sid:
-                open_sess = {
-                    "id": sid, "placa": placa, "tipo": tipo,
-                    "t0": level_tracker["start_t"],
-                    "nivel0": level_tracker["start_nv"],
-                    "last_touch_t": point["t"],
-                    "last_nivel": point["nv"],
-                    "point_count": 1,
-                    "last_unique_nv": point["nv"],
-                    "lat0": point.get("lat"),
-                    "lon0": point.get("lon"),
-                }
-                state = "TRENDING_DOWN" if tipo == "DESCARGA" else "TRENDING_UP"
-
+            _LOG_DETECTOR.info(f"[{placa}] Tendência: {delta_accumulated:.2f}pp/{time_elapsed:.0f}s - Iniciando {tipo}")
+            self.open_sess = sessao_nova(placa, tipo, level_tracker["start_t"], level_tracker["start_nv"],
+                                         point.get("lat"), point.get("lon"), level_tracker.get("start_id"))
+            self.open_sess.update({
+                "last_touch_t": point["t"],
+                "last_nivel": point["nv"],
+                "point_count": 1,
+                "last_unique_nv": point["nv"],
+            })
+            self._marcar(self.open_sess)
+            self.state = "TRENDING_DOWN" if tipo == "DESCARGA" else "TRENDING_UP"
+
+        open_sess = self.open_sess
         # Se há sessão aberta, tratar timeouts e GEOfence
         if open_sess:
             # GEOfence: se saiu do raio medido a partir do início, fecha/cancela e bloqueia até parar
             dist_m = _haversine_m(open_sess.get("lat0"), open_sess.get("lon0"), point.get("lat"), point.get("lon"))
             if dist_m > EXIT_RADIUS_M:
-                logging.warning(f"[{placa}] Saiu do raio de {EXIT_RADIUS_M} m (dist={dist_m:.1f} m). Finalizando sessão {open_sess['id']} e aguardando parada.")
-                finalizados += finalizar_sessao_se_valida(cur, open_sess)
-                state = "STABLE"
-                open_sess = None
-                block_until_stopped = True
-                stop_since_t = None
+                _LOG_DETECTOR.warning(f"[{placa}] Saiu do raio de {EXIT_RADIUS_M} m (dist={dist_m:.1f} m). Finalizando sessão {open_sess['id'] or '(nova)'} e aguardando parada.")
+                n = self._fechar_sessao(cur)
+                self.block_until_stopped = True
+                self.stop_since_t = None
                 # não reseta level_tracker aqui; só retomamos quando o veículo parar
-                continue
+                return n
 
             # Timeout de duração
             session_duration_min = (point["t"] - open_sess["t0"]).total_seconds() / 60
             if session_duration_min > MAX_SESSION_DURATION_MIN:
-                logging.warning(f"[{placa}] Sessão {open_sess['id']} > {MAX_SESSION_DURATION_MIN} min - forçando fechamento")
-                finalizados += finalizar_sessao_se_valida(cur, open_sess)
-                state = "STABLE"
-                open_sess = None
-                level_tracker = {"start_nv": point["nv"], "start_t": point["t"], "current_nv": point["nv"], "current_t": point["t"]}
-                continue
+                _LOG_DETECTOR.warning(f"[{placa}] Sessão {open_sess['id'] or '(nova)'} > {MAX_SESSION_DURATION_MIN} min - forçando fechamento")
+                return self._fechar_sessao(cur, point)
 
             # Timeout de “stale”
             if open_sess["last_touch_t"]:
                 stale_time_min = (point["t"] - open_sess["last_touch_t"]).total_seconds() / 60
                 if stale_time_min > MAX_STALE_TIME_MIN and abs(float(point["nv"] - open_sess["last_nivel"])) < 0.5:
-                    logging.warning(f"[{placa}] Sessão {open_sess['id']} sem variação por {stale_time_min:.1f} min - finalizando")
-                    finalizados += finalizar_sessao_se_valida(cur, open_sess)
-                    state = "STABLE"
-                    open_sess = None
-                    level_tracker = {"start_nv": point["nv"], "start_t": point["t"], "current_nv": point["nv"], "current_t": point["t"]}
-                    continue
+                    _LOG_DETECTOR.warning(f"[{placa}] Sessão {open_sess['id'] or '(nova)'} sem variação por {stale_time_min:.1f} min - finalizando")
+                    return self._fechar_sessao(cur, point)
 
             # Critérios de inversão
             delta_from_start = float(point["nv"] - open_sess["nivel0"])
             if open_sess["tipo"] == "DESCARGA":
                 if delta_from_start > 2.0:
-                    logging.info(f"[{placa}] DESCARGA interrompida (subiu {delta_from_start:.2f}pp)")
-                    finalizados += finalizar_sessao_se_valida(cur, open_sess)
-                    state = "STABLE"
-                    open_sess = None
-                    level_tracker = {"start_nv": point["nv"], "start_t": point["t"], "current_nv": point["nv"], "current_t": point["t"]}
-                    continue
+                    _LOG_DETECTOR.info(f"[{placa}] DESCARGA interrompida (subiu {delta_from_start:.2f}pp)")
+                    return self._fechar_sessao(cur, point)
             else:  # COLETA
                 if delta_from_start < -2.0:
-                    logging.info(f"[{placa}] COLETA interrompida (caiu {delta_from_start:.2f}pp)")
-                    finalizados += finalizar_sessao_se_valida(cur, open_sess)
-                    state = "STABLE"
-                    open_sess = None
-                    level_tracker = {"start_nv": point["nv"], "start_t": point["t"], "current_nv": point["nv"], "current_t": point["t"]}
-                    continue
+                    _LOG_DETECTOR.info(f"[{placa}] COLETA interrompida (caiu {delta_from_start:.2f}pp)")
+                    return self._fechar_sessao(cur, point)
 
             # Touch condicionado a “parado” (já existe a flag)
             should_touch = True
@@ -519,7 +1428,8 @@ def detect_events_by_trend(cur, placa, rows):
                     pass
 
             if should_touch:
-                sessao_touch(cur, open_sess["id"], point["t"], point["nv"], point.get("lat"), point.get("lon"))
+                sessao_touch(open_sess, point["t"], point["nv"], point.get("lat"), point.get("lon"), point.get("id"))
+                self._marcar(open_sess)
                 open_sess["last_touch_t"] = point["t"]
                 open_sess["last_nivel"] = point["nv"]
                 if point["nv"] != open_sess["last_unique_nv"]:
@@ -527,16 +1437,622 @@ def detect_events_by_trend(cur, placa, rows):
                     open_sess["last_unique_nv"] = point["nv"]
 
         # Sem sessão aberta: se já passou muito tempo desde o start do tracker, reinicie a base
-        elif not open_sess and time_elapsed > 300:
-            level_tracker = {"start_nv": point["nv"], "start_t": point["t"], "current_nv": point["nv"], "current_t": point["t"]}
+        elif time_elapsed > 300:
+            self.level_tracker = _nova_base(point)
+
+        return 0
+
+    # ---------- frente vetorizada (NumPy) ----------
+    # Mesmas decisões de _anti_spike/_processar_ponto, com o lote em arrays (_LoteVetorizado):
+    # o laço Python só para nos pontos onde algo acontece (abrir, fechar, liberar o geofence)
+    # e nos reinícios de base. Tempo em µs e nível em inteiro escalado: comparações exatas.
+    def _vetorizar(self, n):
+        return np is not None and DETECTOR_LOTE_VETORIZADO > 0 and n >= DETECTOR_LOTE_VETORIZADO
+
+    def _alimentar_lote(self, cur, lote):
+        antigos, novos, removidos = self._anti_spike_lote(lote)
+        finalizados = sum(self._processar_ponto(cur, p) for p in antigos)
+        finalizados += self._processar_lote(cur, novos)
+        if removidos:
+            _LOG_DETECTOR.info(f"[{self.placa}] Anti-spike removeu {removidos} pontos.")
+        return finalizados
+
+    def _anti_spike_lote(self, lote):
+        """
+        _anti_spike para o lote inteiro: só os saltos >= 10pp olham a janela à frente
+        (searchsorted no tempo). Devolve (pendentes antigos liberados, sub-lote mantido,
+        descartados); o que ainda está em julgamento vai para self.pendentes.
+        """
+        T, NV, n = lote.T, lote.NVf, len(lote)
+        janela = SPIKE_REV_WIN_SEC * _US
+        removidos = 0
+
+        def _volta(seg, prev):
+            return bool(np.any((seg >= prev - SPIKE_TOL_BAND_PP) & (seg <= prev + SPIKE_TOL_BAND_PP)))
+
+        # pendentes de ciclos anteriores: a janela deles continua nos pontos novos
+        for item in self.pendentes:
+            if item[2] is not None:
+                continue
+            fim = int(np.searchsorted(T, _epoch_us(item[0]["t"]) + janela, side="right"))
+            if _volta(NV[:fim], item[1]):
+                item[2] = False
+                removidos += 1
+            elif fim < n:
+                item[2] = True
+        antigos = self._liberar(final=False)
+
+        prevs = np.empty(n)
+        prevs[0] = np.nan if self.nv_anterior is None else self.nv_anterior
+        prevs[1:] = NV[:-1]
+        decisoes = [True] * n   # True = mantém, False = spike, None = janela ainda aberta
+        for k in np.flatnonzero(np.abs(NV - prevs) >= 10.0):  # mantém 10pp (NaN = sem anterior)
+            fim = int(np.searchsorted(T, T[k] + janela, side="right"))
+            if _volta(NV[k + 1:fim], prevs[k]):
+                decisoes[k] = False
+                removidos += 1
+            elif fim >= n:
+                decisoes[k] = None
+
+        # a fila só recebe a partir do 1º indeciso (ou tudo, se ainda há pendente antigo na frente)
+        aberto = 0 if self.pendentes else next((k for k, d in enumerate(decisoes) if d is None), n)
+        for k in range(aberto, n):
+            self.pendentes.append([lote.ponto(k), None if np.isnan(prevs[k]) else float(prevs[k]), decisoes[k]])
+        self.nv_anterior = float(NV[-1])
+        return antigos, lote.sub(np.flatnonzero(np.array(decisoes[:aberto], dtype=bool))), removidos
+
+    def _escala(self, NVf):
+        """
+        Menor número de casas (1..9) em que todos os níveis (lote + base/sessão) são decimais
+        exatos, ou None. Níveis vêm de float (API) ou do NUMERIC gravado a partir dele, então
+        float(n / 10**casas) == nível equivale ao Decimal; fora disso, fica o ponto a ponto.
+        """
+        extras = [self.level_tracker.get("start_nv")]
+        if self.open_sess:
+            extras += [self.open_sess[k] for k in ("nivel0", "last_nivel", "last_unique_nv")]
+        vals = np.concatenate([NVf, np.array([float(v) for v in extras if v is not None], dtype=np.float64)])
+        if not np.isfinite(vals).all():
+            return None
+        for casas in range(1, 10):
+            S = 10 ** casas
+            if np.array_equal(np.rint(vals * S) / S, vals):
+                return casas
+        return None
+
+    def _processar_lote(self, cur, lote):
+        n = len(lote)
+        casas = self._escala(lote.NVf) if n else None
+        if casas is None:
+            return sum(self._processar_ponto(cur, lote.ponto(k)) for k in range(n))
+
+        S = 10 ** casas
+        esc = lambda d: int(np.rint(float(d) * S))
+        T = lote.T
+        NV = np.rint(lote.NVf * S).astype(np.int64)
+        PARADO = lote.V <= SPEED_STOP_MAX_KMH
+        TOCA = PARADO if TOUCH_ONLY_WHEN_STOPPED else np.ones(n, dtype=bool)
+        NXT = np.searchsorted(T, T + 300 * _US, side="right").tolist()   # reinício da base após cada ponto
+
+        finalizados, i = 0, 0
+        while i < n:
+            if self.block_until_stopped:
+                j = self._ponto_liberacao(lote, PARADO, i)
+                if j is None:
+                    break
+                self.block_until_stopped = False
+                self.stop_since_t = None
+                self.level_tracker = _nova_base(lote.ponto(j))
+                i = j
+
+            if self.open_sess is None:
+                k = self._trecho_estavel(lote, NV, NXT, S, esc, i)
+                if k is None:
+                    break
+                self._abrir_sessao(lote.ponto(k))
+                i = k   # o ponto de abertura também passa pelas regras da sessão
+
+            i, n_fin = self._trecho_sessao(cur, lote, NV, TOCA, S, esc, i)
+            finalizados += n_fin
+        return finalizados
+
+    def _trecho_estavel(self, lote, NV, NXT, S, esc, i):
+        """
+        Sem sessão: a base do level_tracker reinicia no 1º ponto com > 300 s desde ela, então a
+        cadeia de bases só depende do tempo (NXT). Com as bases de cada ponto em arrays, a
+        abertura (|Δ| >= 3pp e >= 120 s) é o 1º True da máscara. Devolve o índice da abertura
+        (base já ajustada) ou None se o lote acaba estável.
+        """
+        T, n = lote.T, len(lote)
+        lt = self.level_tracker
+        if lt["start_nv"] is None:
+            p = lote.ponto(i)
+            lt["start_nv"], lt["start_t"], lt["start_id"] = p["nv"], p["t"], p.get("id")
+        base_t, base_nv, base_k = _epoch_us(lt["start_t"]), esc(lt["start_nv"]), None
+        pos, janela = i, 256
+        while pos < n:
+            hi = min(n, pos + janela)
+            janela = min(janela * 2, 16384)   # aberturas costumam estar perto: janela cresce aos poucos
+            r = max(pos, int(np.searchsorted(T, base_t + 300 * _US, side="right")))
+            bases, fins = [(base_t, base_nv, base_k)], [min(r, hi - 1)]
+            while r < hi - 1:
+                bases.append((int(T[r]), int(NV[r]), r))
+                r = NXT[r]
+                fins.append(min(r, hi - 1))
+            tam = np.diff(np.array([pos - 1] + fins))
+            bt = np.repeat(np.array([b[0] for b in bases], dtype=np.int64), tam)
+            bn = np.repeat(np.array([b[1] for b in bases], dtype=np.int64), tam)
+            abre = (np.abs(NV[pos:hi] - bn) >= 3 * S) & (T[pos:hi] - bt >= 120 * _US)
+            if abre.any():
+                k = pos + int(np.argmax(abre))
+                seg = int(np.searchsorted(np.array(fins), k))   # segmento (base) do ponto k
+                if bases[seg][2] is not None:
+                    self.level_tracker = _nova_base(lote.ponto(bases[seg][2]))
+                return k
+            if r == hi - 1 and T[r] > bases[-1][0] + 300 * _US:
+                bases.append((int(T[r]), int(NV[r]), r))   # o último ponto da janela também reinicia
+            base_t, base_nv, base_k = bases[-1]
+            pos = hi
+        if base_k is not None:
+            self.level_tracker = _nova_base(lote.ponto(base_k))
+        p = lote.ponto(n - 1)
+        self.level_tracker["current_nv"], self.level_tracker["current_t"] = p["nv"], p["t"]
+        return None
+
+    def _ponto_liberacao(self, lote, PARADO, i):
+        """Índice do ponto que libera o bloqueio do geofence (None = segue bloqueado no lote)."""
+        parados = np.flatnonzero(PARADO[i:]) + i
+        if RESUME_STOP_DWELL_SEC <= 0:
+            return int(parados[0]) if len(parados) else None
+        if self.stop_since_t is None:
+            if not len(parados):
+                return None
+            self.stop_since_t = lote.ponto(int(parados[0]))["t"]
+            parados = parados[1:]
+        ok = parados[lote.T[parados] - _epoch_us(self.stop_since_t) >= RESUME_STOP_DWELL_SEC * _US]
+        return int(ok[0]) if len(ok) else None
+
+    def _abrir_sessao(self, point):
+        lt = self.level_tracker
+        lt["current_nv"], lt["current_t"] = point["nv"], point["t"]
+        delta_accumulated = float(lt["current_nv"] - lt["start_nv"])
+        time_elapsed = (lt["current_t"] - lt["start_t"]).total_seconds()
+        tipo = "DESCARGA" if delta_accumulated < 0 else "COLETA"
+        _LOG_DETECTOR.info(f"[{self.placa}] Tendência: {delta_accumulated:.2f}pp/{time_elapsed:.0f}s - Iniciando {tipo}")
+        self.open_sess = sessao_nova(self.placa, tipo, lt["start_t"], lt["start_nv"], point.get("lat"), point.get("lon"),
+                                     lt.get("start_id"))
+        self.open_sess.update({
+            "last_touch_t": point["t"],
+            "last_nivel": point["nv"],
+            "point_count": 1,
+            "last_unique_nv": point["nv"],
+        })
+        self._marcar(self.open_sess)
+        self.state = "TRENDING_DOWN" if tipo == "DESCARGA" else "TRENDING_UP"
+
+    def _trecho_sessao(self, cur, lote, NV, TOCA, S, esc, i):
+        """
+        Sessão aberta a partir do ponto i: acha o 1º ponto que a fecha (geofence, duração,
+        stale, inversão, nessa prioridade), aplica os toques anteriores de uma vez e fecha.
+        Devolve (próximo índice, finalizadas).
+        """
+        placa, s, n, T = self.placa, self.open_sess, len(lote), lote.T
+        t0 = _epoch_us(s["t0"])
+        limite = max(i, int(np.searchsorted(T, t0 + MAX_SESSION_DURATION_MIN * 60 * _US, side="right")))
+        hi = min(limite + 1, n)
+        Ts, NVs, toca = T[i:hi], NV[i:hi], TOCA[i:hi]
+        m = hi - i
+
+        # GEOfence: candidatos pelo NumPy, confirmação com a mesma função do laço ponto a ponto
+        geo = None
+        if s.get("lat0") is None or s.get("lon0") is None:
+            geo = 0
+        else:
+            dist = _haversine_np(float(s["lat0"]), float(s["lon0"]), lote.LAT[i:hi], lote.LON[i:hi])
+            for c in np.flatnonzero(~(dist <= EXIT_RADIUS_M - 1e-6)):
+                p = lote.ponto(i + int(c))
+                if _haversine_m(s["lat0"], s["lon0"], p.get("lat"), p.get("lon")) > EXIT_RADIUS_M:
+                    geo = int(c)
+                    break
+        dur = (Ts - t0) > MAX_SESSION_DURATION_MIN * 60 * _US
+
+        # último toque ANTES de cada ponto (ou o da sessão, se ainda não houve toque no lote)
+        ant = np.empty(m, dtype=np.int64)
+        ant[0] = -1
+        ant[1:] = np.maximum.accumulate(np.where(toca, np.arange(m), -1))[:-1]
+        lt_t = np.where(ant >= 0, Ts[np.maximum(ant, 0)], _epoch_us(s["last_touch_t"]))
+        lt_nv = np.where(ant >= 0, NVs[np.maximum(ant, 0)], esc(s["last_nivel"]))
+        stale = ((Ts - lt_t) > MAX_STALE_TIME_MIN * 60 * _US) & (2 * np.abs(NVs - lt_nv) < S)
+        n0 = esc(s["nivel0"])
+        inv = (NVs - n0 > 2 * S) if s["tipo"] == "DESCARGA" else (NVs - n0 < -2 * S)
+
+        primeiros = [geo] + [int(np.argmax(mk)) if mk.any() else None for mk in (dur, stale, inv)]
+        evento = min((e for e in primeiros if e is not None), default=None)
+        ate = m if evento is None else evento
+
+        # toques entre i e o evento, em bloco
+        tocados = np.flatnonzero(toca[:ate])
+        if len(tocados):
+            vals = NVs[tocados]
+            prev = np.empty(len(vals), dtype=np.int64)
+            prev[0] = esc(s["last_unique_nv"])
+            prev[1:] = vals[:-1]
+            mudou = vals != prev
+            ult = lote.ponto(i + int(tocados[-1]))
+            sessao_touch(s, ult["t"], ult["nv"], ult.get("lat"), ult.get("lon"), ult.get("id"))
+            self._marcar(s)
+            s["last_touch_t"] = ult["t"]
+            s["last_nivel"] = ult["nv"]
+            if mudou.any():
+                s["point_count"] += int(mudou.sum())
+                s["last_unique_nv"] = lote.ponto(i + int(tocados[np.flatnonzero(mudou)[-1]]))["nv"]
+
+        p = lote.ponto(i + (ate - 1 if evento is None else evento))
+        self.level_tracker["current_nv"], self.level_tracker["current_t"] = p["nv"], p["t"]
+        if evento is None:
+            return hi, 0
+
+        if evento == geo:
+            dist_m = _haversine_m(s.get("lat0"), s.get("lon0"), p.get("lat"), p.get("lon"))
+            _LOG_DETECTOR.warning(f"[{placa}] Saiu do raio de {EXIT_RADIUS_M} m (dist={dist_m:.1f} m). Finalizando sessão {s['id'] or '(nova)'} e aguardando parada.")
+            n_fin = self._fechar_sessao(cur)
+            self.block_until_stopped = True
+            self.stop_since_t = None
+        elif dur[evento]:
+            _LOG_DETECTOR.warning(f"[{placa}] Sessão {s['id'] or '(nova)'} > {MAX_SESSION_DURATION_MIN} min - forçando fechamento")
+            n_fin = self._fechar_sessao(cur, p)
+        elif stale[evento]:
+            stale_time_min = (p["t"] - s["last_touch_t"]).total_seconds() / 60
+            _LOG_DETECTOR.warning(f"[{placa}] Sessão {s['id'] or '(nova)'} sem variação por {stale_time_min:.1f} min - finalizando")
+            n_fin = self._fechar_sessao(cur, p)
+        else:
+            delta_from_start = float(p["nv"] - s["nivel0"])
+            if s["tipo"] == "DESCARGA":
+                _LOG_DETECTOR.info(f"[{placa}] DESCARGA interrompida (subiu {delta_from_start:.2f}pp)")
+            else:
+                _LOG_DETECTOR.info(f"[{placa}] COLETA interrompida (caiu {delta_from_start:.2f}pp)")
+            n_fin = self._fechar_sessao(cur, p)
+        return i + evento + 1, n_fin
+
+class _LoteVetorizado:
+    """
+    Pontos válidos de um lote do detector em arrays NumPy (tempo em µs, nível, lat/lon,
+    velocidade), montados direto das Posicao. O dict do ponto (_ponto_detector) só é criado
+    onde o detector guarda estado: base, sessão, toque final, pendentes do anti-spike.
+    """
+
+    def __init__(self, rows, tempos, T, NVf, LAT, LON, V):
+        self.rows, self.tempos = rows, tempos
+        self.T, self.NVf, self.LAT, self.LON, self.V = T, NVf, LAT, LON, V
+        self._pontos = {}
+
+    @classmethod
+    def de_linhas(cls, rows, tempos):
+        niveis = []
+        for r in rows:
+            nv = r.nivel_tanque_percent
+            try:
+                niveis.append(float(nv) if nv is not None and nv > 0 else np.nan)
+            except (InvalidOperation, TypeError, ValueError):
+                niveis.append(np.nan)
+        NVf = np.array(niveis, dtype=np.float64)
+        sel = np.flatnonzero((NVf > 0) & np.array([t is not None for t in tempos], dtype=bool))
+        rows = [rows[k] for k in sel]
+        tempos = [tempos[k] for k in sel]
+        n = len(rows)
+        return cls(
+            rows, tempos,
+            np.fromiter(((t - _EPOCH_NAIVE) // _UM_US for t in tempos), dtype=np.int64, count=n),
+            NVf[sel],
+            np.array([np.nan if r.latitude is None else float(r.latitude) for r in rows], dtype=np.float64),
+            np.array([np.nan if r.longitude is None else float(r.longitude) for r in rows], dtype=np.float64),
+            np.fromiter((float(r.velocidade_kmh or 0) for r in rows), dtype=np.float64, count=n),
+        )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def ponto(self, k):
+        p = self._pontos.get(k)
+        if p is None:
+            p = self._pontos[k] = _ponto_detector(self.rows[k])
+        return p
+
+    def sub(self, idx):
+        return _LoteVetorizado([self.rows[k] for k in idx], [self.tempos[k] for k in idx],
+                               self.T[idx], self.NVf[idx], self.LAT[idx], self.LON[idx], self.V[idx])
+
+_DETECTORES = {}   # placa -> DetectorTendencia, vivo entre ciclos
+
+def detector_da_placa(cur, placa):
+    det = _DETECTORES.get(placa)
+    if det is None:
+        det = _DETECTORES[placa] = DetectorTendencia.carregar(cur, placa)
+    return det
+
+def detect_events_by_trend(cur, placa, rows):
+    """Versão em lote: analisa 'rows' do zero (retomando a sessão aberta no banco) e fecha ao fim."""
+    det = DetectorTendencia(placa)
+    det.retomar_sessao_aberta(cur)
+    if det._vetorizar(len(rows)):
+        pontos = _LoteVetorizado.de_linhas(rows, [_naive_local(r.data_evento) for r in rows])
+    else:
+        pontos = [p for p in map(_ponto_detector, rows) if p["t"] is not None and p["nv"] is not None]
+    if len(pontos) < 3:
+        _LOG_DETECTOR.debug(f"[{placa}] Apenas {len(pontos)} pontos válidos")
+        return 0
+    _LOG_DETECTOR.info(f"[{placa}] Analisando {len(pontos)} pontos válidos")
+    alimentar = det._alimentar_lote if isinstance(pontos, _LoteVetorizado) else det._alimentar
+    return alimentar(cur, pontos) + det.encerrar(cur)
+
+# ====================== Parsing do HistoryPosition ======================
+@dataclass(slots=True)
+class Posicao:
+    """Uma posição pronta para gravar (colunas de rastreio.posicao + EventDate original da API)."""
+    id_position: int
+    placa: str
+    data_evento: datetime
+    evento_api: datetime = None        # EventDate aware/UTC: ordenação do lote e cursor de paginação
+    id_event: int = None
+    ignicao: bool = None
+    valid_gps: bool = None
+    data_atualizacao: datetime = None
+    latitude: float = None
+    longitude: float = None
+    velocidade_kmh: float = None
+    inputs: bytes = None               # JSONB já serializado (json_dumps_bytes)
+    outputs: bytes = None
+    telemetria: bytes = None
+    nivel_tanque_percent: float = None
+    raw: bytes | str = None
+
+def _posicao_de_item(placa, item, raw_txt):
+    """Item do HistoryPosition -> Posicao; cada data é interpretada uma única vez."""
+    try:
+        idp = int(item["IdPosition"])
+        evento_api = _api_dt_utc(item.get("EventDate"))
+        upd = item.get("UpdateDate")
+        tele = item.get("ListTelemetry") or {}
+        nivel_raw = item.get("PercentageLevelTank")
+        if nivel_raw is None and isinstance(tele, dict):
+            nivel_raw = tele.get("304")
+        vel = item.get("SpeedKmh")
+        if vel is None:
+            vel = item.get("Speed")
+        return Posicao(
+            id_position=idp, placa=placa, id_event=item.get("IdEvent"),
+            ignicao=item.get("Ignition"), valid_gps=item.get("ValidGPS"),
+            evento_api=evento_api, data_evento=_utc_to_db_ts(evento_api),
+            data_atualizacao=_to_db_ts(upd) if upd else None,
+            latitude=item.get("Latitude"), longitude=item.get("Longitude"),
+            inputs=json_dumps_bytes(item.get("ListInputSensor") or {}),
+            outputs=json_dumps_bytes(item.get("ListOutputActuator") or {}),
+            telemetria=json_dumps_bytes(tele),
+            nivel_tanque_percent=float(nivel_raw) if nivel_raw is not None else None,
+            velocidade_kmh=float(vel) if vel is not None else None,
+            raw=raw_txt,
+        )
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        logging.warning(f"Erro ao processar item para {placa}: {e} - Item: {str(item)[:200]}")
+        return None
+
+_JSON_DECODER = json.JSONDecoder()
+_JSON_SEPARADORES = re.compile(r"[\s,]*")
+_JSON_FIM_ITEM = re.compile(r"\s*[,\]]")
+# caminho orjson (bytes): o fim de um objeto é o '}' seguido de ',' ou ']' (_JSON_FIM_OBJETO_B) em que o
+# nível de chaves, contado de forma incremental desde o início do item, volta a zero; só aí o trecho vai ao
+# orjson.loads, uma vez. Se ele recusar (chave dentro de string desequilibrou a contagem), o item é varrido
+# de novo pulando strings inteiras (_JSON_TRECHO_B), como os arrays. Strings vão até a aspa final e
+# números/literais até o próximo ',', ']' ou espaço. O que o orjson recusa e o json aceita (NaN, Infinity)
+# cai no _JSON_DECODER.
+_JSON_SEPARADORES_B = re.compile(rb"[\s,]*")
+_JSON_FIM_OBJETO_B = re.compile(rb"\}(?=\s*[,\]])")
+_JSON_TRECHO_B = re.compile(rb'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+_JSON_STRING_B = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_JSON_ESCALAR_B = re.compile(rb'[^,\]\s]+')
+
+def _orjson_item(trecho: bytes):
+    try:
+        return orjson.loads(trecho)
+    except orjson.JSONDecodeError:
+        return _JSON_DECODER.decode(trecho.decode("utf-8"))
+
+class LeitorPaginaPosicoes:
+    """
+    Decodificador da resposta do HistoryPosition (array JSON), alimentado em pedaços
+    (iter_content / iter_chunked). 'total' conta os itens recebidos (inclusive os
+    descartados), usado contra o SOFT_CAP.
+    Nos dois backends cada item sai assim que fecha e o trecho original dele vira a coluna
+    'raw', sem re-serializar:
+    - stdlib: texto decodificado incrementalmente, item a item com raw_decode;
+    - orjson: direto nos bytes; cada item é o trecho até a chave/colchete que fecha o nível
+      dele, decodificado uma vez (a varredura de um item incompleto continua no próximo pedaço).
+    """
 
-    # Finalização no fim da análise
-    if open_sess:
-        logging.info(f"[{placa}] Finalizando sessão aberta ao fim da análise")
-        finalizados += finalizar_sessao_se_valida(cur, open_sess)
+    def __init__(self, placa):
+        self.placa = placa
+        self.total = 0
+        self._bytes = JSON_BACKEND == "orjson"
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buf = b"" if self._bytes else ""
+        self._varredura = None   # (exata, deslocamento, nível) do item incompleto no caminho orjson
+        self._estado = "inicio"   # inicio | array | fim | outro (resposta que não é array)
+
+    def feed(self, chunk: bytes) -> list:
+        if self._bytes:
+            self._buf += chunk
+            return self._drenar_bytes(final=False)
+        self._buf += self._utf8.decode(chunk)
+        return self._drenar(final=False)
+
+    def close(self) -> list:
+        if self._bytes:
+            return self._drenar_bytes(final=True)
+        self._buf += self._utf8.decode(b"", final=True)
+        return self._drenar(final=True)
+
+    def _emitir(self, obj, raw_txt, out):
+        self.total += 1
+        rec = _posicao_de_item(self.placa, obj, raw_txt)
+        if rec is not None:
+            out.append(rec)
+
+    def _drenar(self, final: bool) -> list:
+        out, buf = [], self._buf
+        i = _JSON_SEPARADORES.match(buf, 0).end() if self._estado == "inicio" else 0
+        if self._estado == "inicio" and i < len(buf):
+            if buf[i] == "[":
+                self._estado, i = "array", i + 1
+            else:
+                self._estado = "outro"
+        if self._estado == "array":
+            while True:
+                i = _JSON_SEPARADORES.match(buf, i).end()
+                if i >= len(buf):
+                    break
+                if buf[i] == "]":
+                    self._estado, i = "fim", len(buf)
+                    break
+                try:
+                    obj, fim = _JSON_DECODER.raw_decode(buf, i)
+                except JSONDecodeError:
+                    if final: raise
+                    break  # item ainda incompleto: aguarda o próximo pedaço
+                if not final and _JSON_FIM_ITEM.match(buf, fim) is None:
+                    break  # número cortado ('-2' de '-2.5e3'): o item só fecha com ',' ou ']' depois
+                self._emitir(obj, buf[i:fim], out)
+                i = fim
+            self._buf = buf[i:]
+        elif self._estado == "fim":
+            self._buf = ""
+        elif self._estado == "outro" and final:
+            # null / objeto / texto vazio: mesmo tratamento de 'resp.json() or []'
+            dados = json_loads(buf) if buf.strip() else None
+            for obj in (dados if isinstance(dados, list) else []):
+                self._emitir(obj, json_dumps_bytes(obj), out)
+            self._buf = ""
+        elif self._estado == "inicio":
+            self._buf = buf[i:]
+        if final and self._estado == "array":
+            raise JSONDecodeError("Array JSON incompleto", buf, 0)
+        return out
+
+    def _item_bytes(self, buf, i, final=False):
+        """(fim exclusivo, objeto) do item que começa em buf[i], ou None se ele ainda não chegou inteiro."""
+        if buf[i] == 0x22:   # string: completa quando a aspa final chegou
+            m = _JSON_STRING_B.match(buf, i)
+            return None if m is None else (m.end(), _orjson_item(buf[i:m.end()]))
+        if buf[i] not in b"{[":   # número/literal: só fecha com o separador depois
+            m = _JSON_ESCALAR_B.match(buf, i)
+            if m.end() >= len(buf):
+                return None
+            return m.end(), _orjson_item(buf[i:m.end()])
+        exata, desloc, nivel = self._varredura or (buf[i] == 0x5B, 0, 0)
+        j = i + desloc
+        while not exata:
+            m = _JSON_FIM_OBJETO_B.search(buf, j)
+            if m is None:
+                if final:
+                    exata, j, nivel = True, i, 0
+                    break
+                self._varredura = (False, j - i, nivel)
+                return None
+            nivel += buf.count(b"{", j, m.end()) - buf.count(b"}", j, m.end())
+            j = m.end()
+            if nivel < 0:
+                exata, j, nivel = True, i, 0
+            elif nivel == 0:
+                try:
+                    self._varredura = None
+                    return j, orjson.loads(buf[i:j])
+                except orjson.JSONDecodeError:
+                    exata, j, nivel = True, i, 0
+        while True:
+            j = _JSON_TRECHO_B.match(buf, j).end()
+            if j >= len(buf) or buf[j] == 0x22:   # acabou o buffer ou string sem fechar
+                self._varredura = (True, j - i, nivel)
+                return None
+            nivel += 1 if buf[j] in b"{[" else -1
+            j += 1
+            if nivel == 0:
+                self._varredura = None
+                return j, _orjson_item(buf[i:j])
+
+    def _drenar_bytes(self, final: bool) -> list:
+        out, buf = [], self._buf
+        i = _JSON_SEPARADORES_B.match(buf, 0).end() if self._estado == "inicio" else 0
+        if self._estado == "inicio" and i < len(buf):
+            if buf[i] == 0x5B:   # [
+                self._estado, i = "array", i + 1
+            else:
+                self._estado = "outro"
+        if self._estado == "array":
+            while True:
+                i = _JSON_SEPARADORES_B.match(buf, i).end()
+                if i >= len(buf):
+                    break
+                if buf[i] == 0x5D:   # ]
+                    self._estado, i = "fim", len(buf)
+                    break
+                item = self._item_bytes(buf, i, final)
+                if item is None:
+                    if not final:
+                        break  # item ainda incompleto: aguarda o próximo pedaço
+                    orjson.loads(buf[i:])   # truncado/inválido: o orjson aponta o erro
+                    raise JSONDecodeError("Array JSON incompleto", buf.decode("utf-8", "replace"), i)
+                fim, obj = item
+                self._emitir(obj, buf[i:fim], out)
+                i = fim
+            self._buf = buf[i:]
+        elif self._estado == "fim":
+            self._buf = b""
+        elif self._estado == "outro" and final:
+            # null / objeto / texto vazio: mesmo tratamento de 'resp.json() or []'
+            dados = orjson.loads(buf) if buf.strip() else None
+            for obj in (dados if isinstance(dados, list) else []):
+                self._emitir(obj, orjson.dumps(obj), out)
+            self._buf = b""
+        elif self._estado == "inicio":
+            self._buf = buf[i:]
+        if final and self._estado == "array":
+            raise JSONDecodeError("Array JSON incompleto", buf.decode("utf-8", "replace"), 0)
+        return out
 
-    return finalizados
 # ====================== HTTP / API ======================
+class LimitadorTaxa:
+    """Token bucket compartilhado entre threads: limita as chamadas à API (req/s)."""
+
+    def __init__(self, taxa_por_seg: float, rajada: int = 1):
+        self.taxa = taxa_por_seg
+        self.rajada = rajada
+        self._fichas = float(rajada)
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reservar(self) -> float:
+        """Consome uma ficha e devolve 0, ou devolve quanto esperar antes de tentar de novo."""
+        with self._lock:
+            agora = time.monotonic()
+            self._fichas = min(self.rajada, self._fichas + (agora - self._ultimo) * self.taxa)
+            self._ultimo = agora
+            if self._fichas >= 1:
+                self._fichas -= 1
+                return 0.0
+            return (1 - self._fichas) / self.taxa
+
+    def aguardar(self):
+        if self.taxa <= 0:
+            return
+        while (espera := self._reservar()) > 0:
+            time.sleep(espera)
+
+    async def aguardar_async(self):
+        if self.taxa <= 0:
+            return
+        while (espera := self._reservar()) > 0:
+            await asyncio.sleep(espera)
+
+_LIMITADOR_API = LimitadorTaxa(API_RATE_LIMIT_RPS, API_RATE_LIMIT_BURST)
+
 def _log_http_debug(resp, label="HTTP"):
     if not DEBUG_HTTP: return
     ctype = (resp.headers.get("Content-Type") or "").lower()
@@ -547,36 +2063,1145 @@ def _log_http_debug(resp, label="HTTP"):
         f"req_len={req_body_len} resp_len={len(resp.content)} body^300={body_preview!r}"
     )
 
-def login():
-    url = _build_url(API_BASE_URL, AUTH_LOGIN_PATH)
-    params = {AUTH_QUERY_USER_KEY: AUTH_USER, AUTH_QUERY_PASS_KEY: AUTH_PASS}
-    if AUTH_QUERY_HASH_KEY and AUTH_HASH:
-        params[AUTH_QUERY_HASH_KEY] = AUTH_HASH
+class ApiClient:
+    """
+    Cliente da API de rastreamento compartilhado por todos os workers.
+    - requests.Session com pool de conexões keep-alive (sem handshake TCP/TLS por página);
+    - token em cache com expiração; 401/403 invalida o token usado e só UMA thread reloga;
+    - retry com backoff exponencial + jitter, respeitando Retry-After (429/503).
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, limitador: LimitadorTaxa):
+        self.limitador = limitador
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=API_POOL_MAXSIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip, deflate"})
+        self._token = None
+        self._token_expira = 0.0
+        self._lock = threading.Lock()
+        self.relogins = 0
+
+    # ---------- autenticação ----------
+    def _login(self):
+        url = _build_url(API_BASE_URL, AUTH_LOGIN_PATH)
+        params = {AUTH_QUERY_USER_KEY: AUTH_USER, AUTH_QUERY_PASS_KEY: AUTH_PASS}
+        if AUTH_QUERY_HASH_KEY and AUTH_HASH:
+            params[AUTH_QUERY_HASH_KEY] = AUTH_HASH
+
+        self.limitador.aguardar()
+        if AUTH_METHOD == "GET_PARAMS":
+            resp = self.session.get(url, params=params, timeout=30)
+        elif AUTH_METHOD == "POST_FORM":
+            resp = self.session.post(url, data=params, timeout=30)
+        else:  # POST_PARAMS
+            resp = self.session.post(url, params=params, timeout=30)
+
+        if not (200 <= resp.status_code < 300):
+            raise RuntimeError(f"Login HTTP {resp.status_code}: {resp.text[:200]!r}")
+
+        ttl = API_TOKEN_TTL_SEC
+        try:
+            data = resp.json()
+            token = data.get("AccessToken") if isinstance(data, dict) else str(data)
+            if isinstance(data, dict) and data.get("ExpiresIn"):
+                ttl = int(data["ExpiresIn"])
+        except JSONDecodeError:
+            token = resp.text.strip()
+        except (TypeError, ValueError):
+            pass
+
+        if not token or "<" in token:
+            raise RuntimeError(f"Token inválido recebido: {token[:120]!r}")
+        return token, ttl
+
+    def token(self) -> str:
+        """Token válido em cache; reloga (uma thread só) quando expira ou foi invalidado."""
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._token_expira:
+                token, ttl = self._login()
+                self._token = token
+                # margem para não usar token no limiar da expiração
+                self._token_expira = time.monotonic() + max(30, ttl - 60)
+                self.relogins += 1
+                METRICAS.contar("etl_api_logins_total")
+                logging.info(f"Login na API efetuado (token válido por ~{ttl}s).")
+            return self._token
+
+    def invalidar(self, token_usado: str):
+        """Descarta o token se ainda for o que falhou (outra thread pode já ter relogado)."""
+        with self._lock:
+            if self._token == token_usado:
+                self._token = None
+
+    # ---------- retry ----------
+    @staticmethod
+    def _espera_retry(tentativa: int, resp=None) -> float:
+        if resp is not None:
+            retry_after = resp.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(API_BACKOFF_MAX_SEC, max(0.0, float(retry_after)))
+                except ValueError:
+                    try:
+                        quando = parsedate_to_datetime(retry_after)
+                        return min(API_BACKOFF_MAX_SEC, max(0.0, (quando - datetime.now(timezone.utc)).total_seconds()))
+                    except (TypeError, ValueError):
+                        pass
+        # "full jitter": espalha os retries dos workers em vez de sincronizá-los
+        return random.uniform(0, min(API_BACKOFF_MAX_SEC, API_BACKOFF_BASE_SEC * (2 ** tentativa)))
+
+    # ---------- endpoints ----------
+    def list_positions(self, placa: str, dt_ini: datetime, dt_fim: datetime, falhar=False) -> tuple[list, int]:
+        """
+        Uma página do HistoryPosition: (registros Posicao, total de itens recebidos).
+        Esgotadas as tentativas devolve ([], 0), igual a uma janela vazia; com falhar=True levanta o erro.
+        """
+        url = _build_url(API_BASE_URL, GET_LAST_POSITIONS_PATH)
+        body = {
+            "TrackedUnitType": 1,
+            "TrackedUnitIntegrationCode": placa,
+            "StartDatePosition": _to_iso_z(dt_ini),
+            "EndDatePosition": _to_iso_z(dt_fim),
+        }
+        if CLIENT_INTEGRATION_CODE:
+            body["ClientIntegrationCode"] = str(CLIENT_INTEGRATION_CODE)
+
+        relogou, erro = False, None
+        for tentativa in range(API_MAX_TENTATIVAS):
+            resp = None
+            try:
+                token = self.token()
+                headers = {AUTH_HEADER_NAME: AUTH_HEADER_TEMPLATE.format(token=token)}
+                self.limitador.aguardar()
+                with self.session.post(url, json=body, headers=headers, timeout=120, stream=True) as resp:
+                    _log_http_debug(resp, label="HistoryPosition")
+
+                    if resp.status_code in (401, 403) and not relogou:
+                        logging.warning("Auth expirada, tentando relogar...")
+                        self.invalidar(token)
+                        relogou = True
+                        continue
+
+                    if resp.status_code == 204: return [], 0
+                    resp.raise_for_status()
+
+                    leitor = LeitorPaginaPosicoes(placa)
+                    registros = []
+                    for chunk in resp.iter_content(chunk_size=65536):
+                        registros += leitor.feed(chunk)
+                    registros += leitor.close()
+                    return registros, leitor.total
+
+            except (requests.RequestException, JSONDecodeError) as e:
+                erro = e
+                logging.error(f"API call falhou (tentativa {tentativa+1}): {e}")
+                if tentativa + 1 < API_MAX_TENTATIVAS:
+                    METRICAS.contar("etl_api_retentativas_total", placa=placa)
+                    status = resp.status_code if resp is not None else None
+                    time.sleep(self._espera_retry(tentativa, resp if status in self.RETRY_STATUS else None))
+        if falhar:
+            raise erro or RuntimeError(f"[{placa}] API sem resposta válida após {API_MAX_TENTATIVAS} tentativas")
+        return [], 0
+
+API = ApiClient(_LIMITADOR_API)
+
+def api_list_positions(placa: str, dt_ini: datetime, dt_fim: datetime, falhar=False) -> tuple[list, int]:
+    return API.list_positions(placa, dt_ini, dt_fim, falhar)
+
+# ====================== Inserção em rastreio.posicao ======================
+POSICAO_COLS = ("id_position","placa","id_event","ignicao","valid_gps","data_evento",
+                "data_atualizacao","latitude","longitude","velocidade_kmh","inputs","outputs",
+                "telemetria","nivel_tanque_percent","raw")
+_COPY_NULL = b"\\N"
+_COPY_ESCAPES = ((b"\\", b"\\\\"), (b"\n", b"\\n"), (b"\r", b"\\r"), (b"\t", b"\\t"))
+
+def _copy_campo(v) -> bytes:
+    """Valor -> campo do COPY em formato texto (bytes). JSONB já chega em bytes do json_dumps_bytes."""
+    if v is None: return _COPY_NULL
+    if isinstance(v, bool): return b"t" if v else b"f"
+    if isinstance(v, (int, float, Decimal)): return str(v).encode()
+    if isinstance(v, datetime): return v.isoformat().encode()
+    if isinstance(v, str): v = v.encode()
+    for de, para in _COPY_ESCAPES:
+        if de in v: v = v.replace(de, para)
+    return v
+
+def _buffer_copy(linhas) -> io.BytesIO:
+    """Monta o stream do COPY (texto, tab-separado) direto em bytes, sem passar por str/csv."""
+    buf = io.BytesIO()
+    escrever = buf.write
+    for linha in linhas:
+        escrever(b"\t".join([_copy_campo(getattr(linha, c)) for c in POSICAO_COLS]))
+        escrever(b"\n")
+    buf.seek(0)
+    return buf
+
+def _garantir_staging(cur):
+    # TEMP = sem WAL e privada da conexão (cada worker tem a sua); esvaziada a cada commit
+    cur.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS _stage_posicao "
+        "(LIKE rastreio.posicao INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;"
+    )
+
+_ATUAL_SET = ",".join(f"{c} = EXCLUDED.{c}" for c in POSICAO_COLS if c != "placa")
+
+def inserir_posicoes(cur, linhas) -> set:
+    """
+    Carga em massa: COPY (texto) para a staging temporária e um único INSERT ... SELECT
+    com ON CONFLICT DO NOTHING. Devolve os id_position efetivamente inseridos,
+    dispensando a consulta prévia de IDs existentes.
+    Na mesma instrução, a posição mais recente do que entrou avança rastreio.posicao_atual.
+    """
+    if not linhas: return set()
+    corte = corte_retencao()
+    if corte is not None:
+        linhas = _descartar_antes_do_corte(cur, linhas, corte)
+        if not linhas: return set()
+    # partições antes de tocar a tabela (±1 dia cobre data_evento naive em qualquer fuso)
+    datas = [r.data_evento for r in linhas]
+    ini = min(datas).date() - timedelta(days=1)
+    if corte is not None:
+        ini = max(ini, corte.date())   # o mês anterior ao corte foi desanexado: não tenta recriá-lo
+    garantir_particoes(ini, max(datas).date() + timedelta(days=1))
+    _garantir_staging(cur)
+    cur.execute("TRUNCATE _stage_posicao;")
+
+    cols = ",".join(POSICAO_COLS)
+    cur.copy_expert(f"COPY _stage_posicao ({cols}) FROM STDIN", _buffer_copy(linhas))
+    cur.execute(f"""
+        WITH ins AS (
+            INSERT INTO rastreio.posicao ({cols})
+            SELECT {cols} FROM _stage_posicao ORDER BY data_evento, id_position
+            ON CONFLICT (id_position, data_evento) DO NOTHING
+            RETURNING {cols}
+        ), atual AS (
+            INSERT INTO rastreio.posicao_atual AS a ({cols})
+            SELECT DISTINCT ON (placa) {cols} FROM ins
+             ORDER BY placa, data_evento DESC, id_position DESC
+            ON CONFLICT (placa) DO UPDATE SET {_ATUAL_SET}, atualizado_em = now()
+             WHERE (EXCLUDED.data_evento, EXCLUDED.id_position) > (a.data_evento, a.id_position)
+        )
+        SELECT id_position FROM ins;
+    """)
+    return {r[0] for r in cur.fetchall()}
+
+def _descartar_antes_do_corte(cur, linhas, corte) -> list:
+    """
+    Tira do lote as posições anteriores ao corte da retenção (backfill longo, atrasadas, spool antigo):
+    a partição delas já saiu de rastreio.posicao. data_evento naive vale no fuso da sessão do banco.
+    """
+    tz_sessao = cur.connection.info.parameter_status("TimeZone")
+    try:
+        tz = ZoneInfo(tz_sessao) if tz_sessao else LOCAL_TZ
+    except (ValueError, KeyError):   # fuso POSIX/abreviação que o zoneinfo não conhece
+        tz = LOCAL_TZ
+    ficam = [r for r in linhas if (r.data_evento if r.data_evento.tzinfo else r.data_evento.replace(tzinfo=tz)) >= corte]
+    if len(ficam) < len(linhas):
+        por_placa = {}
+        for r in linhas:
+            por_placa[r.placa] = por_placa.get(r.placa, 0) + 1
+        for r in ficam:
+            por_placa[r.placa] -= 1
+        for placa, n in sorted(por_placa.items()):
+            if n:
+                logging.warning(f"[{placa}] {n} posições anteriores à retenção ({corte:%Y-%m-%d}) descartadas.")
+    return ficam
+
+def verificar_posicao_atual(cur, corrigir=False) -> list:
+    """
+    Confere rastreio.posicao_atual contra o histórico (uma busca por índice por placa,
+    não uma varredura) e devolve [(placa, id_position gravado, id_position esperado)].
+    Com corrigir=True, reescreve as placas divergentes a partir de rastreio.posicao.
+    """
+    cur.execute("""
+        SELECT v.placa, a.id_position, u.id_position
+          FROM cadastro.veiculo v
+          LEFT JOIN rastreio.posicao_atual a ON a.placa = v.placa
+          LEFT JOIN LATERAL (
+                SELECT p.id_position FROM rastreio.posicao p
+                 WHERE p.placa = v.placa
+                 ORDER BY p.data_evento DESC, p.id_position DESC
+                 LIMIT 1) u ON TRUE
+         WHERE a.id_position IS DISTINCT FROM u.id_position
+         ORDER BY v.placa;
+    """)
+    divergentes = cur.fetchall()
+    if corrigir and divergentes:
+        placas = [d[0] for d in divergentes]
+        cols = ",".join(POSICAO_COLS)
+        cur.execute("DELETE FROM rastreio.posicao_atual WHERE placa = ANY(%s);", (placas,))
+        cur.execute(f"""
+            INSERT INTO rastreio.posicao_atual ({cols})
+            SELECT u.* FROM unnest(%s::text[]) AS d(placa)
+              CROSS JOIN LATERAL (
+                    SELECT {cols} FROM rastreio.posicao p
+                     WHERE p.placa = d.placa
+                     ORDER BY p.data_evento DESC, p.id_position DESC
+                     LIMIT 1) u;
+        """, (placas,))
+    return divergentes
+
+# ====================== Arquivo frio (Parquet) ======================
+# inputs/outputs/telemetria/raw das posições com mais de ARQUIVO_IDADE_DIAS saem do banco para
+# ARQUIVO_DIR/placa=<placa>/dia=<AAAA-MM-DD, UTC>/<id_min>-<id_max>.parquet (zstd); o resto da
+# linha fica. O arquivo é gravado (fsync + rename) antes do UPDATE que zera as colunas: uma queda
+# no meio deixa no máximo um arquivo repetido, que a leitura descarta por (id_position, data_evento).
+_ARQUIVO_COLS = ("inputs", "outputs", "telemetria", "raw")
+_ARQUIVO_PENDENTE = "COALESCE(raw, telemetria, inputs, outputs) IS NOT NULL"
+_ARQUIVO_DIA = None   # dia (UTC) em que o loop zerou o atrasado; volta a arquivar no dia seguinte
+
+def _exigir_pyarrow():
+    if pq is None:
+        raise RuntimeError("O arquivo frio requer o pacote 'pyarrow' instalado.")
+
+def _arquivo_pasta(diretorio, placa, dia):
+    return os.path.join(diretorio, f"placa={placa}", f"dia={dia:%Y-%m-%d}")
+
+def _arquivo_gravar(pasta, linhas):
+    """linhas = [(id_position, placa, data_evento, inputs, outputs, telemetria, raw)] com o JSON em texto."""
+    colunas = list(zip(*linhas))
+    tabela = pa.Table.from_arrays([
+        pa.array(colunas[0], pa.int64()),
+        pa.array(colunas[1], pa.string()),
+        pa.array(colunas[2], pa.timestamp("us", tz="UTC")),
+        *(pa.array(c, pa.string()) for c in colunas[3:]),
+    ], names=["id_position", "placa", "data_evento", *_ARQUIVO_COLS])
+    os.makedirs(pasta, exist_ok=True)
+    nome = os.path.join(pasta, f"{min(colunas[0])}-{max(colunas[0])}.parquet")
+    pq.write_table(tabela, nome + ".tmp", compression="zstd")
+    with open(nome + ".tmp", "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(nome + ".tmp", nome)
+    return nome
+
+def arquivar_posicoes(idade_dias=None, diretorio=None, tempo_max=None, agora=None):
+    """
+    Arquiva as colunas JSON das posições de dias (UTC) inteiros com mais de idade_dias, uma
+    placa+dia por transação, e zera essas colunas no banco. Com tempo_max (s), para quando
+    passar do limite (sempre anda ao menos uma placa+dia). Devolve (linhas, partições tocadas,
+    terminou?).
+    """
+    _exigir_pyarrow()
+    idade_dias = ARQUIVO_IDADE_DIAS if idade_dias is None else idade_dias
+    diretorio = diretorio or ARQUIVO_DIR
+    hoje = (agora or datetime.now(timezone.utc)).date()
+    limite = datetime.combine(hoje - timedelta(days=idade_dias), datetime.min.time(), timezone.utc)
+    inicio, total, particoes = time.monotonic(), 0, set()
+    conn = obter_conexao()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT placa, (data_evento AT TIME ZONE 'UTC')::date
+                  FROM rastreio.posicao
+                 WHERE data_evento < %s AND {_ARQUIVO_PENDENTE}
+                 GROUP BY 1, 2
+                 ORDER BY 2, 1;
+            """, (limite,))
+            grupos = cur.fetchall()
+            conn.commit()
+            for k, (placa, dia) in enumerate(grupos):
+                if k and tempo_max is not None and time.monotonic() - inicio > tempo_max:
+                    return total, particoes, False
+                ini = datetime.combine(dia, datetime.min.time(), timezone.utc)
+                cur.execute(f"""
+                    SELECT id_position, placa, data_evento, inputs::text, outputs::text, telemetria::text, raw::text
+                      FROM rastreio.posicao
+                     WHERE placa = %s AND data_evento >= %s AND data_evento < %s AND {_ARQUIVO_PENDENTE}
+                     ORDER BY data_evento, id_position;
+                """, (placa, ini, ini + timedelta(days=1)))
+                linhas = cur.fetchall()
+                if linhas:
+                    _arquivo_gravar(_arquivo_pasta(diretorio, placa, dia), linhas)
+                    # só as linhas que estão no arquivo: posição atrasada que chegou no meio fica para a próxima
+                    cur.execute("""
+                        UPDATE rastreio.posicao
+                           SET inputs = NULL, outputs = NULL, telemetria = NULL, raw = NULL
+                         WHERE placa = %s AND data_evento >= %s AND data_evento < %s AND id_position = ANY(%s);
+                    """, (placa, ini, ini + timedelta(days=1), [r[0] for r in linhas]))
+                conn.commit()
+                total += len(linhas)
+                particoes.add(f"posicao_{dia:%Y%m}")
+    finally:
+        conn.close()
+    return total, particoes, True
+
+def manter_arquivo(agora=None):
+    """Fim de ciclo: arquiva o atrasado em fatias de ARQUIVO_TEMPO_MAX_SEC; em dia, uma vez por dia."""
+    global _ARQUIVO_DIA
+    hoje = (agora or datetime.now(timezone.utc)).date()
+    if ARQUIVO_IDADE_DIAS <= 0 or _ARQUIVO_DIA == hoje:
+        return
+    if pq is None:
+        logging.warning("ARQUIVO_IDADE_DIAS definido, mas o pacote 'pyarrow' não está instalado: nada arquivado.")
+        _ARQUIVO_DIA = hoje
+        return
+    linhas, particoes, terminou = arquivar_posicoes(tempo_max=ARQUIVO_TEMPO_MAX_SEC, agora=agora)
+    if terminou:
+        _ARQUIVO_DIA = hoje
+    if linhas:
+        logging.info(f"Arquivo frio: {linhas} posições arquivadas ({', '.join(sorted(particoes))})"
+                     f"{'' if terminou else '; continua no próximo ciclo'}.")
+
+def reidratar_posicoes(placa, ini, fim, diretorio=None) -> list:
+    """
+    Colunas JSON arquivadas de uma placa em [ini, fim) (datetimes com fuso): dicts com
+    id_position, placa, data_evento e o JSON em texto, em ordem (data_evento, id_position).
+    """
+    _exigir_pyarrow()
+    diretorio = diretorio or ARQUIVO_DIR
+    ini, fim = ini.astimezone(timezone.utc), fim.astimezone(timezone.utc)
+    linhas, dia = {}, ini.date()
+    while dia <= fim.date():
+        pasta = _arquivo_pasta(diretorio, placa, dia)
+        if os.path.isdir(pasta):
+            for nome in sorted(os.listdir(pasta)):
+                if not nome.endswith(".parquet"): continue
+                # partitioning=None: placa/dia já são colunas do arquivo, não vêm do caminho
+                tabela = pq.read_table(os.path.join(pasta, nome), partitioning=None,
+                                       filters=[("data_evento", ">=", ini), ("data_evento", "<", fim)])
+                for r in tabela.to_pylist():
+                    linhas[(r["id_position"], r["data_evento"])] = r
+        dia += timedelta(days=1)
+    return sorted(linhas.values(), key=lambda r: (r["data_evento"], r["id_position"]))
+
+def restaurar_posicoes(cur, linhas) -> int:
+    """
+    Devolve ao banco o JSON de reidratar_posicoes() onde ele ainda está arquivado (colunas nulas).
+    O próximo arquivamento volta a tirá-lo. Devolve quantas linhas foram restauradas.
+    """
+    if not linhas: return 0
+    rows = execute_values(cur, """
+        UPDATE rastreio.posicao p
+           SET inputs = v.inputs, outputs = v.outputs, telemetria = v.telemetria, raw = v.raw
+          FROM (VALUES %s) AS v(id_position, data_evento, inputs, outputs, telemetria, raw)
+         WHERE p.id_position = v.id_position AND p.data_evento = v.data_evento AND p.raw IS NULL
+        RETURNING p.id_position;
+    """, [(r["id_position"], r["data_evento"], *(r[c] for c in _ARQUIVO_COLS)) for r in linhas],
+        template="(%s::bigint, %s::timestamptz, %s::jsonb, %s::jsonb, %s::jsonb, %s::jsonb)", fetch=True)
+    return len(rows)
+
+# ====================== Eventos de sessão (LISTEN/NOTIFY) ======================
+# Toda mudança de operacao.sessao_tanque (aberta, finalizada, fechada_gap, cancelada, reclassificada e
+# removida/inserida por reprocessamento) vira uma linha em operacao.sessao_evento, gravada por trigger
+# na mesma transação, e um NOTIFY no canal sessao_tanque. seq cresce na ordem de commit: o consumidor
+# guarda o último seq lido e puxa só o que veio depois; o NOTIFY só avisa que há o que puxar.
+_EVENTOS_COLS = ("seq", "id_sessao", "placa", "evento", "tipo", "tipo_anterior", "inicio_em", "fim_em",
+                 "origem", "criado_em")
+_EVENTOS_RETENCAO_DIA = None   # limpeza roda uma vez por dia por processo
+
+def ler_eventos_sessao(cur, desde=0, limite=10000) -> list:
+    """Eventos com seq > desde, em ordem, como dicts."""
+    cur.execute(f"SELECT {', '.join(_EVENTOS_COLS)} FROM operacao.sessao_evento "
+                "WHERE seq > %s ORDER BY seq LIMIT %s;", (desde, limite))
+    return [dict(zip(_EVENTOS_COLS, r)) for r in cur.fetchall()]
+
+def eventos_sessao_perdidos(cur, desde) -> bool:
+    """True se a retenção já apagou eventos depois de `desde` (o consumidor deve recarregar tudo)."""
+    cur.execute("SELECT min(seq) FROM operacao.sessao_evento;")
+    menor = cur.fetchone()[0]
+    return desde > 0 and menor is not None and menor > desde + 1
+
+def seguir_eventos_sessao(desde, tratar, espera=60.0, limite=10000):
+    """
+    Chama tratar(evento) para cada evento com seq > desde, em ordem, e fica escutando o canal
+    sessao_tanque para os próximos. Sem NOTIFY em `espera` segundos relê mesmo assim (aviso perdido
+    numa reconexão não atrasa o consumidor mais que isso). Não retorna.
+    """
+    conn = obter_conexao()
+    conn.autocommit = True   # NOTIFY só chega fora de transação aberta
+    try:
+        with conn.cursor() as cur:
+            cur.execute("LISTEN sessao_tanque;")   # antes da 1ª leitura: nenhum commit escapa entre as duas
+            while True:
+                while True:
+                    eventos = ler_eventos_sessao(cur, desde, limite)
+                    for ev in eventos:
+                        tratar(ev)
+                    if eventos:
+                        desde = eventos[-1]["seq"]
+                    if len(eventos) < limite:
+                        break
+                if select.select([conn], [], [], espera)[0]:
+                    conn.poll()
+                    conn.notifies.clear()
+    finally:
+        conn.close()
+
+def manter_eventos_sessao(cur, agora=None) -> int:
+    """Apaga eventos mais velhos que SESSAO_EVENTOS_RETENCAO_DIAS (uma vez por dia); sem commit."""
+    global _EVENTOS_RETENCAO_DIA
+    hoje = (agora or datetime.now(timezone.utc)).date()
+    if SESSAO_EVENTOS_RETENCAO_DIAS <= 0 or _EVENTOS_RETENCAO_DIA == hoje:
+        return 0
+    cur.execute("DELETE FROM operacao.sessao_evento WHERE criado_em < now() - make_interval(days => %s);",
+                (SESSAO_EVENTOS_RETENCAO_DIAS,))
+    _EVENTOS_RETENCAO_DIA = hoje
+    return cur.rowcount
+
+# ====================== Tabelas do Qlik ======================
+# Placas/sessões tocadas no ciclo (marcadas após o commit de cada placa, por qualquer worker);
+# no fim do ciclo uma chamada a operacao.qlik_atualizar recalcula só essas linhas.
+# O 1º ciclo do processo reconstrói tudo: marcas de um processo que caiu antes do fim do ciclo
+# se perdem com ele, e placas sem posição nova nunca seriam incluídas.
+_QLIK_PLACAS, _QLIK_SESSOES = set(), set()
+_QLIK_LOCK = threading.Lock()
+_QLIK_RECONSTRUIR = True
+
+def qlik_marcar(placa=None, sessoes=()):
+    if not QLIK_TABELAS: return
+    with _QLIK_LOCK:
+        if placa: _QLIK_PLACAS.add(placa)
+        _QLIK_SESSOES.update(sessoes)
+
+def qlik_atualizar(conn, cur):
+    """Recalcula as linhas pendentes (commit próprio). Em erro, o pendente fica para o próximo ciclo."""
+    global _QLIK_RECONSTRUIR
+    if not QLIK_TABELAS:
+        return None
+    with _QLIK_LOCK:
+        placas, sessoes = sorted(_QLIK_PLACAS), sorted(_QLIK_SESSOES)
+        _QLIK_PLACAS.clear()
+        _QLIK_SESSOES.clear()
+    if not placas and not sessoes and not _QLIK_RECONSTRUIR:
+        return None
+    try:
+        if _QLIK_RECONSTRUIR:
+            cur.execute("SELECT operacao.qlik_reconstruir();")
+        else:
+            cur.execute("SELECT operacao.qlik_atualizar(%s::text[], %s::bigint[]);", (placas, sessoes))
+        versao = cur.fetchone()[0]
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        with _QLIK_LOCK:
+            _QLIK_PLACAS.update(placas)
+            _QLIK_SESSOES.update(sessoes)
+        logging.error(f"Falha ao atualizar tabelas do Qlik ({len(placas)} placas, {len(sessoes)} sessões): {e}")
+        return None
+    if _QLIK_RECONSTRUIR:
+        _QLIK_RECONSTRUIR = False
+        logging.info(f"Qlik: tabelas reconstruídas (versão {versao}).")
+        return versao
+    logging.info(f"Qlik: versão {versao} ({len(placas)} placas, {len(sessoes)} sessões recalculadas).")
+    return versao
+
+def encerrar_ciclo(conn, cur):
+    """Fim de ciclo: fecha sessões estagnadas por GAP, atualiza as tabelas do Qlik, limpa eventos antigos e arquiva."""
+    with cronometrar("fechar_stagnadas"):
+        cur.execute("SELECT id_sessao, placa FROM operacao.fechar_sessoes_stagnadas_placas(%s);", (int(GAP_MIN),))
+        fechadas = cur.fetchall()
+        conn.commit()
+    if fechadas:
+        logging.info(f"Finalizadas {len(fechadas)} sessões estagnadas por GAP.")
+    for id_sessao, placa in fechadas:
+        qlik_marcar(placa, (id_sessao,))
+        METRICAS.contar("etl_sessoes_total", placa=placa, evento="fechada_gap")
+    with cronometrar("qlik"):
+        qlik_atualizar(conn, cur)
+    try:
+        removidos = manter_eventos_sessao(cur)
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logging.error(f"Falha na limpeza de operacao.sessao_evento (segue no próximo ciclo): {e}")
+    else:
+        if removidos:
+            logging.info(f"Eventos de sessão: {removidos} com mais de {SESSAO_EVENTOS_RETENCAO_DIAS} dias removidos.")
+    try:
+        with cronometrar("arquivo"):
+            manter_arquivo()
+    except (psycopg2.Error, OSError) as e:
+        logging.error(f"Falha no arquivo frio (segue no próximo ciclo): {e}")
+
+# ====================== Spool local (banco fora do ar) ======================
+# Com SPOOL_DIR, lotes já baixados e parseados que não chegam ao banco (conexão recusada, queda ou
+# timeout na carga) vão para arquivos append-only em disco em vez de serem baixados de novo da API.
+# Registro = [tamanho u32][crc32 u32][pickle de (placa, tuplas de Posicao)]; arquivos de até
+# SPOOL_SEGMENTO_MB, nomeados em ordem de criação. Sem banco no início do ciclo, as janelas saem das
+# marcas em memória (último ciclo com banco + o que já foi para o spool). No primeiro ciclo com banco,
+# antes de ler as marcas, os segmentos são lidos por mmap, agrupados por placa e reaplicados em massa
+# (gravar_posicoes + detecção), do mais antigo ao mais novo; o ON CONFLICT por id_position torna o
+# replay idempotente e o segmento só é apagado depois de reaplicado.
+_SPOOL_REGISTRO = struct.Struct("<II")
+_POSICAO_CAMPOS = tuple(f.name for f in fields(Posicao))
+_MARCAS_MEMORIA = {}   # placa -> marca, para ciclos sem banco
+_MARCAS_LOCK = threading.Lock()
+
+class Spool:
+    """Segmentos append-only de lotes de posições; thread-safe (workers, writers do async, estágios)."""
+
+    def __init__(self, diretorio, segmento_mb=SPOOL_SEGMENTO_MB, max_mb=SPOOL_MAX_MB):
+        self.diretorio = diretorio
+        self.segmento_max, self.total_max = segmento_mb << 20, max_mb << 20
+        self._lock = threading.Lock()
+        self._arq = None
+        self.placas = set()   # placas com lote no spool ainda não reaplicado
+
+    def pendente(self, placa) -> bool:
+        return placa in self.placas
+
+    def segmentos(self) -> list:
+        try:
+            nomes = os.listdir(self.diretorio)
+        except FileNotFoundError:
+            return []
+        return sorted(os.path.join(self.diretorio, n) for n in nomes if n.endswith(".spool"))
+
+    def _fechar(self):
+        if self._arq is not None:
+            self._arq.flush()
+            os.fsync(self._arq.fileno())
+            self._arq.close()
+            self._arq = None
+
+    def sincronizar(self):
+        """Fecha o segmento corrente (fsync); o próximo lote abre outro."""
+        with self._lock:
+            self._fechar()
+
+    @staticmethod
+    def _registro(placa, linhas) -> bytes:
+        payload = pickle.dumps((placa, [tuple(getattr(r, c) for c in _POSICAO_CAMPOS) for r in linhas]),
+                               protocol=pickle.HIGHEST_PROTOCOL)
+        return _SPOOL_REGISTRO.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def gravar(self, placa, linhas) -> bool:
+        """Acrescenta o lote ao segmento corrente. False com o spool cheio (SPOOL_MAX_MB) ou erro de disco."""
+        registro = self._registro(placa, linhas)
+        with self._lock:
+            try:
+                if self._arq is None or self._arq.tell() >= self.segmento_max:
+                    self._fechar()
+                    if sum(os.path.getsize(c) for c in self.segmentos()) >= self.total_max:
+                        logging.error(f"[{placa}] Spool cheio ({SPOOL_MAX_MB} MB em {self.diretorio}).")
+                        return False
+                    os.makedirs(self.diretorio, exist_ok=True)
+                    self._arq = open(os.path.join(self.diretorio, f"{time.time_ns():020d}.spool"), "ab")
+                self._arq.write(registro)
+                self._arq.flush()
+                self.placas.add(placa)
+            except OSError as e:
+                logging.error(f"[{placa}] Falha ao gravar no spool {self.diretorio}: {e}")
+                return False
+        return True
+
+    @staticmethod
+    def ler(caminho):
+        """(placa, [Posicao]) de cada registro íntegro; para no primeiro registro cortado (gravação interrompida)."""
+        with open(caminho, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                pos, fim = 0, len(m)
+                while pos + _SPOOL_REGISTRO.size <= fim:
+                    tamanho, crc = _SPOOL_REGISTRO.unpack_from(m, pos)
+                    ini = pos + _SPOOL_REGISTRO.size
+                    payload = m[ini:ini + tamanho]
+                    if len(payload) < tamanho or zlib.crc32(payload) != crc:
+                        break
+                    placa, tuplas = pickle.loads(payload)
+                    yield placa, [Posicao(*t) for t in tuplas]
+                    pos = ini + tamanho
+                if pos < fim:
+                    logging.warning(f"Spool {caminho}: {fim - pos} bytes finais incompletos ignorados.")
+
+    @staticmethod
+    def _regravar(caminho, lotes):
+        """Troca o segmento por um só com `lotes` (placa -> linhas): mesmo nome, então mesma posição na ordem."""
+        tmp = caminho + ".tmp"
+        with open(tmp, "wb") as f:
+            for placa, linhas in lotes.items():
+                f.write(Spool._registro(placa, linhas))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, caminho)
+
+    def reaplicar(self, conn, cur) -> int:
+        """
+        Reaplica os segmentos pendentes no banco, em ordem. Queda do banco no meio propaga a exceção
+        (o segmento fica para o próximo ciclo). Erro de uma placa desfaz só ela: os lotes dela (deste
+        e dos segmentos seguintes, para não reaplicar fora de ordem) ficam no spool para o próximo
+        replay e a placa continua pendente; o segmento é regravado só com eles.
+        """
+        self.sincronizar()
+        total, falhas = 0, set()
+        for caminho in self.segmentos():
+            lotes, ficam = {}, {}
+            for placa, linhas in self.ler(caminho):
+                lotes.setdefault(placa, []).extend(linhas)
+            for placa, linhas in lotes.items():
+                if placa in falhas:
+                    ficam[placa] = linhas
+                    continue
+                try:
+                    novas = gravar_posicoes(conn, cur, placa, linhas)
+                    if novas:
+                        detectar_posicoes(conn, cur, placa, novas)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
+                except Exception as e:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        pass
+                    logging.exception(f"[{placa}] Falha ao reaplicar {len(linhas)} posições do spool "
+                                      f"(ficam no spool para o próximo ciclo): {e}")
+                    falhas.add(placa)
+                    ficam[placa] = linhas
+                    continue
+                METRICAS.contar("etl_spool_posicoes_total", len(linhas), placa=placa, evento="reaplicada")
+                total += len(linhas)
+            if ficam:
+                self._regravar(caminho, ficam)
+                logging.warning(f"Spool {os.path.basename(caminho)} reaplicado em parte: "
+                                f"{len(lotes) - len(ficam)} placas; ficam {', '.join(sorted(ficam))}.")
+            else:
+                os.remove(caminho)
+                logging.info(f"Spool {os.path.basename(caminho)} reaplicado ({len(lotes)} placas).")
+        self.placas.clear()
+        self.placas.update(falhas)   # lotes novos delas seguem para o spool, atrás dos que ficaram
+        return total
+
+SPOOL = Spool(SPOOL_DIR) if SPOOL_DIR else None
+
+def lembrar_marcas(marcas):
+    with _MARCAS_LOCK:
+        _MARCAS_MEMORIA.clear()
+        _MARCAS_MEMORIA.update((placa, dict(m)) for placa, m in marcas.items())
+
+def _avancar_marca_memoria(placa, linhas):
+    """Mesma regra de atualizar_marca, na cópia em memória (depois do commit ou do spool)."""
+    ultimo = max(linhas, key=lambda r: (r.evento_api, r.id_position))
+    with _MARCAS_LOCK:
+        m = _MARCAS_MEMORIA.get(placa)
+        if m is not None and (m["evento_api"] is None or
+                              (ultimo.evento_api, ultimo.id_position) > (m["evento_api"], m["id_position"] or 0)):
+            m["evento_api"], m["id_position"] = ultimo.evento_api, ultimo.id_position
+
+def spool_gravar(placa, linhas) -> bool:
+    """Lote para o spool (e cursor em memória adiante). False sem spool configurado ou se não coube."""
+    if SPOOL is None or not SPOOL.gravar(placa, linhas):
+        return False
+    _avancar_marca_memoria(placa, linhas)
+    METRICAS.contar("etl_spool_posicoes_total", len(linhas), placa=placa, evento="gravada")
+    return True
+
+def marcas_sem_banco(erro) -> dict:
+    """Marcas para um ciclo sem banco: só com spool e depois de um ciclo com banco; senão relança o erro."""
+    with _MARCAS_LOCK:
+        marcas = {placa: dict(m) for placa, m in _MARCAS_MEMORIA.items()}
+    if SPOOL is None or not marcas:
+        raise erro
+    logging.warning(f"Banco indisponível ({str(erro).strip().splitlines()[0]}); ciclo vai para o spool em {SPOOL_DIR}.")
+    return marcas
+
+def preparar_ciclo(conn, cur) -> dict:
+    """Início de ciclo com banco: áreas, replay do spool pendente e marcas d'água (nesta ordem)."""
+    carregar_areas(cur)
+    if SPOOL is not None:
+        n = SPOOL.reaplicar(conn, cur)
+        if n:
+            logging.info(f"Spool: {n} posições reaplicadas no banco.")
+    marcas = carregar_marcas(cur)
+    conn.commit()
+    lembrar_marcas(marcas)
+    return marcas
+
+def coletar_para_spool(marcas, workers):
+    """Ciclo sem banco: baixa as janelas a partir das marcas em memória direto para o spool."""
+    global _CICLO
+    placas = _ordem_justa(sorted(marcas), _CICLO)
+    _CICLO += 1
+    agora = datetime.now(timezone.utc)
+
+    def _placa(placa):
+        janela = calcular_janela(placa, marcas[placa], agora)
+        if not janela:
+            return
+        try:
+            for lote in paginar_posicoes(placa, janela):
+                if not spool_gravar(placa, lote):
+                    logging.warning(f"[{placa}] {len(lote)} posições fora do spool: voltam da API no próximo ciclo.")
+                    return
+        except Exception as e:
+            logging.exception(f"Falha crítica no download da placa {placa}: {e}")
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="etl-spool") as pool:
+        list(pool.map(_placa, placas))
+    SPOOL.sincronizar()
+
+# ====================== ETL principal ======================
+API_SOFT_CAP = 1000  # limite observado na API por requisição (ajuste se mudar)
+
+def calcular_janela(placa, marca, agora):
+    """Janela [dt_ini, dt_fim] (UTC) a buscar para a placa, ou None se não há o que buscar."""
+    dt_ultimo = marca["evento_api"] or marca["ultima_data_evento"]
+    if marca["evento_api"]:
+        # cursor exato: retoma no EventDate do último item gravado (o ON CONFLICT descarta o repetido)
+        dt_ini = marca["evento_api"].astimezone(timezone.utc)
+    elif dt_ultimo:
+        dt_ini = (dt_ultimo.astimezone(timezone.utc) if dt_ultimo.tzinfo else dt_ultimo.replace(tzinfo=LOCAL_TZ)).astimezone(timezone.utc)
+    else:
+        dt_inst = marca["instalado_em"]
+        dt_ini = dt_inst.astimezone(timezone.utc) if dt_inst else datetime(agora.year, 1, 1, tzinfo=timezone.utc)
+    corte = corte_retencao(agora)
+    if corte is not None and dt_ini < corte:
+        # antes do corte a partição já saiu (ou sai no próximo mês): nem pede à API
+        logging.info(f"[{placa}] Início da janela {dt_ini:%Y-%m-%d} anterior à retenção; buscando a partir de {corte:%Y-%m-%d}.")
+        dt_ini = corte
+
+    dt_fim = agora
+    if dt_ini >= dt_fim:
+        logging.info(f"[{placa}] Sem novas posições para buscar (última em {dt_ultimo}).")
+        return None
+    return dt_ini, dt_fim
+
+def acumular_lote(lote, n_itens, candidatos):
+    """
+    Ordena a página da API por EventDate e acrescenta os registros em 'candidatos'.
+    Devolve o próximo cursor (1 ms após o último item) se a página bateu o SOFT_CAP, senão None.
+    """
+    # Ordena por timestamp da API (asc) para pegar o último com precisão de ms
+    lote.sort(key=lambda r: r.evento_api)
+    candidatos.extend(lote)
+
+    # Se bateu perto do limite, avança o cursor para DEPOIS do último timestamp do lote
+    if n_itens >= API_SOFT_CAP and lote:
+        # avança 1 ms para não reprocessar o último
+        return lote[-1].evento_api + timedelta(milliseconds=1)
+    return None
+
+# ---------- backfill: janela longa em fatias paralelas ----------
+# Em vez de paginar meses de histórico uma página por vez (cursor 1 ms após o último item), a janela
+# é cortada em fatias de BACKFILL_FATIA_HORAS buscadas em paralelo; fatia que bate o SOFT_CAP tem o
+# resto cortado de novo pela densidade observada. As fatias saem em ordem de EventDate assim que a
+# frente da janela fica pronta, para serem gravadas em lotes (paginar_posicoes).
+def janela_longa(janela) -> bool:
+    return BACKFILL_LIMIAR_HORAS > 0 and (janela[1] - janela[0]) > timedelta(hours=BACKFILL_LIMIAR_HORAS)
+
+def planejar_fatias(dt_ini, dt_fim, horas=None) -> list:
+    """[dt_ini, dt_fim] em fatias contíguas de 'horas' (a última pode ser menor)."""
+    passo = timedelta(hours=horas or BACKFILL_FATIA_HORAS)
+    fatias, ini = [], dt_ini
+    while ini < dt_fim:
+        fim = min(ini + passo, dt_fim)
+        fatias.append((ini, fim))
+        ini = fim + timedelta(milliseconds=1)
+    return fatias
+
+def _subdividir(lote, n_itens, ini, fim) -> list:
+    """
+    Fatia que bateu o SOFT_CAP: o resto (1 ms após o último item até 'fim') em sub-fatias do
+    tamanho que, pela densidade da página recebida, cabe em ~metade do cap cada.
+    """
+    if n_itens < API_SOFT_CAP or not lote:
+        return []
+    ultimo = max(r.evento_api for r in lote)
+    resto_ini = ultimo + timedelta(milliseconds=1)
+    if resto_ini > fim:
+        return []
+    coberto = max((ultimo - ini).total_seconds(), 1.0)
+    estimados = n_itens * (fim - resto_ini).total_seconds() / coberto
+    partes = max(2, min(BACKFILL_CONCORRENCIA * 4, int(estimados / (API_SOFT_CAP / 2)) + 1))
+    return planejar_fatias(resto_ini, fim, (fim - resto_ini).total_seconds() / 3600 / partes + 1e-9)
+
+def _pagina_api(placa, ini, fim, falhar=False):
+    with cronometrar("api", placa):
+        lote, n = api_list_positions(placa, ini, fim, falhar)
+    METRICAS.contar("etl_api_paginas_total", placa=placa)
+    METRICAS.contar("etl_posicoes_recebidas_total", n, placa=placa)
+    return lote, n
+
+class _FatiasEmOrdem:
+    """
+    Fatias contíguas da janela, em ordem de tempo; cada uma pendente (None), em voo, pronta (lote
+    ordenado) ou com falha (a exceção). Só as 2 x BACKFILL_CONCORRENCIA primeiras são buscadas e as
+    prontas saem pela frente, então a memória não cresce com o tamanho da janela.
+    """
+    _EM_VOO = object()
+
+    def __init__(self, placa, janela):
+        self.placa = placa
+        self.nos = [[ini, fim, None] for ini, fim in planejar_fatias(*janela)]
+        self.em_voo = self.requisicoes = self.posicoes = 0
+        logging.info(f"[{placa}] Backfill de {_to_iso_z(janela[0])} até {_to_iso_z(janela[1])} em {len(self.nos)} fatias.")
+
+    def a_buscar(self) -> list:
+        """Próximas fatias a pedir (até BACKFILL_CONCORRENCIA em voo), da frente para trás."""
+        out = []
+        for no in self.nos[:2 * BACKFILL_CONCORRENCIA]:
+            if self.em_voo >= BACKFILL_CONCORRENCIA:
+                break
+            if no[2] is None:
+                no[2] = self._EM_VOO
+                self.em_voo += 1
+                out.append(no)
+        return out
+
+    def concluir(self, no, resultado):
+        """Página recebida: fatia pronta; se bateu o SOFT_CAP, o resto entra logo atrás dela em sub-fatias."""
+        lote, n = resultado
+        self.em_voo -= 1
+        self.requisicoes += 1
+        lote.sort(key=lambda r: (r.evento_api, r.id_position))
+        no[2] = lote
+        subs = _subdividir(lote, n, no[0], no[1])
+        if subs:
+            i = self.nos.index(no)
+            self.nos[i + 1:i + 1] = [[ini, fim, None] for ini, fim in subs]
+
+    def falhou(self, no, erro):
+        self.em_voo -= 1
+        self.requisicoes += 1
+        no[2] = erro
+        logging.error(f"[{self.placa}] Backfill: fatia {_to_iso_z(no[0])} .. {_to_iso_z(no[1])} falhou: {erro}")
+
+    def prontas(self) -> list:
+        """Lotes prontos na frente, em ordem (saem da fila)."""
+        out = []
+        while self.nos and isinstance(self.nos[0][2], list):
+            out.append(self.nos.pop(0)[2])
+            self.posicoes += len(out[-1])
+        return out
+
+    def encerrada(self) -> bool:
+        """
+        Tudo entregue, ou a fatia da frente falhou: nada depois dela é entregue, para o cursor da
+        placa não pular o buraco (o resto volta no próximo ciclo).
+        """
+        if self.nos and not isinstance(self.nos[0][2], Exception):
+            return False
+        if self.nos:
+            logging.warning(f"[{self.placa}] Backfill: fatia falhou; gravado só até {_to_iso_z(self.nos[0][0])}.")
+        logging.info(f"[{self.placa}] Backfill: {self.posicoes} posições em {self.requisicoes} requisições.")
+        return True
+
+def paginas_fatiadas(placa, janela):
+    """Backfill da janela em fatias paralelas (pool de BACKFILL_CONCORRENCIA threads), em ordem de EventDate."""
+    fatias = _FatiasEmOrdem(placa, janela)
+    voando = {}
+    with ThreadPoolExecutor(max_workers=BACKFILL_CONCORRENCIA, thread_name_prefix="etl-backfill") as pool:
+        try:
+            while True:
+                yield from fatias.prontas()
+                if fatias.encerrada():
+                    return
+                for no in fatias.a_buscar():
+                    voando[pool.submit(_pagina_api, placa, no[0], no[1], True)] = no
+                prontos, _ = wait(voando, return_when=FIRST_COMPLETED)
+                for f in prontos:
+                    no = voando.pop(f)
+                    try:
+                        resultado = f.result()
+                    except Exception as e:
+                        fatias.falhou(no, e)
+                        continue
+                    fatias.concluir(no, resultado)
+        finally:
+            for f in voando:   # consumidor parou (erro na gravação): não espera fatias que ninguém vai ler
+                f.cancel()
+
+def gravar_posicoes(conn, cur, placa, candidatos) -> list:
+    """Insert com dedup no banco + cursor da placa (commit). Devolve as linhas novas, em ordem de evento."""
+    if not candidatos:
+        return []
+
+    mapa = {c.id_position: c for c in candidatos}
+    with cronometrar("insert", placa):
+        inseridos = inserir_posicoes(cur, list(mapa.values()))
+        atualizar_marca(cur, placa, candidatos)
+        conn.commit()
+    _avancar_marca_memoria(placa, candidatos)
+    METRICAS.contar("etl_posicoes_inseridas_total", len(inseridos), placa=placa)
+    linhas_novas = [mapa[i] for i in inseridos]
+    if not linhas_novas:
+        logging.info(f"[{placa}] Nenhuma posição nova após filtrar existentes.")
+        return []
+
+    qlik_marcar(placa)
+    linhas_novas.sort(key=lambda r: (_naive_local(r.data_evento), r.id_position))
+    logging.info(f"[{placa}] Inseridas {len(linhas_novas)} novas posições.")
+    return linhas_novas
+
+def detectar_posicoes(conn, cur, placa, linhas_novas):
+    """Detecção incremental sobre as linhas novas: sessões + snapshot do detector (commit)."""
+    try:
+        with cronometrar("detect", placa):
+            det = detector_da_placa(cur, placa)
+            total_sessoes = det.processar(cur, linhas_novas)
+            sessoes = det.gravar(cur)
+            det.salvar(cur)
+            conn.commit()
+        qlik_marcar(placa, sessoes)
+    except Exception:
+        # após o rollback o estado em memória não bate com o banco: recarrega do snapshot
+        _DETECTORES.pop(placa, None)
+        raise
+    if total_sessoes > 0:
+        logging.info(f"[{placa}] Finalizadas {total_sessoes} sessões neste ciclo.")
+
+def gravar_posicoes_ou_spool(conn, cur, placa, candidatos) -> list:
+    """gravar_posicoes; com o banco fora do ar (ou lento demais) no meio da carga, o lote vai para o spool."""
+    if SPOOL is not None and SPOOL.pendente(placa):
+        # lote anterior da placa está no spool: este vai atrás dele, senão o replay chegaria fora de ordem
+        if spool_gravar(placa, candidatos):
+            return []
+        raise RuntimeError(f"[{placa}] Spool cheio com lote anterior da placa pendente; placa fica para o próximo ciclo.")
+    try:
+        return gravar_posicoes(conn, cur, placa, candidatos)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+        if not candidatos or not spool_gravar(placa, candidatos):
+            raise
+        logging.warning(f"[{placa}] Banco indisponível ({str(e).strip().splitlines()[0]}); {len(candidatos)} posições no spool.")
+        return []
+
+def gravar_e_detectar(conn, cur, placa, candidatos):
+    """Insert com dedup no banco (commit) -> detecção incremental (commit), na conexão recebida."""
+    linhas_novas = gravar_posicoes_ou_spool(conn, cur, placa, candidatos)
+    if linhas_novas:
+        detectar_posicoes(conn, cur, placa, linhas_novas)
+
+def paginas_sequenciais(placa, dt_ini, dt_fim):
+    """Pagina [dt_ini, dt_fim] pela API (time-cursor), uma página por vez, em ordem de EventDate."""
+    cursor_ini = dt_ini
+    total_payload = 0
+
+    while cursor_ini < dt_fim:
+        lote, n = _pagina_api(placa, cursor_ini, dt_fim)
+        logging.info(f"[{placa}] Lote API: {n} posições (cursor={_to_iso_z(cursor_ini)} .. {_to_iso_z(dt_fim)})")
+        if n == 0:
+            break
+        total_payload += n
+        pagina = []
+        proximo = acumular_lote(lote, n, pagina)
+        yield pagina
+        if proximo is None:
+            # não bateu o cap -> já consumimos tudo
+            break
+        cursor_ini = proximo
+
+    logging.info(f"[{placa}] Total recebido (paginado): {total_payload}")
+
+def paginar_posicoes(placa, janela):
+    """
+    Registros da janela [dt_ini, dt_fim] em lotes de ~ETL_LOTE_POSICOES, em ordem de EventDate. A
+    próxima página só é pedida quando o consumidor volta, então quem grava cada lote (com o cursor da
+    placa, no mesmo commit) antes de pedir o seguinte mantém a memória limitada em qualquer janela, e
+    uma queda no meio retoma do último lote gravado.
+    """
+    if janela_longa(janela):
+        paginas = paginas_fatiadas(placa, janela)
+    else:
+        logging.info(f"[{placa}] Buscando janela de {_to_iso_z(janela[0])} até {_to_iso_z(janela[1])}")
+        paginas = paginas_sequenciais(placa, *janela)
+    lote = []
+    for pagina in paginas:
+        lote.extend(pagina)
+        if len(lote) >= ETL_LOTE_POSICOES:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+def baixar_posicoes(placa, janela) -> list:
+    """A janela inteira numa lista (benchmark, testes): memória proporcional à janela."""
+    return [r for lote in paginar_posicoes(placa, janela) for r in lote]
+
+def processar_placa(conn, cur, placa, marca, agora):
+    """
+    Ciclo completo de UMA placa: janela -> API -> dedup -> insert (commit) -> detecção (commit),
+    um lote de paginar_posicoes por vez. Usa somente a conexão recebida, então pode rodar em
+    paralelo com outras placas desde que cada worker tenha a sua.
+    """
+    janela = calcular_janela(placa, marca, agora)
+    if not janela:
+        return
+    for lote in paginar_posicoes(placa, janela):
+        gravar_e_detectar(conn, cur, placa, lote)
+
+def _processar_placa_isolada(conn, cur, placa, marca, agora):
+    """Erro em uma placa não contamina as demais: desfaz só a transação dela e segue."""
+    try:
+        processar_placa(conn, cur, placa, marca, agora)
+    except Exception as e:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+        logging.exception(f"Falha crítica no processamento da placa {placa}: {e}")
+
+def _ordem_justa(placas, ciclo):
+    """
+    Rotaciona a ordem das placas a cada ciclo: se o ciclo estourar o tempo,
+    não são sempre as mesmas placas (fim da lista alfabética) que ficam atrasadas.
+    """
+    if not placas: return placas
+    k = ciclo % len(placas)
+    return placas[k:] + placas[:k]
 
-    headers = {"Accept": "application/json"}
-    if AUTH_METHOD == "GET_PARAMS":
-        resp = requests.get(url, params=params, headers=headers, timeout=30)
-    elif AUTH_METHOD == "POST_FORM":
-        resp = requests.post(url, data=params, headers=headers, timeout=30)
-    else:  # POST_PARAMS
-        resp = requests.post(url, params=params, headers=headers, timeout=30)
+def _worker_placas(fila, marcas, agora):
+    """Worker do pool: conexão própria ao banco, consome placas da fila até esvaziar."""
+    conn = obter_conexao()
+    try:
+        with conn.cursor() as cur:
+            while True:
+                try:
+                    placa = fila.get_nowait()
+                except queue.Empty:
+                    return
+                _processar_placa_isolada(conn, cur, placa, marcas[placa], agora)
+    finally:
+        conn.close()
 
-    if not (200 <= resp.status_code < 300):
-        raise RuntimeError(f"Login HTTP {resp.status_code}: {resp.text[:200]!r}")
+_CICLO = 0
 
+def coletar_e_gravar():
+    global _CICLO
+    API.token()  # falha cedo se o login estiver quebrado (token fica em cache entre ciclos)
     try:
-        data = resp.json()
-        token = data.get("AccessToken") if isinstance(data, dict) else str(data)
-    except JSONDecodeError:
-        token = resp.text.strip()
-    
-    if not token or "<" in token:
-        raise RuntimeError(f"Token inválido recebido: {token[:120]!r}")
-    return token
+        manter_particoes()
+        conn = obter_conexao()
+    except psycopg2.OperationalError as e:
+        coletar_para_spool(marcas_sem_banco(e), ETL_WORKERS)
+        return
+    with conn, conn.cursor() as cur:
+        marcas = preparar_ciclo(conn, cur)
+        placas = _ordem_justa(sorted(marcas), _CICLO)
+        _CICLO += 1
+        agora = datetime.now(timezone.utc)
 
-def api_list_positions(token: str, placa: str, dt_ini: datetime, dt_fim: datetime) -> list[dict]:
+        if ETL_WORKERS <= 1:
+            for placa in placas:
+                _processar_placa_isolada(conn, cur, placa, marcas[placa], agora)
+        else:
+            # fila compartilhada: quem termina primeiro pega a próxima placa (sem worker ocioso)
+            fila = queue.Queue()
+            for placa in placas:
+                fila.put(placa)
+            n_workers = min(ETL_WORKERS, len(placas)) or 1
+            logging.info(f"Processando {len(placas)} placas com {n_workers} workers.")
+            with ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="etl-placa") as pool:
+                futuros = [pool.submit(_worker_placas, fila, marcas, agora) for _ in range(n_workers)]
+                for f in futuros:
+                    try:
+                        f.result()
+                    except Exception as e:
+                        logging.exception(f"Worker de ingestão encerrou com erro: {e}")
+
+        encerrar_ciclo(conn, cur)
+
+# ====================== Motor assíncrono (ETL_ENGINE=async) ======================
+async def _async_list_positions(http, placa: str, dt_ini: datetime, dt_fim: datetime, falhar=False) -> tuple[list, int]:
+    """Versão aiohttp de ApiClient.list_positions: mesmo token em cache, retry e rate limit."""
     url = _build_url(API_BASE_URL, GET_LAST_POSITIONS_PATH)
-    headers = {AUTH_HEADER_NAME: AUTH_HEADER_TEMPLATE.format(token=token), "Accept": "application/json", "Content-Type": "application/json"}
     body = {
         "TrackedUnitType": 1,
         "TrackedUnitIntegrationCode": placa,
@@ -586,168 +3211,665 @@ def api_list_positions(token: str, placa: str, dt_ini: datetime, dt_fim: datetim
     if CLIENT_INTEGRATION_CODE:
         body["ClientIntegrationCode"] = str(CLIENT_INTEGRATION_CODE)
 
-    for tentativa in range(3):
+    relogou, erro = False, None
+    for tentativa in range(API_MAX_TENTATIVAS):
+        espera = None
         try:
-            resp = requests.post(url, json=body, headers=headers, timeout=120)
-            _log_http_debug(resp, label="HistoryPosition")
-
-            if resp.status_code in (401, 403) and tentativa == 0:
-                logging.warning("Auth expirada, tentando relogar...")
-                token = login()
-                headers[AUTH_HEADER_NAME] = AUTH_HEADER_TEMPLATE.format(token=token)
-                continue
-            
-            if resp.status_code == 204: return []
-            resp.raise_for_status()
-            
-            return resp.json() or []
-        
-        except (requests.RequestException, JSONDecodeError) as e:
+            token = await asyncio.to_thread(API.token)
+            headers = {AUTH_HEADER_NAME: AUTH_HEADER_TEMPLATE.format(token=token)}
+            await API.limitador.aguardar_async()
+            async with http.post(url, json=body, headers=headers) as resp:
+                if resp.status in (401, 403) and not relogou:
+                    logging.warning("Auth expirada, tentando relogar...")
+                    API.invalidar(token)
+                    relogou = True
+                    continue
+                if resp.status == 204: return [], 0
+                if resp.status in ApiClient.RETRY_STATUS:
+                    espera = ApiClient._espera_retry(tentativa, resp)
+                resp.raise_for_status()
+                leitor = LeitorPaginaPosicoes(placa)
+                registros = []
+                async for chunk in resp.content.iter_chunked(65536):
+                    registros += leitor.feed(chunk)
+                registros += leitor.close()
+                return registros, leitor.total
+        except (aiohttp.ClientError, asyncio.TimeoutError, JSONDecodeError) as e:
+            erro = e
             logging.error(f"API call falhou (tentativa {tentativa+1}): {e}")
-            time.sleep(2 ** tentativa)
-    return []
-
-# ====================== Inserção em rastreio.posicao ======================
-def inserir_posicoes(cur, linhas):
-    if not linhas: return
-    cols = ("id_position","placa","id_event","ignicao","valid_gps","data_evento",
-            "data_atualizacao","latitude","longitude","inputs","outputs",
-            "telemetria","nivel_tanque_percent","raw")
-    tpl = f'({",".join(["%s"] * len(cols))})'
-    sql = f"INSERT INTO rastreio.posicao ({','.join(cols)}) VALUES %s ON CONFLICT (id_position) DO NOTHING;"
-    
-    data_tuples = [
-        tuple(linha.get(c) for c in cols)
-        for linha in linhas
-    ]
-    execute_values(cur, sql, data_tuples, template=tpl, page_size=10000)
-
-# ====================== ETL principal ======================
-def coletar_e_gravar():
-    token = login()
-    with obter_conexao() as conn, conn.cursor() as cur:
-        placas = sorted(carregar_placas_validas(cur))
-        agora = datetime.now(timezone.utc)
-
-        for placa in placas:
+            if tentativa + 1 < API_MAX_TENTATIVAS:
+                METRICAS.contar("etl_api_retentativas_total", placa=placa)
+                await asyncio.sleep(espera if espera is not None else ApiClient._espera_retry(tentativa))
+    if falhar:
+        raise erro or RuntimeError(f"[{placa}] API sem resposta válida após {API_MAX_TENTATIVAS} tentativas")
+    return [], 0
+
+async def _async_pagina(http, sem_api, placa, ini, fim, falhar=False):
+    async with sem_api:
+        with cronometrar("api", placa):
+            lote, n = await _async_list_positions(http, placa, ini, fim, falhar)
+    METRICAS.contar("etl_api_paginas_total", placa=placa)
+    METRICAS.contar("etl_posicoes_recebidas_total", n, placa=placa)
+    return lote, n
+
+async def _async_paginas_fatiadas(http, sem_api, placa, janela):
+    """Backfill em fatias no event loop (mesma ordem e limites de paginas_fatiadas; semáforo global da API)."""
+    fatias = _FatiasEmOrdem(placa, janela)
+    voando = {}
+    try:
+        while True:
+            for lote in fatias.prontas():
+                yield lote
+            if fatias.encerrada():
+                return
+            for no in fatias.a_buscar():
+                voando[asyncio.ensure_future(_async_pagina(http, sem_api, placa, no[0], no[1], True))] = no
+            prontos, _ = await asyncio.wait(voando, return_when=asyncio.FIRST_COMPLETED)
+            for t in prontos:
+                no = voando.pop(t)
+                try:
+                    resultado = t.result()
+                except Exception as e:
+                    fatias.falhou(no, e)
+                    continue
+                fatias.concluir(no, resultado)
+    finally:
+        for t in voando:
+            t.cancel()
+
+async def _async_paginas_sequenciais(http, sem_api, placa, dt_ini, dt_fim):
+    cursor_ini, total_payload = dt_ini, 0
+    while cursor_ini < dt_fim:
+        lote, n = await _async_pagina(http, sem_api, placa, cursor_ini, dt_fim)
+        logging.info(f"[{placa}] Lote API: {n} posições (cursor={_to_iso_z(cursor_ini)} .. {_to_iso_z(dt_fim)})")
+        if n == 0:
+            break
+        total_payload += n
+        pagina = []
+        proximo = acumular_lote(lote, n, pagina)
+        yield pagina
+        if proximo is None:
+            break
+        cursor_ini = proximo
+    logging.info(f"[{placa}] Total recebido (paginado): {total_payload}")
+
+async def _async_paginar_placa(http, sem_api, placa, janela):
+    """Versão async de paginar_posicoes (concorrente com as demais placas)."""
+    if janela_longa(janela):
+        paginas = _async_paginas_fatiadas(http, sem_api, placa, janela)
+    else:
+        logging.info(f"[{placa}] Buscando janela de {_to_iso_z(janela[0])} até {_to_iso_z(janela[1])}")
+        paginas = _async_paginas_sequenciais(http, sem_api, placa, *janela)
+    lote = []
+    async for pagina in paginas:
+        lote.extend(pagina)
+        if len(lote) >= ETL_LOTE_POSICOES:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+async def _async_writer(fila):
+    """
+    Consome lotes já baixados e grava/detecta numa thread com conexão própria.
+    Enquanto uma placa grava, o event loop continua baixando as próximas (pipeline).
+    Cada placa cai sempre na fila do mesmo writer: seus lotes são gravados na ordem.
+    """
+    falhas = set()   # placa com lote que falhou descarta os seguintes do ciclo (sem buraco no cursor)
+    try:
+        conn = await asyncio.to_thread(obter_conexao)
+    except psycopg2.Error as e:
+        # sem banco: continua drenando a fila para não travar os downloads (placas voltam no próximo ciclo)
+        logging.error(f"Writer sem conexão com o banco: {e}")
+        conn = None
+    try:
+        cur = conn.cursor() if conn else None
+        while True:
+            item = await fila.get()
             try:
-                dt_ultimo = obter_ultima_data_posicao(cur, placa)
-                if dt_ultimo:
-                    dt_ini = (dt_ultimo.astimezone(timezone.utc) if dt_ultimo.tzinfo else dt_ultimo.replace(tzinfo=LOCAL_TZ)).astimezone(timezone.utc)
-                else:
-                    dt_inst = obter_data_instalacao(cur, placa)
-                    dt_ini = dt_inst.astimezone(timezone.utc) if dt_inst else datetime(agora.year, 1, 1, tzinfo=timezone.utc)
-                
-                dt_fim = agora
-                if dt_ini >= dt_fim:
-                    logging.info(f"[{placa}] Sem novas posições para buscar (última em {dt_ultimo}).")
+                if item is None:
+                    return
+                placa, candidatos = item
+                if placa in falhas or (conn is None and not spool_gravar(placa, candidatos)):
+                    falhas.add(placa)
+                    logging.warning(f"[{placa}] Descartando {len(candidatos)} posições no writer.")
                     continue
+                if conn is not None and not await asyncio.to_thread(_gravar_e_detectar_isolado, conn, cur, placa, candidatos):
+                    falhas.add(placa)
+            finally:
+                fila.task_done()
+    finally:
+        if conn is not None:
+            await asyncio.to_thread(conn.close)
+
+def _gravar_e_detectar_isolado(conn, cur, placa, candidatos) -> bool:
+    try:
+        gravar_e_detectar(conn, cur, placa, candidatos)
+        return True
+    except Exception as e:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+        logging.exception(f"Falha crítica no processamento da placa {placa}: {e}")
+        return False
 
-                # ===== Paginação por tempo (time-cursor) =====
-                logging.info(f"[{placa}] Buscando janela de {_to_iso_z(dt_ini)} até {_to_iso_z(dt_fim)}")
-
-                SOFT_CAP = 1000  # limite observado na API (ajuste se mudar)
-                cursor_ini = dt_ini
-                total_payload = 0
-                candidatos = []
-
-                while cursor_ini < dt_fim:
-                    lote = api_list_positions(token, placa, cursor_ini, dt_fim)
-                    n = len(lote)
-                    logging.info(f"[{placa}] Lote API: {n} posições (cursor={_to_iso_z(cursor_ini)} .. {_to_iso_z(dt_fim)})")
-                    if n == 0:
-                        break
+async def coletar_e_gravar_async(http):
+    global _CICLO
+    await asyncio.to_thread(API.token)
+    def _marcas():
+        manter_particoes()
+        conn = obter_conexao()
+        try:
+            with conn.cursor() as cur:
+                return preparar_ciclo(conn, cur)
+        finally:
+            conn.close()
+    try:
+        marcas, com_banco = await asyncio.to_thread(_marcas), True
+    except psycopg2.OperationalError as e:
+        marcas, com_banco = marcas_sem_banco(e), False   # writers sem conexão gravam no spool
+    placas = _ordem_justa(sorted(marcas), _CICLO)
+    _CICLO += 1
+    agora = datetime.now(timezone.utc)
+    janelas = {placa: calcular_janela(placa, marcas[placa], agora) for placa in placas}
+
+    # backpressure: download não dispara à frente da gravação (ASYNC_FILA_MAX lotes no total)
+    n_writers = max(1, ASYNC_DB_WRITERS)
+    filas = [asyncio.Queue(maxsize=max(1, ASYNC_FILA_MAX // n_writers)) for _ in range(n_writers)]
+    writers = [asyncio.create_task(_async_writer(f)) for f in filas]
+    sem_api = asyncio.Semaphore(max(1, ASYNC_API_CONCORRENCIA))
+
+    async def _placa(placa):
+        fila = filas[hash(placa) % n_writers]
+        try:
+            async for lote in _async_paginar_placa(http, sem_api, placa, janelas[placa]):
+                await fila.put((placa, lote))
+        except Exception as e:
+            logging.exception(f"Falha crítica no download da placa {placa}: {e}")
+
+    await asyncio.gather(*(_placa(p) for p in placas if janelas.get(p)))
+    for f in filas:
+        await f.put(None)
+    await asyncio.gather(*writers, return_exceptions=True)
+    if not com_banco:
+        await asyncio.to_thread(SPOOL.sincronizar)
+        return
+
+    def _encerrar():
+        conn = obter_conexao()
+        try:
+            with conn.cursor() as cur:
+                encerrar_ciclo(conn, cur)
+        finally:
+            conn.close()
+    await asyncio.to_thread(_encerrar)
 
-                    # Ordena por timestamp da API (asc) para pegar o último com precisão de ms
+async def loop_async():
+    """
+    Ciclos agendados pelo INÍCIO do ciclo anterior (sem deriva): se um ciclo demora 40 s
+    com FREQUENCIA=60, o próximo começa 20 s depois. Ciclos que estouram pulam os ticks perdidos.
+    """
+    if aiohttp is None:
+        raise RuntimeError("ETL_ENGINE=async requer o pacote 'aiohttp' instalado.")
+    timeout = aiohttp.ClientTimeout(total=120)
+    conector = aiohttp.TCPConnector(limit=max(1, ASYNC_API_CONCORRENCIA), keepalive_timeout=60)
+    async with aiohttp.ClientSession(timeout=timeout, connector=conector,
+                                     headers={"Accept": "application/json"}) as http:
+        proximo = time.monotonic()
+        while True:
+            inicio = time.monotonic()
+            try:
+                with ciclo_medido():
+                    await coletar_e_gravar_async(http)
+            except Exception as e:
+                logging.exception(f"Falha irrecuperável no ciclo de ETL: {e}")
+            duracao = time.monotonic() - inicio
+            proximo += FREQUENCIA
+            if proximo <= time.monotonic():
+                atrasados = int((time.monotonic() - proximo) // FREQUENCIA) + 1
+                logging.warning(f"Ciclo levou {duracao:.1f}s (> {FREQUENCIA}s); pulando {atrasados} tick(s).")
+                proximo += atrasados * FREQUENCIA
+            espera = max(0.0, proximo - time.monotonic())
+            logging.info(f"Ciclo em {duracao:.1f}s; próximo em {espera:.1f}s.")
+            await asyncio.sleep(espera)
+
+# ====================== Motor em estágios (ETL_ENGINE=pipeline) ======================
+# download (API + parsing, PIPELINE_BAIXAR_WORKERS) -> insert (PIPELINE_GRAVAR_WORKERS) -> detecção
+# (PIPELINE_DETECTAR_WORKERS), ligados por filas limitadas: com o estágio seguinte atrasado, o put
+# bloqueia e o anterior espera (backpressure). A detecção consome lotes já commitados, então uma placa
+# lenta para detectar não segura o insert das demais. Insert e detecção são particionados por placa
+# (mesma placa -> mesmo worker, fila FIFO): os lotes de uma placa são gravados e detectados na ordem
+# em que foram baixados. O ciclo só termina com as filas vazias (nada de um ciclo cruza o seguinte).
+_FIM_ESTAGIO = object()
+
+class _Estagio:
+    """Workers com fila limitada e conexão própria; cada lote vai para o worker da sua placa."""
+
+    def __init__(self, nome, n_workers, processar, sem_banco=None):
+        self.nome, self.processar, self.sem_banco = nome, processar, sem_banco
+        self.filas = [queue.Queue(maxsize=PIPELINE_FILA_MAX) for _ in range(n_workers)]
+        self.falhas = set()   # placa que falhou descarta os lotes seguintes do ciclo (sem buraco no cursor)
+        self.threads = [threading.Thread(target=self._worker, args=(f,), name=f"etl-{nome}-{i}", daemon=True)
+                        for i, f in enumerate(self.filas)]
+        for t in self.threads:
+            t.start()
+
+    def enviar(self, placa, lote):
+        t = time.perf_counter()
+        self.filas[hash(placa) % len(self.filas)].put((placa, lote))
+        espera = time.perf_counter() - t
+        if espera >= 0.001:
+            METRICAS.contar("etl_pipeline_bloqueio_segundos_total", round(espera, 6), fila=self.nome)
+
+    def encerrar(self):
+        """Espera os workers esvaziarem as filas e fecharem as conexões."""
+        for f in self.filas:
+            f.put(_FIM_ESTAGIO)
+        for t in self.threads:
+            t.join()
+
+    def _worker(self, fila):
+        try:
+            conn = obter_conexao()
+        except psycopg2.Error as e:
+            # sem banco: continua drenando para não travar o estágio anterior (placas voltam no próximo ciclo)
+            logging.error(f"Pipeline ({self.nome}) sem conexão com o banco: {e}")
+            conn = None
+        try:
+            cur = conn.cursor() if conn else None
+            while (item := fila.get()) is not _FIM_ESTAGIO:
+                placa, lote = item
+                if conn is None or placa in self.falhas:
+                    # sem conexão: o estágio de insert manda para o spool (lotes seguintes da placa só se este coube)
+                    if placa in self.falhas or self.sem_banco is None or not self.sem_banco(placa, lote):
+                        self.falhas.add(placa)
+                        logging.warning(f"[{placa}] Descartando lote de {len(lote)} posições no {self.nome}.")
+                    continue
+                try:
+                    self.processar(conn, cur, placa, lote)
+                except Exception as e:
+                    self.falhas.add(placa)
                     try:
-                        lote.sort(key=lambda x: _parse_dt_any(x.get("EventDate")))
-                    except Exception:
+                        conn.rollback()
+                    except psycopg2.Error:
                         pass
+                    logging.exception(f"Falha crítica no {self.nome} da placa {placa}: {e}")
+        finally:
+            if conn is not None:
+                conn.close()
+
+def coletar_e_gravar_pipeline():
+    global _CICLO
+    API.token()
+    try:
+        manter_particoes()
+        conn = obter_conexao()
+    except psycopg2.OperationalError as e:
+        coletar_para_spool(marcas_sem_banco(e), PIPELINE_BAIXAR_WORKERS)
+        return
+    with conn, conn.cursor() as cur:
+        marcas = preparar_ciclo(conn, cur)
+        placas = _ordem_justa(sorted(marcas), _CICLO)
+        _CICLO += 1
+        agora = datetime.now(timezone.utc)
+        janelas = {placa: calcular_janela(placa, marcas[placa], agora) for placa in placas}
 
-                    # Converte lote em 'candidatos' (mesma lógica original)
-                    for item in lote:
-                        try:
-                            idp = int(item["IdPosition"])
-                            tele = item.get("ListTelemetry") or {}
-                            nivel_raw = item.get("PercentageLevelTank")
-                            if nivel_raw is None and isinstance(tele, dict):
-                                nivel_raw = tele.get("304")
-                            vel = item.get("SpeedKmh")
-                            if vel is None:
-                                vel = item.get("Speed")
-                            candidatos.append({
-                                "id_position": idp, "placa": placa, "id_event": item.get("IdEvent"),
-                                "ignicao": item.get("Ignition"), "valid_gps": item.get("ValidGPS"),
-                                "data_evento": _to_db_ts(item.get("EventDate")),
-                                "data_atualizacao": _to_db_ts(item.get("UpdateDate")) if item.get("UpdateDate") else None,
-                                "latitude": item.get("Latitude"), "longitude": item.get("Longitude"),
-                                "inputs": json.dumps(item.get("ListInputSensor") or {}),
-                                "outputs": json.dumps(item.get("ListOutputActuator") or {}),
-                                "telemetria": json.dumps(tele),
-                                "nivel_tanque_percent": float(nivel_raw) if nivel_raw is not None else None,
-                                "velocidade_kmh": float(vel) if vel is not None else None,
-                                "raw": json.dumps(item),
-                            })
-                        except (KeyError, TypeError, ValueError) as e:
-                            logging.warning(f"Erro ao processar item para {placa}: {e} - Item: {str(item)[:200]}")
-
-                    total_payload += n
-
-                    # Se bateu perto do limite, avança o cursor para DEPOIS do último timestamp do lote
-                    if n >= SOFT_CAP:
-                        last_api_ts_utc = _parse_dt_any(lote[-1].get("EventDate"))  # aware/UTC
-                        # avança 1 ms para não reprocessar o último
-                        cursor_ini = (last_api_ts_utc + timedelta(milliseconds=1)).astimezone(timezone.utc)
-                        continue
-                    else:
-                        # não bateu o cap -> já consumimos tudo
-                        break
+        detectar = _Estagio("detect", PIPELINE_DETECTAR_WORKERS, detectar_posicoes)
 
-                logging.info(f"[{placa}] Total recebido (paginado): {total_payload}")
+        def _gravar(conn_w, cur_w, placa, candidatos):
+            linhas_novas = gravar_posicoes_ou_spool(conn_w, cur_w, placa, candidatos)
+            if linhas_novas:
+                detectar.enviar(placa, linhas_novas)   # já commitadas; espera só se a detecção estiver atrasada
+        gravar = _Estagio("insert", PIPELINE_GRAVAR_WORKERS, _gravar, sem_banco=spool_gravar)
 
-                # ===== dedupe + insert exatamente como você já fazia =====
-                if not candidatos:
-                    continue
+        def _baixar(placa):
+            try:
+                for lote in paginar_posicoes(placa, janelas[placa]):
+                    gravar.enviar(placa, lote)   # cada lote segue para o insert enquanto o próximo é baixado
+            except Exception as e:
+                logging.exception(f"Falha crítica no download da placa {placa}: {e}")
 
-                mapa = {c["id_position"]: c for c in candidatos}
-                ids = list(mapa.keys())
-                existentes = carregar_ids_existentes(cur, ids)
-                linhas_novas = [c for c in mapa.values() if c["id_position"] not in existentes]
+        logging.info(f"Pipeline: {len(placas)} placas, {PIPELINE_BAIXAR_WORKERS} downloads, "
+                     f"{PIPELINE_GRAVAR_WORKERS} inserts, {PIPELINE_DETECTAR_WORKERS} detecções.")
+        try:
+            with ThreadPoolExecutor(max_workers=PIPELINE_BAIXAR_WORKERS, thread_name_prefix="etl-api") as pool:
+                list(pool.map(_baixar, [p for p in placas if janelas[p]]))
+        finally:
+            gravar.encerrar()
+            detectar.encerrar()
+
+        encerrar_ciclo(conn, cur)
+
+# ====================== Reprocessamento offline ======================
+# `etl.py reprocessar`: recalcula as sessões de placas/intervalo a partir de rastreio.posicao com a
+# configuração atual do detector, uma placa por processo, numa tabela-sombra
+# (06_reprocessamento.sql). Nada muda em operacao.sessao_tanque até trocar_sessoes_sombra().
+REPROCESSAR_LOTE = int(os.getenv("REPROCESSAR_LOTE", "50000"))   # posições por leitura do cursor
+
+# configuração que muda o resultado do detector (gravada com a execução, para comparar depois)
+_PARAMETROS_DETECTOR = (
+    "TREND_WINDOW_POINTS", "TREND_START_THRESHOLD_PP", "TREND_STOP_THRESHOLD_PP", "TREND_CONFIRMATION_WINDOWS",
+    "MAX_INV_PCT", "MIN_SESSION_DURATION_SEC", "MIN_SESSION_DELTA_PP", "MAX_STALE_TIME_MIN",
+    "MAX_SESSION_DURATION_MIN", "SLOW_WIN_SEC", "SLOW_RANGE", "SLOW_NEGFR", "TOUCH_ONLY_WHEN_STOPPED",
+    "SPEED_STOP_MAX_KMH", "SPIKE_MIN_JUMP_PP", "SPIKE_REV_WIN_SEC", "SPIKE_TOL_BAND_PP",
+    "MIN_DWELL_NEW_LEVEL_SEC", "EXIT_RADIUS_M", "RESUME_STOP_DWELL_SEC",
+)
 
-                if not linhas_novas:
-                    logging.info(f"[{placa}] Nenhuma posição nova após filtrar existentes.")
-                    continue
+def _sombra_inserir(cur, sessoes, origem):
+    """Sessões do detector (nunca gravadas) -> operacao.sessao_tanque_sombra; canceladas ficam de fora."""
+    classificar_descargas(sessoes)
+    linhas = []
+    for s in sessoes:
+        if s["fim"] == "cancelar": continue
+        t, nv, lat, lon, id_fim = s["toque"] or (None, None, None, None, None)
+        linhas.append((origem, s["placa"], s["tipo"], s["t0"], (t or s["t0"]) if s["fim"] == "finalizar" else None,
+                       float(s["nivel0"]), float(nv) if nv is not None else None, s["lat0"], s["lon0"], lat, lon,
+                       s.get("id_pos0"), id_fim, t or s["t0"]))
+    if linhas:
+        execute_values(cur, """
+            INSERT INTO operacao.sessao_tanque_sombra
+                   (origem, placa, tipo, inicio_em, fim_em, nivel_inicio_pct, nivel_fim_pct,
+                    lat_inicio, lon_inicio, lat_fim, lon_fim, id_position_inicio, id_position_fim, atualizado_em)
+            VALUES %s;
+        """, linhas)
+    return len(linhas)
+
+def _reprocessar_inicio_processo(log_detector):
+    # o detector registra cada sessão (INFO/WARNING): num ano de frota isso vira ruído (e custo).
+    # Só o logger dele: avisos e exceções do resto do worker continuam saindo.
+    if not log_detector:
+        _LOG_DETECTOR.setLevel(logging.ERROR)
+
+def _reprocessar_placa(placa, de, ate, origem):
+    """
+    Tarefa do pool: lê as posições da placa em [de, ate) por cursor no servidor, em lotes de
+    REPROCESSAR_LOTE, alimenta um detector novo e grava na sombra as sessões já encerradas a
+    cada lote. Devolve (placa, posições, sessões gravadas, segundos).
+    """
+    inicio = time.monotonic()
+    det = DetectorTendencia(placa)
+    posicoes = gravadas = 0
+    conn = obter_conexao()
+    try:
+        with conn.cursor() as cur:
+            carregar_areas(cur)
+        leitor = conn.cursor(name=f"reproc_{placa}")
+        leitor.itersize = REPROCESSAR_LOTE
+        # data_evento já no horário local sem fuso (o que o detector usa) e numéricos como float, como
+        # chegam da API no ciclo normal: poupa a conversão por linha (Decimal/fuso) no cliente
+        leitor.execute("""
+            SELECT id_position, data_evento AT TIME ZONE %s, nivel_tanque_percent::float8, latitude, longitude,
+                   velocidade_kmh::float8
+              FROM rastreio.posicao
+             WHERE placa = %s AND data_evento >= %s AND data_evento < %s
+             ORDER BY data_evento, id_position
+        """, (LOCAL_TZ_NAME, placa, de, ate))
+        with conn.cursor() as cur:
+            while True:
+                rows = leitor.fetchmany(REPROCESSAR_LOTE)
+                if not rows: break
+                posicoes += len(rows)
+                det.processar(None, [
+                    Posicao(id_position=r[0], placa=placa, data_evento=r[1], nivel_tanque_percent=r[2],
+                            latitude=r[3], longitude=r[4], velocidade_kmh=r[5])
+                    for r in rows
+                ])
+                gravadas += _sombra_inserir(cur, det.retirar_encerradas(), origem)
+            leitor.close()
+            # fim do intervalo não fecha sessão: pendentes do anti-spike são processados e a aberta
+            # vai para a sombra como aberta (fica fora da troca)
+            det.drenar(None)
+            gravadas += _sombra_inserir(cur, det.retirar_pendentes(), origem)
+        conn.commit()
+    finally:
+        conn.close()
+    return placa, posicoes, gravadas, time.monotonic() - inicio
 
-                linhas_novas.sort(key=lambda r: (r["data_evento"], r["id_position"]))
-                inserir_posicoes(cur, linhas_novas)
-                logging.info(f"[{placa}] Inseridas {len(linhas_novas)} novas posições.")
-                conn.commit()
+def reprocessar(placas, de, ate, processos=None, origem=None, log_detector=False):
+    """
+    Reprocessa as placas em [de, ate) num pool de processos e registra a execução em
+    operacao.reprocessamento. Devolve a origem. Placa que falhar interrompe tudo (a execução
+    não é marcada como concluída e não pode ser trocada). log_detector mantém o log por sessão
+    do detector nos workers (padrão: só ERROR dele).
+    """
+    origem = origem or f"reproc_{datetime.now(LOCAL_TZ):%Y%m%d_%H%M%S}"
+    parametros = {k: str(globals()[k]) for k in _PARAMETROS_DETECTOR}
+    with obter_conexao() as conn, conn.cursor() as cur:
+        if not placas:
+            cur.execute("SELECT placa FROM cadastro.veiculo WHERE ativo ORDER BY placa;")
+            placas = [r[0] for r in cur.fetchall()]
+        cur.execute("""
+            INSERT INTO operacao.reprocessamento (origem, placas, de, ate, parametros)
+            VALUES (%s, %s, %s, %s, %s);
+        """, (origem, placas, de, ate, json.dumps(parametros)))
+    conn.close()   # antes do fork: os processos abrem as próprias conexões
+
+    inicio, total = time.monotonic(), 0
+    processos = max(1, min(processos or os.cpu_count() or 1, len(placas) or 1))
+    logging.info(f"Reprocessando {len(placas)} placas de {de} a {ate} em {processos} processos (origem {origem}).")
+    with ProcessPoolExecutor(max_workers=processos, initializer=_reprocessar_inicio_processo,
+                             initargs=(log_detector,)) as pool:
+        futuros = [pool.submit(_reprocessar_placa, placa, de, ate, origem) for placa in placas]
+        for f in as_completed(futuros):
+            placa, posicoes, sessoes, seg = f.result()
+            total += posicoes
+            logging.info(f"[{placa}] {posicoes} posições, {sessoes} sessões em {seg:.1f}s.")
 
-                LOOKBACK_MINUTES = int(os.getenv("LOOKBACK_MINUTES", "30"))
-                total_sessoes = detect_events_with_context(cur, placa, linhas_novas, lookback_minutes=LOOKBACK_MINUTES)
-                if total_sessoes > 0:
-                    logging.info(f"[{placa}] Finalizadas {total_sessoes} sessões neste ciclo.")
+    with obter_conexao() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE operacao.reprocessamento SET concluido_em = now(), posicoes = %s WHERE origem = %s;",
+                    (total, origem))
+    conn.close()
+    dur = time.monotonic() - inicio
+    logging.info(f"Reprocessamento {origem}: {total} posições em {dur:.1f}s ({total / max(dur, 1e-9):,.0f} posições/s).")
+    return origem
+
+def trocar_sessoes(origem):
+    """Aplica a sombra da execução em operacao.sessao_tanque (uma transação) e atualiza o Qlik."""
+    conn = obter_conexao()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id_sessao, placa, acao FROM operacao.trocar_sessoes_sombra(%s);", (origem,))
+            linhas = cur.fetchall()
+            conn.commit()
+            if QLIK_TABELAS and linhas:
+                cur.execute("SELECT operacao.qlik_atualizar(%s::text[], %s::bigint[]);",
+                            (sorted({r[1] for r in linhas}), [r[0] for r in linhas]))
                 conn.commit()
-
-
-            except Exception as e:
-                logging.exception(f"Falha crítica no processamento da placa {placa}: {e}")
-
-        cur.execute("SELECT operacao.fechar_sessoes_stagnadas(%s);", (int(GAP_MIN),))
-        rows_closed = cur.rowcount
-        if rows_closed > 0:
-            logging.info(f"Finalizadas {rows_closed} sessões estagnadas por GAP.")
-        conn.commit()
+    finally:
+        conn.close()
+    removidas = sum(1 for r in linhas if r[2] == "removida")
+    return removidas, len(linhas) - removidas
 
 # ====================== Loop Principal ======================
-def loop():
+def loop(coletar=coletar_e_gravar):
     while True:
         try:
-            coletar_e_gravar()
+            with ciclo_medido():
+                coletar()
         except Exception as e:
             logging.exception(f"Falha irrecuperável no ciclo de ETL: {e}")
         logging.info(f"Aguardando {FREQUENCIA} segundos para o próximo ciclo.")
         time.sleep(FREQUENCIA)
 
+# ====================== CLI ======================
+def _cmd_executar(args):
+    iniciar_servidor_metricas()
+    PERFIL.instalar_sinal()
+    if ETL_ENGINE == "async":
+        asyncio.run(loop_async())
+    elif ETL_ENGINE == "pipeline":
+        loop(coletar_e_gravar_pipeline)
+    else:
+        loop()
+
+def _cmd_posicao_atual(args):
+    conn = obter_conexao()
+    try:
+        with conn.cursor() as cur:
+            divergentes = verificar_posicao_atual(cur, corrigir=args.corrigir)
+        conn.commit()
+    finally:
+        conn.close()
+    for placa, gravado, esperado in divergentes:
+        logging.warning(f"[{placa}] posicao_atual divergente: gravado={gravado} esperado={esperado}")
+    acao = "reconstruídas" if args.corrigir else "divergentes"
+    logging.info(f"posicao_atual: {len(divergentes)} placas {acao}.")
+    return 1 if divergentes and not args.corrigir else 0
+
+def _cmd_qlik_reconstruir(args):
+    conn = obter_conexao()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT operacao.qlik_reconstruir();")
+            versao = cur.fetchone()[0]
+        conn.commit()
+    finally:
+        conn.close()
+    logging.info(f"Tabelas do Qlik reconstruídas (versão {versao}).")
+
+def _cmd_sessoes_posicoes(args):
+    conn = obter_conexao()
+    try:
+        total = preencher_posicoes_sessoes(conn, lote=args.lote)
+    finally:
+        conn.close()
+    logging.info(f"sessoes-posicoes: concluído, {total} sessões preenchidas.")
+
+def _cmd_sessoes_eventos(args):
+    def imprimir(ev):
+        sys.stdout.write(json.dumps({k: v.isoformat() if isinstance(v, datetime) else v for k, v in ev.items()},
+                                    ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+    conn = obter_conexao()
+    try:
+        with conn.cursor() as cur:
+            perdidos = eventos_sessao_perdidos(cur, args.desde)
+            eventos = [] if args.seguir else ler_eventos_sessao(cur, args.desde, args.limite)
+        conn.commit()
+    finally:
+        conn.close()
+    if perdidos:
+        logging.warning(f"sessoes-eventos: eventos depois do seq {args.desde} já saíram pela retenção "
+                        f"({SESSAO_EVENTOS_RETENCAO_DIAS} dias); recarregue as sessões inteiras.")
+    if args.seguir:
+        try:
+            seguir_eventos_sessao(args.desde, imprimir)
+        except KeyboardInterrupt:
+            pass
+        return 2 if perdidos else 0
+    for ev in eventos:
+        imprimir(ev)
+    return 2 if perdidos else 0
+
+def _data_cli(txt):
+    dt = datetime.fromisoformat(txt)
+    return dt if dt.tzinfo else dt.replace(tzinfo=LOCAL_TZ)
+
+def _cmd_arquivar(args):
+    linhas, particoes, _ = arquivar_posicoes(idade_dias=args.idade_dias)
+    logging.info(f"Arquivo frio: {linhas} posições arquivadas em {ARQUIVO_DIR}.")
+    if not (args.vacuum or args.compactar) or not particoes:
+        return
+    conn = obter_conexao()
+    conn.autocommit = True   # VACUUM não roda dentro de transação
+    try:
+        with conn.cursor() as cur:
+            for nome in sorted(particoes):
+                # FULL devolve o espaço ao disco, mas trava a partição (leituras inclusive) enquanto reescreve
+                cur.execute(f"VACUUM ({'FULL, ' if args.compactar else ''}ANALYZE) rastreio.{nome};")
+                logging.info(f"VACUUM{' FULL' if args.compactar else ''} rastreio.{nome} concluído.")
+    finally:
+        conn.close()
+
+def _cmd_reidratar(args):
+    linhas = reidratar_posicoes(args.placa, _data_cli(args.de), _data_cli(args.ate))
+    if args.restaurar:
+        conn = obter_conexao()
+        try:
+            with conn.cursor() as cur:
+                n = restaurar_posicoes(cur, linhas)
+            conn.commit()
+        finally:
+            conn.close()
+        logging.info(f"[{args.placa}] {n} de {len(linhas)} posições arquivadas restauradas no banco.")
+        return
+    for r in linhas:
+        sys.stdout.write(json.dumps({
+            "id_position": r["id_position"], "placa": r["placa"], "data_evento": r["data_evento"].isoformat(),
+            **{c: json.loads(r[c]) if r[c] is not None else None for c in _ARQUIVO_COLS},
+        }, ensure_ascii=False) + "\n")
+
+def _cmd_reprocessar(args):
+    placas = [p.strip() for p in args.placas.split(",") if p.strip()] if args.placas else None
+    origem = reprocessar(placas, _data_cli(args.de), _data_cli(args.ate), processos=args.processos,
+                         origem=args.origem, log_detector=args.log_detector)
+    _cmd_reprocessar_comparar(argparse.Namespace(origem=origem))
+    if args.trocar:
+        _cmd_reprocessar_trocar(argparse.Namespace(origem=origem))
+
+def _cmd_reprocessar_comparar(args):
+    with obter_conexao() as conn, conn.cursor() as cur:
+        cur.execute("SELECT * FROM operacao.comparar_sessoes_sombra(%s);", (args.origem,))
+        linhas = cur.fetchall()
+    conn.close()
+    print(f"{'placa':<12} {'tipo':<18} {'atual':>6} {'sombra':>6} {'Δpp atual':>10} {'Δpp sombra':>10}")
+    for placa, tipo, n_atual, n_sombra, pp_atual, pp_sombra in linhas:
+        print(f"{placa:<12} {tipo:<18} {n_atual:>6} {n_sombra:>6} {float(pp_atual or 0):>10.1f} "
+              f"{float(pp_sombra or 0):>10.1f}")
+
+def _cmd_reprocessar_trocar(args):
+    removidas, inseridas = trocar_sessoes(args.origem)
+    logging.info(f"Reprocessamento {args.origem} aplicado: {removidas} sessões removidas, {inseridas} inseridas.")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="etl.py", description="ETL de rastreio (API -> rastreio.posicao -> sessões).")
+    sub = ap.add_subparsers(dest="comando")
+    sub.add_parser("executar", help="loop do ETL (padrão sem subcomando)").set_defaults(func=_cmd_executar)
+    p = sub.add_parser("posicao-atual", help="confere rastreio.posicao_atual contra o histórico")
+    p.add_argument("--corrigir", action="store_true", help="reconstrói as placas divergentes")
+    p.set_defaults(func=_cmd_posicao_atual)
+    sub.add_parser("qlik-reconstruir", help="recalcula todas as linhas de operacao.qlik_*"
+                   ).set_defaults(func=_cmd_qlik_reconstruir)
+    p = sub.add_parser("sessoes-posicoes", help="preenche id_position_inicio/fim das sessões antigas")
+    p.add_argument("--lote", type=int, default=5000, help="sessões por transação")
+    p.set_defaults(func=_cmd_sessoes_posicoes)
+    p = sub.add_parser("sessoes-eventos", help="imprime (JSON Lines) os eventos de sessão depois de um seq")
+    p.add_argument("--desde", type=int, default=0, help="último seq já processado")
+    p.add_argument("--limite", type=int, default=10000, help="eventos por leitura (sem --seguir)")
+    p.add_argument("--seguir", action="store_true", help="continua escutando (LISTEN sessao_tanque)")
+    p.set_defaults(func=_cmd_sessoes_eventos)
+    p = sub.add_parser("arquivar", help="move o JSON antigo de rastreio.posicao para Parquet em ARQUIVO_DIR")
+    p.add_argument("--idade-dias", type=int, default=max(ARQUIVO_IDADE_DIAS, 1),
+                   help="arquiva dias (UTC) inteiros mais antigos que isto")
+    p.add_argument("--vacuum", action="store_true", help="VACUUM (ANALYZE) nas partições tocadas")
+    p.add_argument("--compactar", action="store_true", help="VACUUM FULL nas partições tocadas (trava cada uma)")
+    p.set_defaults(func=_cmd_arquivar)
+    p = sub.add_parser("reidratar", help="lê do arquivo frio o JSON de uma placa num intervalo [de, ate)")
+    p.add_argument("--placa", required=True)
+    p.add_argument("--de", required=True, help="início (ISO 8601; sem fuso = horário local)")
+    p.add_argument("--ate", required=True, help="fim exclusivo (ISO 8601; sem fuso = horário local)")
+    p.add_argument("--restaurar", action="store_true",
+                   help="grava o JSON de volta em rastreio.posicao em vez de imprimir (JSON Lines)")
+    p.set_defaults(func=_cmd_reidratar)
+    p = sub.add_parser("reprocessar", help="recalcula sessões de um intervalo numa tabela-sombra")
+    p.add_argument("--placas", help="lista separada por vírgula (padrão: todas as ativas)")
+    p.add_argument("--de", required=True, help="início (ISO 8601; sem fuso = horário local)")
+    p.add_argument("--ate", required=True, help="fim exclusivo (ISO 8601; sem fuso = horário local)")
+    p.add_argument("--processos", type=int, help="processos do pool (padrão: núcleos da máquina)")
+    p.add_argument("--origem", help="rótulo da execução (padrão: reproc_AAAAMMDD_HHMMSS)")
+    p.add_argument("--trocar", action="store_true", help="aplica em operacao.sessao_tanque ao terminar")
+    p.add_argument("--log-detector", action="store_true",
+                   help="mantém o log por sessão do detector nos processos (padrão: só erros dele)")
+    p.set_defaults(func=_cmd_reprocessar)
+    p = sub.add_parser("reprocessar-comparar", help="sessões atuais x sombra de uma execução")
+    p.add_argument("origem")
+    p.set_defaults(func=_cmd_reprocessar_comparar)
+    p = sub.add_parser("reprocessar-trocar", help="troca as sessões do intervalo pelas da sombra (atômico)")
+    p.add_argument("origem")
+    p.set_defaults(func=_cmd_reprocessar_trocar)
+    args = ap.parse_args(argv)
+    return getattr(args, "func", _cmd_executar)(args) or 0
+
 if __name__ == "__main__":
-    loop()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""
+DetectorTendencia: alimentado em pedaços (ponto a ponto ou vetorizado, com gravação a cada ciclo e
+snapshot/restauração do estado no meio), termina com as mesmas sessões que detect_events_by_trend
+analisando o histórico inteiro de uma vez. gravar_sessoes é trocado por uma tabela em memória com o
+mesmo efeito no banco (INSERT/UPDATE/DELETE de operacao.sessao_tanque).
+"""
+import random
+
+import pytest
+
+import etl
+from bench.detector import historico_sintetico
+
+PLACA = "BENCH0001"
+
+
+class _Sessoes:
+    """operacao.sessao_tanque de uma placa: id -> [tipo, inicio, fim, nível início, nível fim, atualizado]."""
+
+    def __init__(self):
+        self.linhas, self._seq = {}, 0
+
+    def gravar(self, cur, sessoes, origem="trend_v2"):
+        etl.classificar_descargas(sessoes)
+        for s in sessoes:
+            t, nv = (s["toque"] or (None, None))[:2]
+            if s["id"] is None:
+                if s["fim"] == "cancelar":
+                    continue
+                self._seq += 1
+                fim = t if s["fim"] == "finalizar" else None
+                self.linhas[self._seq] = [s["tipo"], s["t0"], fim, float(s["nivel0"]),
+                                          float(nv) if nv is not None else None, t]
+                if s["fim"] is None:
+                    s["id"] = self._seq
+            elif s["fim"] == "cancelar":
+                del self.linhas[s["id"]]
+            else:
+                linha = self.linhas[s["id"]]
+                if s["toque"]:
+                    linha[4], linha[5] = float(nv), t
+                if s["fim"] == "finalizar":
+                    linha[0], linha[2] = s["tipo"], linha[5]
+            s["toque"] = None
+        return [], []
+
+    def resultado(self):
+        return sorted(tuple(v) for v in self.linhas.values())
+
+
+class _Cursor:
+    """Sem sessão aberta no banco; guarda o snapshot de salvar() para o carregar() seguinte."""
+
+    def __init__(self):
+        self.estado = None
+        self.connection = self
+        self._linha = None
+
+    def execute(self, sql, params=None):
+        if "INSERT INTO operacao.detector_estado" in sql:
+            self.estado = params[1]
+        self._linha = (etl.json_loads(self.estado),) if "FROM operacao.detector_estado" in sql and self.estado else None
+
+    def fetchone(self):
+        return self._linha
+
+    # cursor nomeado de _recuperar: nenhuma posição gravada depois do snapshot
+    def cursor(self, name=None):
+        return self
+
+    def fetchmany(self, n):
+        return []
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def sessoes(monkeypatch):
+    tabela = _Sessoes()
+    monkeypatch.setattr(etl, "gravar_sessoes", tabela.gravar)
+    monkeypatch.setattr(etl, "DETECTOR_LOTE_VETORIZADO", 0)
+    return tabela
+
+
+def _pedacos(rng, linhas, tamanhos=(1, 2, 5, 37, 300, 2000)):
+    i = 0
+    while i < len(linhas):
+        n = rng.choice(tamanhos)
+        yield linhas[i:i + n]
+        i += n
+
+
+def _em_lote(linhas, vetorizado, monkeypatch):
+    tabela = _Sessoes()
+    monkeypatch.setattr(etl, "gravar_sessoes", tabela.gravar)
+    monkeypatch.setattr(etl, "DETECTOR_LOTE_VETORIZADO", 1 if vetorizado else 0)
+    etl.detect_events_by_trend(_Cursor(), PLACA, linhas)
+    return tabela.resultado()
+
+
+def _incremental(linhas, rng, modos, monkeypatch, restaurar_em=None, restaurar=0.0, tamanhos=(1, 2, 5, 37, 300, 2000)):
+    """
+    Um ciclo por pedaço (processar + gravar + salvar); modo de cada ciclo sorteado entre 'modos'.
+    Restart do processo (carregar do snapshot) ao passar de 'restaurar_em' posições e, a cada
+    ciclo, com probabilidade 'restaurar'.
+    """
+    tabela, cur = _Sessoes(), _Cursor()
+    monkeypatch.setattr(etl, "gravar_sessoes", tabela.gravar)
+    det = etl.DetectorTendencia(PLACA)
+    vistos = 0
+    for pedaco in _pedacos(rng, linhas, tamanhos):
+        monkeypatch.setattr(etl, "DETECTOR_LOTE_VETORIZADO", 1 if rng.choice(modos) == "numpy" else 0)
+        det.processar(cur, pedaco)
+        det.gravar(cur)
+        det.salvar(cur)
+        vistos += len(pedaco)
+        if restaurar_em is not None and vistos >= restaurar_em:
+            det, restaurar_em = etl.DetectorTendencia.carregar(cur, PLACA), None
+        elif rng.random() < restaurar:
+            det = etl.DetectorTendencia.carregar(cur, PLACA)
+    det.encerrar(cur)
+    return tabela.resultado()
+
+
+MODOS = [("ponto",)] + ([("numpy",), ("ponto", "numpy")] if etl.np is not None else [])
+
+
+@pytest.mark.parametrize("modos", MODOS, ids="+".join)
+@pytest.mark.parametrize("semente", range(8))
+def test_incremental_igual_ao_lote(semente, modos, sessoes, monkeypatch):
+    linhas = historico_sintetico(4000, seed=semente)
+    base = _em_lote(linhas, False, monkeypatch)
+    assert len(base) > 5
+    rng = random.Random(semente)
+    assert _incremental(linhas, rng, modos, monkeypatch) == base
+    assert _incremental(linhas, rng, modos, monkeypatch, restaurar_em=len(linhas) // 2) == base
+    assert _incremental(linhas, rng, modos, monkeypatch, restaurar=0.3) == base
+
+
+@pytest.mark.parametrize("modos", MODOS, ids="+".join)
+def test_restart_a_cada_ciclo(modos, sessoes, monkeypatch):
+    # ciclos curtos com restart em todos: o anti-spike tem de continuar com a referência do snapshot
+    linhas = historico_sintetico(1500, seed=11)
+    base = _em_lote(linhas, False, monkeypatch)
+    rng = random.Random(11)
+    assert _incremental(linhas, rng, modos, monkeypatch, restaurar=1.0, tamanhos=(1, 2, 3, 8)) == base
+
+
+@pytest.mark.skipif(etl.np is None, reason="numpy não instalado")
+@pytest.mark.parametrize("semente", range(8))
+def test_lote_vetorizado_igual_ao_ponto_a_ponto(semente, sessoes, monkeypatch):
+    linhas = historico_sintetico(4000, seed=100 + semente)
+    assert _em_lote(linhas, True, monkeypatch) == _em_lote(linhas, False, monkeypatch)
+
+
+def test_snapshot_volta_identico(sessoes):
+    linhas = historico_sintetico(1500, seed=3)
+    cur = _Cursor()
+    det = etl.DetectorTendencia(PLACA)
+    det.processar(cur, linhas[:777])
+    det.gravar(cur)
+    det.salvar(cur)
+    restaurado = etl.DetectorTendencia.carregar(cur, PLACA)
+    for campo in etl.DetectorTendencia._CAMPOS_ESTADO:
+        assert getattr(restaurado, campo) == getattr(det, campo), campo
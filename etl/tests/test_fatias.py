@@ -0,0 +1,147 @@
+"""
+Backfill em fatias: planejar_fatias/_subdividir cobrem a janela sem buraco nem sobreposição (na
+resolução de milissegundos com que os limites vão para a API) e _FatiasEmOrdem entrega cada posição
+uma vez, em ordem de EventDate, qualquer que seja a ordem em que as fatias terminam.
+"""
+import random, time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import etl
+
+MS = timedelta(milliseconds=1)
+T0 = datetime(2025, 3, 1, tzinfo=timezone.utc)
+
+
+def _na_api(dt):
+    """Limite como a API o recebe (_to_iso_z: UTC truncado no milissegundo)."""
+    return datetime.fromisoformat(etl._to_iso_z(dt).replace("Z", "+00:00"))
+
+
+def _assert_cobre(fatias, de, ate):
+    """Intervalos fechados [ini, fim] em ms: contíguos, sem sobreposição, de 'de' até 'ate'."""
+    limites = [(_na_api(a), _na_api(b)) for a, b in fatias]
+    assert limites[0][0] == _na_api(de)
+    assert limites[-1][1] == _na_api(ate)
+    for (a, b), (c, _) in zip(limites, limites[1:]):
+        assert a <= b
+        assert c == b + MS
+    assert limites[-1][0] <= limites[-1][1]
+
+
+def _instante(rng, ini, segundos):
+    return ini + timedelta(microseconds=rng.randrange(int(segundos * 1e6)))
+
+
+@pytest.mark.parametrize("semente", range(200))
+def test_planejar_fatias_cobre_a_janela(semente):
+    rng = random.Random(semente)
+    de = _instante(rng, T0, 86400)
+    ate = de + timedelta(seconds=rng.choice([0.002, 1, 3600, 6 * 3600, 90 * 86400]) * rng.random() + 0.001)
+    horas = rng.choice([None, 6, 1, 0.25, rng.uniform(1e-6, 48)])
+    _assert_cobre(etl.planejar_fatias(de, ate, horas), de, ate)
+
+
+def _lote(instantes):
+    return [etl.Posicao(id_position=int(t.timestamp() * 1000), placa="TST0001", data_evento=t.replace(tzinfo=None),
+                        evento_api=t) for t in instantes]
+
+
+@pytest.mark.parametrize("semente", range(200))
+def test_subdividir_cobre_o_resto_da_fatia(semente, monkeypatch):
+    rng = random.Random(semente)
+    monkeypatch.setattr(etl, "BACKFILL_CONCORRENCIA", rng.choice([1, 4, 8]))
+    cap = etl.API_SOFT_CAP
+    ini = _instante(rng, T0, 86400)
+    fim = ini + timedelta(hours=rng.uniform(0.01, 48))
+    # página que bateu o cap: os 'cap' itens mais antigos, o último em algum ponto antes do fim
+    ultimo = _na_api(ini + (fim - ini) * rng.uniform(0.001, 0.999))
+    lote = _lote(sorted({_na_api(ini + (ultimo - ini) * rng.random()) for _ in range(cap - 1)} | {ultimo}))
+    subs = etl._subdividir(lote, cap, ini, fim)
+    assert len(subs) >= 2
+    _assert_cobre([(ini, ultimo)] + subs, ini, fim)
+    assert etl._subdividir(lote, cap - 1, ini, fim) == []
+
+
+class _ApiFalsa:
+    """Posições com EventDate únicos em ms; devolve as 'cap' mais antigas de [ini, fim] (limites em ms)."""
+
+    def __init__(self, rng, de, ate, n):
+        self.rng = rng
+        total_ms = int((ate - de) / MS)
+        self.instantes = sorted({_na_api(de) + MS * rng.randrange(total_ms + 1) for _ in range(n)})
+        self.pedidos = []
+
+    def __call__(self, ini, fim):
+        self.pedidos.append((ini, fim))
+        a, b = _na_api(ini), _na_api(fim)
+        dentro = [t for t in self.instantes if a <= t <= b]
+        lote = _lote(dentro[:etl.API_SOFT_CAP])
+        self.rng.shuffle(lote)   # a API não garante a ordem dentro da página
+        return lote, len(lote)
+
+
+def _rodar(fatias, api, rng, falhar_em=None):
+    """Conclui as fatias em voo em ordem aleatória; devolve os lotes entregues por prontas()."""
+    entregues, voando = [], []
+    while True:
+        entregues.extend(fatias.prontas())
+        if fatias.encerrada():
+            return entregues
+        voando.extend(fatias.a_buscar())
+        assert fatias.em_voo <= etl.BACKFILL_CONCORRENCIA
+        no = voando.pop(rng.randrange(len(voando)))
+        if falhar_em is not None and len(api.pedidos) == falhar_em:
+            api.pedidos.append((no[0], no[1]))
+            fatias.falhou(no, RuntimeError("HTTP 500"))
+        else:
+            fatias.concluir(no, api(no[0], no[1]))
+
+
+@pytest.fixture
+def backfill(monkeypatch):
+    monkeypatch.setattr(etl, "API_SOFT_CAP", 25)
+    monkeypatch.setattr(etl, "BACKFILL_CONCORRENCIA", 3)
+    monkeypatch.setattr(etl, "BACKFILL_FATIA_HORAS", 6.0)
+
+
+@pytest.mark.parametrize("semente", range(100))
+def test_fatias_em_ordem_entrega_tudo_uma_vez(semente, backfill):
+    rng = random.Random(semente)
+    de = _instante(rng, T0, 86400)
+    ate = de + timedelta(hours=rng.uniform(1, 24 * 20))
+    api = _ApiFalsa(rng, de, ate, rng.choice([0, 10, 200, 2000]))
+    fatias = etl._FatiasEmOrdem("TST0001", (de, ate))
+    entregues = [r.evento_api for lote in _rodar(fatias, api, rng) for r in lote]
+    assert entregues == api.instantes
+    assert fatias.posicoes == len(api.instantes) and fatias.requisicoes == len(api.pedidos)
+
+
+@pytest.mark.parametrize("semente", range(50))
+def test_fatia_com_falha_corta_a_entrega_sem_buraco(semente, backfill):
+    rng = random.Random(semente)
+    de = _instante(rng, T0, 86400)
+    ate = de + timedelta(hours=rng.uniform(24, 24 * 10))
+    api = _ApiFalsa(rng, de, ate, 500)
+    fatias = etl._FatiasEmOrdem("TST0001", (de, ate))
+    entregues = [r.evento_api for lote in _rodar(fatias, api, rng, falhar_em=rng.randrange(1, 6)) for r in lote]
+    # só um prefixo contíguo: o que vem depois da fatia que falhou fica para o próximo ciclo
+    assert entregues == api.instantes[:len(entregues)]
+    assert fatias.nos and isinstance(fatias.nos[0][2], Exception)
+    assert all(t < _na_api(fatias.nos[0][0]) for t in entregues)
+    assert all(t >= _na_api(fatias.nos[0][0]) for t in api.instantes[len(entregues):])
+
+
+def test_paginas_fatiadas_em_ordem_com_threads(backfill, monkeypatch):
+    rng = random.Random(7)
+    de, ate = T0, T0 + timedelta(days=15)
+    api = _ApiFalsa(rng, de, ate, 3000)
+
+    def pagina(placa, ini, fim, falhar=False):
+        time.sleep(rng.random() / 500)   # termina fora de ordem
+        return api(ini, fim)
+
+    monkeypatch.setattr(etl, "_pagina_api", pagina)
+    entregues = [r.evento_api for lote in etl.paginas_fatiadas("TST0001", (de, ate)) for r in lote]
+    assert entregues == api.instantes
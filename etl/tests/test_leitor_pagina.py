@@ -0,0 +1,111 @@
+"""
+LeitorPaginaPosicoes: os dois backends (stdlib e orjson) devem entregar os mesmos itens, com o mesmo
+trecho original ('raw'), qualquer que seja o tamanho dos pedaços que chegam da rede.
+"""
+import json
+
+import pytest
+
+import etl
+
+PAGINAS = {
+    "objetos": b'[{"IdPosition": 1, "EventDate": "2025-01-01T00:00:00Z", "ListTelemetry": {"304": 51.5}},'
+               b' {"IdPosition": 2, "EventDate": "2025-01-01T00:00:30Z", "ListInputSensor": {"1": true}}]',
+    "objeto_e_null": b'[{"IdPosition":1,"EventDate":"2025-01-01T00:00:00Z"}, null]',
+    "objeto_e_numero": b'[{"IdPosition":1,"EventDate":"2025-01-01T00:00:00Z"}, 1]',
+    "misto": b'[ 1 , "a]b", {"IdPosition":3,"EventDate":"2025-01-01T00:00:00Z"} ,true,null,'
+             b' [1, {"x": [2, 3]}], -2.5e3, {"IdPosition":4,"EventDate":"2025-01-01T00:01:00Z"}, false ]',
+    "chaves_em_string": b'[{"IdPosition":5,"EventDate":"2025-01-01T00:00:00Z","Obs":"} ,{ ] \\" }"},'
+                        b'{"IdPosition":6,"EventDate":"2025-01-01T00:00:00Z","Obs":"\\\\"}]',
+    "chave_aberta_em_string": b'[{"IdPosition":11,"EventDate":"2025-01-01T00:00:00Z","Obs":"{"},'
+                              b'{"IdPosition":12,"EventDate":"2025-01-01T00:00:00Z","Obs":"{{ ["}]',
+    "chave_fechada_em_string": b'[{"IdPosition":13,"EventDate":"2025-01-01T00:00:00Z","Obs":"}}"}, 2]',
+    "aninhados": b'[{"IdPosition":7,"EventDate":"2025-01-01T00:00:00Z","L":[{"a":{}},{"b":[{}]}]},'
+                 b'{"IdPosition":8,"EventDate":"2025-01-01T00:00:00Z","L":[{}, {}, {"c": {"d": {}}}]}]',
+    "unicode": '[{"IdPosition":9,"EventDate":"2025-01-01T00:00:00Z","Obs":"ação ✓"}, "é"]'.encode(),
+    "nan": b'[{"IdPosition":10,"EventDate":"2025-01-01T00:00:00Z","Speed":NaN}, Infinity]',
+    "vazio": b"[]",
+    "null": b"null",
+}
+PEDACOS = [1, 3, 7, 1 << 20]
+
+
+class _Coletor(etl.LeitorPaginaPosicoes):
+    """Guarda (item, raw) de cada item emitido, inclusive os que não viram Posicao."""
+
+    def __init__(self, placa):
+        super().__init__(placa)
+        self.itens = []
+
+    def _emitir(self, obj, raw_txt, out):
+        self.itens.append((obj, raw_txt.encode() if isinstance(raw_txt, str) else raw_txt))
+        super()._emitir(obj, raw_txt, out)
+
+
+def _ler(monkeypatch, backend, payload, pedaco):
+    monkeypatch.setattr(etl, "JSON_BACKEND", backend)
+    leitor = _Coletor("TST0001")
+    linhas = []
+    for i in range(0, len(payload), pedaco):
+        linhas.extend(leitor.feed(payload[i:i + pedaco]))
+    linhas.extend(leitor.close())
+    return leitor, linhas
+
+
+def _chave(valor):
+    # NaN != NaN: compara pela forma serializada
+    return json.dumps(valor, sort_keys=True)
+
+
+@pytest.mark.skipif(etl.orjson is None, reason="orjson não instalado")
+@pytest.mark.parametrize("pedaco", PEDACOS)
+@pytest.mark.parametrize("nome", sorted(PAGINAS))
+def test_backends_equivalentes(monkeypatch, nome, pedaco):
+    payload = PAGINAS[nome]
+    ref, linhas_ref = _ler(monkeypatch, "stdlib", payload, 1 << 20)
+    for backend in ("stdlib", "orjson"):
+        leitor, linhas = _ler(monkeypatch, backend, payload, pedaco)
+        assert leitor.total == ref.total
+        assert [(_chave(o), r) for o, r in leitor.itens] == [(_chave(o), r) for o, r in ref.itens]
+        assert [p.id_position for p in linhas] == [p.id_position for p in linhas_ref]
+        assert [bytes(p.raw, "utf-8") if isinstance(p.raw, str) else p.raw for p in linhas] == \
+               [bytes(p.raw, "utf-8") if isinstance(p.raw, str) else p.raw for p in linhas_ref]
+
+
+def test_raw_e_o_trecho_original(monkeypatch):
+    for backend in ["stdlib"] + (["orjson"] if etl.orjson is not None else []):
+        leitor, _ = _ler(monkeypatch, backend, PAGINAS["misto"], 3)
+        assert [r for _, r in leitor.itens][:3] == [b"1", b'"a]b"', b'{"IdPosition":3,"EventDate":"2025-01-01T00:00:00Z"}']
+
+
+@pytest.mark.parametrize("backend", ["stdlib", "orjson"])
+def test_array_truncado_falha_no_close(monkeypatch, backend):
+    if backend == "orjson" and etl.orjson is None:
+        pytest.skip("orjson não instalado")
+    monkeypatch.setattr(etl, "JSON_BACKEND", backend)
+    leitor = etl.LeitorPaginaPosicoes("TST0001")
+    leitor.feed(b'[{"IdPosition":1,"EventDate":"2025-01-01T00:00:00Z"}, {"IdPos')
+    with pytest.raises(json.JSONDecodeError):
+        leitor.close()
+
+
+@pytest.mark.skipif(etl.orjson is None, reason="orjson não instalado")
+def test_orjson_decodifica_cada_item_uma_vez(monkeypatch):
+    # item com muitos '}' aninhados seguidos de ',{': um único orjson.loads por item
+    aninhado = b'{"IdPosition":1,"EventDate":"2025-01-01T00:00:00Z","L":[' + b",".join([b'{"a":{}}'] * 200) + b"]}"
+    payload = b"[" + aninhado + b"," + aninhado + b"]"
+    chamadas = []
+    real = etl.orjson.loads
+
+    class _Contador:
+        dumps, JSONDecodeError = etl.orjson.dumps, etl.orjson.JSONDecodeError
+
+        @staticmethod
+        def loads(trecho):
+            chamadas.append(len(trecho))
+            return real(trecho)
+
+    monkeypatch.setattr(etl, "orjson", _Contador)
+    leitor, linhas = _ler(monkeypatch, "orjson", payload, 64)
+    assert len(linhas) == 2
+    assert len(chamadas) == 2
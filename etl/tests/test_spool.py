@@ -0,0 +1,193 @@
+"""
+Spool: lotes gravados sobrevivem a segmento cortado, a falha de uma placa e a queda do banco no meio do
+replay; o replay é idempotente e reaplica os lotes de cada placa na ordem em que foram gravados.
+gravar_posicoes/detectar_posicoes são trocados por um banco em memória com o mesmo contrato
+(ON CONFLICT (id_position) DO NOTHING, devolve só as linhas novas).
+"""
+import os
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+import pytest
+
+import etl
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def _lote(placa, ini, n):
+    return [etl.Posicao(id_position=i, placa=placa, data_evento=(T0 + timedelta(seconds=30 * i)).replace(tzinfo=None),
+                        evento_api=T0 + timedelta(seconds=30 * i), nivel_tanque_percent=50.0, raw=b"{}")
+            for i in range(ini, ini + n)]
+
+
+class _Conexao:
+    def __init__(self):
+        self.commits = self.rollbacks = 0
+
+    def cursor(self):
+        return object()
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class _Banco:
+    """rastreio.posicao em memória + ordem das chamadas; 'falhar' = placas cuja gravação dá erro."""
+
+    def __init__(self, monkeypatch):
+        self.posicoes, self.chamadas, self.detectadas = {}, [], []
+        self.falhar, self.cair = set(), False
+        monkeypatch.setattr(etl, "gravar_posicoes", self.gravar)
+        monkeypatch.setattr(etl, "detectar_posicoes", self.detectar)
+
+    def gravar(self, conn, cur, placa, linhas):
+        if self.cair:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        if placa in self.falhar:
+            raise psycopg2.errors.CheckViolation("violates check constraint")
+        self.chamadas.append((placa, [r.id_position for r in linhas]))
+        novas = [r for r in linhas if r.id_position not in self.posicoes]
+        self.posicoes.update((r.id_position, r.placa) for r in novas)
+        return novas
+
+    def detectar(self, conn, cur, placa, novas):
+        self.detectadas.append((placa, [r.id_position for r in novas]))
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return etl.Spool(str(tmp_path / "spool"), segmento_mb=64, max_mb=1024)
+
+
+@pytest.fixture
+def banco(monkeypatch):
+    return _Banco(monkeypatch)
+
+
+def _novo_segmento(spool, placa, linhas):
+    assert spool.gravar(placa, linhas)
+    spool.sincronizar()
+
+
+def test_gravar_e_ler_ida_e_volta(spool):
+    lote = _lote("AAA0001", 0, 3)
+    _novo_segmento(spool, "AAA0001", lote)
+    (caminho,) = spool.segmentos()
+    assert list(spool.ler(caminho)) == [("AAA0001", lote)]
+    assert spool.pendente("AAA0001") and not spool.pendente("BBB0002")
+
+
+def test_segmento_cortado_e_tolerado(spool, banco):
+    _novo_segmento(spool, "AAA0001", _lote("AAA0001", 0, 3))
+    assert spool.gravar("AAA0001", _lote("AAA0001", 3, 3))
+    assert spool.gravar("BBB0002", _lote("BBB0002", 100, 3))
+    spool.sincronizar()
+    cortado = spool.segmentos()[-1]
+    with open(cortado, "r+b") as f:
+        f.truncate(os.path.getsize(cortado) - 7)   # gravação interrompida no último registro
+
+    assert [p for p, _ in spool.ler(cortado)] == ["AAA0001"]
+    assert spool.reaplicar(_Conexao(), None) == 6
+    assert sorted(banco.posicoes) == list(range(6))
+    assert spool.segmentos() == []
+
+
+def test_registro_corrompido_para_a_leitura(spool):
+    _novo_segmento(spool, "AAA0001", _lote("AAA0001", 0, 2))
+    (caminho,) = spool.segmentos()
+    with open(caminho, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        ultimo = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([ultimo[0] ^ 0xFF]))
+    assert list(spool.ler(caminho)) == []
+
+
+def test_segmento_vazio(spool, banco):
+    os.makedirs(spool.diretorio)
+    open(os.path.join(spool.diretorio, f"{0:020d}.spool"), "wb").close()
+    assert spool.reaplicar(_Conexao(), None) == 0
+    assert spool.segmentos() == []
+
+
+def test_falha_de_uma_placa_mantem_os_lotes_dela(spool, banco):
+    _novo_segmento(spool, "AAA0001", _lote("AAA0001", 0, 3))
+    assert spool.gravar("BBB0002", _lote("BBB0002", 100, 3))
+    assert spool.gravar("AAA0001", _lote("AAA0001", 3, 3))
+    spool.sincronizar()
+    _novo_segmento(spool, "BBB0002", _lote("BBB0002", 103, 3))
+    segmentos = spool.segmentos()
+    assert len(segmentos) == 3
+
+    banco.falhar = {"AAA0001"}
+    conn = _Conexao()
+    assert spool.reaplicar(conn, None) == 6
+    assert conn.rollbacks == 1
+    assert sorted(banco.posicoes) == [100, 101, 102, 103, 104, 105]
+    assert spool.placas == {"AAA0001"}
+    # os dois lotes da placa ficam, cada um no segmento (e na posição) em que estava
+    restantes = [(os.path.basename(c), list(spool.ler(c))) for c in spool.segmentos()]
+    assert [(n, [(p, [r.id_position for r in ls]) for p, ls in lotes]) for n, lotes in restantes] == [
+        (os.path.basename(segmentos[0]), [("AAA0001", [0, 1, 2])]),
+        (os.path.basename(segmentos[1]), [("AAA0001", [3, 4, 5])]),
+    ]
+    assert not any(n.endswith(".tmp") for n in os.listdir(spool.diretorio))
+
+    # o problema foi resolvido: o próximo replay aplica os lotes da placa, do mais antigo ao mais novo
+    banco.falhar = set()
+    banco.chamadas.clear()
+    assert spool.reaplicar(conn, None) == 6
+    assert banco.chamadas == [("AAA0001", [0, 1, 2]), ("AAA0001", [3, 4, 5])]
+    assert sorted(banco.posicoes) == [0, 1, 2, 3, 4, 5, 100, 101, 102, 103, 104, 105]
+    assert spool.segmentos() == [] and spool.placas == set()
+
+
+def test_replay_em_ordem_de_gravacao(spool, banco):
+    for ini in (0, 10, 20):
+        _novo_segmento(spool, "AAA0001", _lote("AAA0001", ini, 2))
+    spool.reaplicar(_Conexao(), None)
+    assert banco.chamadas == [("AAA0001", [0, 1]), ("AAA0001", [10, 11]), ("AAA0001", [20, 21])]
+    assert banco.detectadas == banco.chamadas
+
+
+def test_replay_idempotente(spool, banco):
+    _novo_segmento(spool, "AAA0001", _lote("AAA0001", 0, 4))
+    (caminho,) = spool.segmentos()
+    with open(caminho, "rb") as f:
+        copia = f.read()
+    assert spool.reaplicar(_Conexao(), None) == 4
+    assert spool.reaplicar(_Conexao(), None) == 0   # nada pendente: não chama o banco de novo
+    assert len(banco.chamadas) == 1
+
+    # queda entre o commit e o os.remove: o mesmo segmento volta e é reaplicado sem duplicar nem redetectar
+    with open(caminho, "wb") as f:
+        f.write(copia)
+    banco.detectadas.clear()
+    spool.reaplicar(_Conexao(), None)
+    assert sorted(banco.posicoes) == [0, 1, 2, 3]
+    assert banco.detectadas == []
+    assert spool.segmentos() == []
+
+
+def test_queda_do_banco_no_meio_mantem_o_segmento(spool, banco):
+    _novo_segmento(spool, "AAA0001", _lote("AAA0001", 0, 2))
+    (caminho,) = spool.segmentos()
+    with open(caminho, "rb") as f:
+        antes = f.read()
+    banco.cair = True
+    with pytest.raises(psycopg2.OperationalError):
+        spool.reaplicar(_Conexao(), None)
+    with open(caminho, "rb") as f:
+        assert f.read() == antes
+    banco.cair = False
+    assert spool.reaplicar(_Conexao(), None) == 2
+
+
+def test_spool_cheio_recusa_lote(tmp_path):
+    spool = etl.Spool(str(tmp_path / "spool"), segmento_mb=0, max_mb=0)
+    assert not spool.gravar("AAA0001", _lote("AAA0001", 0, 1))
+    assert not spool.pendente("AAA0001")